@@ -1,12 +1,19 @@
+import multiprocessing
 import sys
 
 from loguru import logger
 
-from com_mate_converter.app import MainApp
+from com_mate_converter import cli
 from com_mate_converter.log import init_logger
 
 
 def main():
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1 and sys.argv[1] in cli.COMMANDS:
+        sys.exit(cli.main(sys.argv[1:]))
+    # The subcommands do not need the app
+    from com_mate_converter.app import MainApp
+
     debug = False
     if sys.argv:
         for i in sys.argv[1:]:
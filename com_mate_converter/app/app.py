@@ -21,11 +21,12 @@ from textual.widgets import (
 from textual.worker import get_current_worker
 
 from com_mate_converter import CMC_Config, _
-from com_mate_converter.work import WorkCommand, WorkManager, WorkProgress, WorkType
+from com_mate_converter.work import WorkManager, WorkType
 
 from .dialog import QuitScreen, WorkConfirmScreen
 from .file_drop import getpaths
 from .logo import logo_str
+from .messages import WorkCommand, WorkProgress
 from .progress import CustomTimeProgress
 from .suggestor import FormatSuggester
 
@@ -67,10 +68,7 @@ class MainApp(App):
                 Container(
                     Label(_("Mate Name Format"), classes="text-label"),
                     Input(
-                        suggester=FormatSuggester(
-                            CMC_Config.get_format_variables(),
-                            case_sensitive=True,
-                        ),
+                        suggester=FormatSuggester(case_sensitive=True),
                         id="mate-format-input",
                     ),
                     Label(
@@ -106,7 +104,10 @@ class MainApp(App):
 
     def on_ready(self) -> None:
         CMC_Config.read_config()
-        self.work_manager = WorkManager(self.post_message)
+        self.work_manager = WorkManager(
+            lambda percentage: self.post_message(WorkProgress(percentage)),
+            lambda: self.post_message(WorkCommand(WorkType.Finished)),
+        )
         self.text_log = self.query_one("#text-log")  # type: ignore
         self.process_percent = self.query_one("#process-percent")  # type: ignore
         self.process_percent.visible = False
@@ -151,13 +152,7 @@ class MainApp(App):
             self.last_time = time.time()
             self.is_working = True
             self.process_percent.visible = True
-            self.process_mate_files(self.input_paths)
-        elif message.work_type == WorkType.Menu:
-            self.process_percent.visible = True
-            self.process_menu_files()
-        elif message.work_type == WorkType.Pmat:
-            self.process_percent.visible = True
-            self.process_pmat_files()
+            self.process_files(self.input_paths)
         elif message.work_type == WorkType.Finished:
             self.process_percent.visible = False
             self.is_working = False
@@ -189,20 +184,9 @@ class MainApp(App):
             CMC_Config.config.pmat_check_mode = list_view.index
 
     @work(exclusive=True, thread=True)
-    def process_mate_files(self, paths: List[str]) -> None:
+    def process_files(self, paths: List[str]) -> None:
         worker = get_current_worker()
-        self.work_manager.wait_for_work_thread_exit()
-        self.work_manager.start_process_mate(paths, lambda: worker.is_cancelled)
-
-    @work(exclusive=True, thread=True)
-    def process_menu_files(self) -> None:
-        self.work_manager.wait_for_work_thread_exit()
-        self.work_manager.start_process_menu()
-
-    @work(exclusive=True, thread=True)
-    def process_pmat_files(self) -> None:
-        self.work_manager.wait_for_work_thread_exit()
-        self.work_manager.start_process_pmat()
+        self.work_manager.run(paths, lambda: worker.is_cancelled)
 
     def send_log_message(self, text: str) -> None:
         if text.startswith("\x1b"):
@@ -45,13 +45,16 @@ class WorkConfirmScreen(ModalScreen):
                 + "\n  ".join(self.input_paths[:3] + (["..."] if len(self.input_paths[:4]) == 4 else []))
                 + "\n\n"
                 + _(
-                    "[grey100]Option:\n  [dodger_blue1]mate_format = '{mate_format}'\n  menu_process_mode = {menu_process_mode}\n  pmat_check_mode = {pmat_check_mode}\n  cpu_percent = {cpu_percent:.0%}\n  backup = {backup}"  # noqa: E501
+                    "[grey100]Option:\n  [dodger_blue1]mate_format = '{mate_format}'\n  menu_process_mode = {menu_process_mode}\n  pmat_check_mode = {pmat_check_mode}\n  cpu_percent = {cpu_percent:.0%}\n  pool_mode = {pool_mode}\n  backup = {backup}\n  backup_backend = {backup_backend} ({backup_filter})"  # noqa: E501
                 ).format(
                     mate_format=CMC_Config.config.mate_format,
                     menu_process_mode=CMC_Config.config.menu_process_mode,
                     pmat_check_mode=CMC_Config.config.pmat_check_mode,
                     cpu_percent=CMC_Config.config.cpu_percent,
+                    pool_mode=CMC_Config.config.pool_mode,
                     backup=CMC_Config.config.backup,
+                    backup_backend=CMC_Config.config.backup_backend,
+                    backup_filter=CMC_Config.config.backup_filter,
                 )
                 + "\n"
             ),
@@ -0,0 +1,15 @@
+from textual.message import Message
+
+from com_mate_converter.work import WorkType
+
+
+class WorkCommand(Message):
+    def __init__(self, work_type: WorkType) -> None:
+        super().__init__()
+        self.work_type = work_type
+
+
+class WorkProgress(Message):
+    def __init__(self, percentage: float) -> None:
+        super().__init__()
+        self.percentage = percentage
@@ -2,11 +2,18 @@ from typing import Optional
 
 from textual.suggester import SuggestFromList
 
+from com_mate_converter.model.format import MateFormat
+
 
 class FormatSuggester(SuggestFromList):
+    """Complete the variable being typed with the variables of `MateFormat`."""
+
+    def __init__(self, *, case_sensitive: bool = True) -> None:
+        super().__init__(MateFormat.get_variables(), case_sensitive=case_sensitive)
+
     async def get_suggestion(self, value: str) -> Optional[str]:
-        index = value.rfind("{")
-        if index >= 0:
+        index = MateFormat.open_variable(value)
+        if index is not None:
             sugg = await super().get_suggestion(value[index:])
             if sugg is not None:
                 return value[:index] + sugg
@@ -0,0 +1,125 @@
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+from loguru import logger
+
+from com_mate_converter import _
+from com_mate_converter.log import init_cli_logger
+
+COMMANDS = ("convert", "restore")
+
+
+class ProgressLogger:
+    """Log the progress of a run in steps of 10%."""
+
+    last_step: int = -1
+
+    def update(self, percentage: int) -> None:
+        if (step := percentage // 10) > self.last_step:
+            self.last_step = step
+            logger.info(_("Progress: {percentage}%").format(percentage=percentage))
+
+    def finish(self) -> None:
+        logger.info(_("[#0087ff]Convert Finished"))
+
+
+def convert_command(args: argparse.Namespace) -> int:
+    """Exit code: 0 done, 1 some files failed, 2 not run or aborted by an error, 130 interrupted."""
+    from com_mate_converter.config import CMC_Config
+    from com_mate_converter.work import WorkManager
+
+    if invalid_paths := [p for p in args.paths if not Path(p).is_dir()]:
+        # A typo must not look like a run with nothing to convert
+        for p in invalid_paths:
+            logger.error(_("Work dir not found: {path}").format(path=p))
+        return 2
+    CMC_Config.read_config()
+    if args.menu_mode is not None:
+        CMC_Config.config.menu_process_mode = args.menu_mode
+    if args.pmat_mode is not None:
+        CMC_Config.config.pmat_check_mode = args.pmat_mode
+    if args.chunk_size is not None:
+        CMC_Config.config.chunk_size = args.chunk_size
+    if args.workers is not None:
+        CMC_Config.worker_num = args.workers
+    if args.auto_workers:
+        CMC_Config.config.auto_workers = True
+    if args.no_backup:
+        CMC_Config.config.backup = False
+    if not CMC_Config.is_shader_info_valid():
+        logger.error(_("Shader Info is None."))
+        return 2
+    progress = ProgressLogger()
+    work_manager = WorkManager(progress.update, progress.finish)
+    start_time = time.perf_counter()
+    interrupted = False
+    try:
+        work_manager.run(args.paths, lambda: False)
+    except KeyboardInterrupt:
+        interrupted = True
+        work_manager.kill_work_thread()
+    work_manager.report_failed()
+    summary = work_manager.get_summary()
+    summary["interrupted"] = interrupted
+    logger.info(_("Used: {seconds:.2f} s").format(seconds=time.perf_counter() - start_time))
+    for stage, seconds in summary["timings"].items():
+        logger.debug(f"{stage}: {seconds:.3f} s")
+    if args.summary is None:
+        json.dump(summary, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with args.summary.open("w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    if interrupted:
+        return 130
+    if work_manager.failed:
+        return 2
+    if any(summary[k]["failed"] for k in ("mate", "menu", "pmat")):
+        return 1
+    return 0
+
+
+def restore_command(args: argparse.Namespace) -> int:
+    from com_mate_converter.work.restore import restore
+
+    if not args.backup_dir.is_dir():
+        logger.error(_("Backup dir not found: {path}").format(path=args.backup_dir))
+        return 2
+    return 0 if restore(args.backup_dir, args.target, args.mod, args.file_types or ()) else 1
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="cmc", description=_("Run without command to start the app."))
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument("--debug", "-debug", action="store_true")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser(
+        "convert", parents=[common_parser], help=_("Convert without the app, the summary is printed as JSON")
+    )
+    convert_parser.add_argument("paths", nargs="+", metavar="PATH")
+    convert_parser.add_argument("--menu-mode", type=int, choices=[0, 1], help=_("menu_process_mode of the config"))
+    convert_parser.add_argument("--pmat-mode", type=int, choices=[0, 1, 2], help=_("pmat_check_mode of the config"))
+    convert_parser.add_argument("--workers", type=int, help=_("Workers per pool instead of cpu_percent"))
+    convert_parser.add_argument("--auto-workers", action="store_true", help=_("Tune the workers of each stage"))
+    convert_parser.add_argument("--chunk-size", type=int, help=_("chunk_size of the config"))
+    convert_parser.add_argument("--no-backup", action="store_true")
+    convert_parser.add_argument("--summary", type=Path, help=_("Write the JSON summary to this file"))
+    convert_parser.set_defaults(func=convert_command)
+    restore_parser = subparsers.add_parser(
+        "restore", parents=[common_parser], help=_("Undo a conversion from its backup folder")
+    )
+    restore_parser.add_argument("backup_dir", type=Path)
+    restore_parser.add_argument("--mod", help=_("Only files in a folder with this name"))
+    restore_parser.add_argument(
+        "--type", dest="file_types", action="append", choices=["mate", "menu", "pmat"], help=_("Only this file type")
+    )
+    restore_parser.add_argument("--target", type=Path, help=_("Extract to this dir instead of the original one"))
+    restore_parser.set_defaults(func=restore_command)
+    args = parser.parse_args(argv)
+    logger.remove()
+    init_cli_logger(args.debug)
+    return args.func(args)
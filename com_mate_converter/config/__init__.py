@@ -1,13 +1,12 @@
 import dataclasses
 import json
+import os
 from pathlib import Path
-from typing import Dict, List
-
-import regex
-from loguru import logger
+from typing import Dict, List, Optional
 
 from com_mate_converter.i18n import _
 from com_mate_converter.model import Config, FormatVariable
+from com_mate_converter.model.format import MateFormat
 
 
 class CMC_Config:
@@ -17,6 +16,15 @@ class CMC_Config:
         pmat_check_mode=0,
         cpu_percent=0.6,
         backup=True,
+        backup_backend="7z",
+        backup_filter="lzma2",
+        backup_memory_limit=256,
+        read_ahead_limit=64,
+        write_behind_limit=64,
+        pool_mode=0,
+        chunk_size=0,
+        auto_workers=False,
+        worker_nums={},
     )
 
     shader_names: Dict[str, str] = {}
@@ -25,33 +33,27 @@ class CMC_Config:
     config_file: Path = Path.cwd() / "config" / "config.json"
     shader_names_file: Path = Path.cwd() / "config" / "ShaderNames.json"
     shader_families_file: Path = Path.cwd() / "config" / "ShaderFamilies.json"
+    scan_manifest_file: Path = Path.cwd() / "scan_manifest.json"
+    # Workers per pool, overrides `Config.cpu_percent` and `Config.auto_workers` when set (`cmc convert --workers`)
+    worker_num: Optional[int] = None
     # ui
     example_mate_format_variable: FormatVariable = FormatVariable(
         mate_name="example",
         shader_family="npr",
         shader_name="_NPRToonV2_",
     )
-    variable_pattern: regex.Pattern = regex.compile(r"\{([^}]+)\}")
-
-    class SafeDict(dict):
-        def __missing__(self, key):
-            if key.lower() in self:
-                return self[key.lower()].upper()
-            return f"{{{key}}}"
+    # Compiled `Config.mate_format`, compiled again when the format changes
+    _mate_format: Optional[MateFormat] = None
 
     @staticmethod
     def get_format_variables() -> List[str]:
-        return [
-            "{mate_name}",
-            "{shader_family}",
-            "{shader_name}",
-            "{MATE_NAME}",
-            "{SHADER_FAMILY}",
-            "{SHADER_NAME}",
-        ]
+        return MateFormat.get_variables()
 
     @staticmethod
     def read_config():
+        # Not imported by `import com_mate_converter`, only once the config is read
+        from loguru import logger
+
         if CMC_Config.config_file.exists():
             try:
                 with CMC_Config.config_file.open("r", encoding="utf-8") as f:
@@ -66,6 +68,24 @@ class CMC_Config:
                         CMC_Config.config.cpu_percent = cpu_percent
                     if (backup := config_dict.get("backup")) is not None:
                         CMC_Config.config.backup = backup
+                    if (backup_backend := config_dict.get("backup_backend")) is not None:
+                        CMC_Config.config.backup_backend = backup_backend
+                    if (backup_filter := config_dict.get("backup_filter")) is not None:
+                        CMC_Config.config.backup_filter = backup_filter
+                    if (backup_memory_limit := config_dict.get("backup_memory_limit")) is not None:
+                        CMC_Config.config.backup_memory_limit = backup_memory_limit
+                    if (read_ahead_limit := config_dict.get("read_ahead_limit")) is not None:
+                        CMC_Config.config.read_ahead_limit = read_ahead_limit
+                    if (write_behind_limit := config_dict.get("write_behind_limit")) is not None:
+                        CMC_Config.config.write_behind_limit = write_behind_limit
+                    if (pool_mode := config_dict.get("pool_mode")) is not None:
+                        CMC_Config.config.pool_mode = pool_mode
+                    if (chunk_size := config_dict.get("chunk_size")) is not None:
+                        CMC_Config.config.chunk_size = chunk_size
+                    if (auto_workers := config_dict.get("auto_workers")) is not None:
+                        CMC_Config.config.auto_workers = auto_workers
+                    if (worker_nums := config_dict.get("worker_nums")) is not None:
+                        CMC_Config.config.worker_nums = worker_nums
             except Exception:
                 logger.warning(_("Failed to load ui config."))
         if CMC_Config.shader_names_file.exists():
@@ -90,30 +110,56 @@ class CMC_Config:
             except Exception:
                 logger.warning(_("Failed to load shader families."))
 
-    @logger.catch
     @staticmethod
     def write_config():
-        if not CMC_Config.config_file.parent.exists():
-            CMC_Config.config_file.parent.mkdir(parents=True, exist_ok=True)
-        with CMC_Config.config_file.open("w", encoding="utf-8") as f:
-            json.dump(dataclasses.asdict(CMC_Config.config), f, indent=4)
+        from loguru import logger
+
+        with logger.catch():
+            if not CMC_Config.config_file.parent.exists():
+                CMC_Config.config_file.parent.mkdir(parents=True, exist_ok=True)
+            with CMC_Config.config_file.open("w", encoding="utf-8") as f:
+                json.dump(dataclasses.asdict(CMC_Config.config), f, indent=4)
+
+    @staticmethod
+    def write_worker_nums() -> None:
+        """Only update `worker_nums` in the config file, the other options may be set for one run only."""
+        from loguru import logger
+
+        with logger.catch():
+            config_dict = {}
+            if CMC_Config.config_file.exists():
+                with CMC_Config.config_file.open("r", encoding="utf-8") as f:
+                    config_dict = json.load(f)
+            else:
+                CMC_Config.config_file.parent.mkdir(parents=True, exist_ok=True)
+            config_dict["worker_nums"] = CMC_Config.config.worker_nums
+            with CMC_Config.config_file.open("w", encoding="utf-8") as f:
+                json.dump(config_dict, f, indent=4)
+
+    @staticmethod
+    def get_mate_format() -> MateFormat:
+        mate_format = CMC_Config._mate_format
+        if mate_format is None or mate_format.template != CMC_Config.config.mate_format:
+            mate_format = CMC_Config._mate_format = MateFormat(CMC_Config.config.mate_format)
+        return mate_format
 
     @staticmethod
     def get_new_mate_name(format_variable: FormatVariable) -> str:
-        variable_dict = dataclasses.asdict(format_variable)
-        variable_dict = CMC_Config.SafeDict(variable_dict)
-        return (
-            CMC_Config.variable_pattern.sub(lambda match: variable_dict[match.group(1)], CMC_Config.config.mate_format)
-            + ".mate"
-        )
+        return CMC_Config.get_mate_format().format(format_variable)
+
+    @staticmethod
+    def get_new_mate_names(format_variables: List[FormatVariable]) -> List[str]:
+        return CMC_Config.get_mate_format().format_batch(format_variables)
 
     @staticmethod
     def get_new_example_mate_name() -> str:
-        variable_dict = CMC_Config.SafeDict(dataclasses.asdict(CMC_Config.example_mate_format_variable))
-        return (
-            CMC_Config.variable_pattern.sub(lambda match: variable_dict[match.group(1)], CMC_Config.config.mate_format)
-            + ".mate"
-        )
+        return CMC_Config.get_mate_format().format(CMC_Config.example_mate_format_variable)
+
+    @staticmethod
+    def get_worker_num() -> int:
+        if CMC_Config.worker_num is not None:
+            return max(CMC_Config.worker_num, 1)
+        return max(int((os.cpu_count() or 1) * CMC_Config.config.cpu_percent), 1)
 
     @staticmethod
     def is_shader_info_valid():
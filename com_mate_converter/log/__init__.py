@@ -1,3 +1,5 @@
+import re
+import sys
 from typing import Callable, Optional
 
 import loguru
@@ -28,6 +30,17 @@ def format_record(record: "loguru.Record") -> str:
     return f"[#808080]{'{:%H:%M:%S}'.format(record.get('time'))}[/#808080] {levename} | {{message}}"
 
 
+# Rich style tags of the app log, e.g. [royal_blue1] or [/#0087ff]
+MARKUP_PATTERN = re.compile(r"\[/?(?:#[0-9a-fA-F]{6}|[a-z][a-z0-9_]*)\]")
+
+
+def format_plain_record(record: "loguru.Record") -> str:
+    record["extra"]["plain_message"] = MARKUP_PATTERN.sub("", record["message"])
+    if record.get("exception") is not None:
+        return "{time:HH:mm:ss} {level: <7} | {extra[plain_message]}\n{exception}"
+    return "{time:HH:mm:ss} {level: <7} | {extra[plain_message]}\n"
+
+
 def init_logger(log_callback: Callable[[str], None], debug=False, filter_str: Optional[str] = None) -> None:
     log_filter = LogFilter(filter_str or "INFO" if not debug else "DEBUG")
     loguru.logger.add(
@@ -37,3 +50,14 @@ def init_logger(log_callback: Callable[[str], None], debug=False, filter_str: Op
         backtrace=True,
         diagnose=debug,
     )
+
+
+def init_cli_logger(debug=False) -> None:
+    """Plain log lines on stderr, for the subcommands run without the app."""
+    loguru.logger.add(
+        sys.stderr,
+        format=format_plain_record,
+        level="DEBUG" if debug else "INFO",
+        backtrace=True,
+        diagnose=debug,
+    )
@@ -1,8 +1,8 @@
 from .base import COMStr
 from .config import Config
-from .format import FormatVariable
+from .format import FormatVariable, MateFormat
 from .mate import Mate
 from .menu import Menu
 from .pmat import Pmat
 
-__all__ = ["COMStr", "Config", "FormatVariable", "Mate", "Menu", "Pmat"]
+__all__ = ["COMStr", "Config", "FormatVariable", "Mate", "MateFormat", "Menu", "Pmat"]
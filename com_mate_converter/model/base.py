@@ -1,9 +1,57 @@
+from typing import Tuple, Union
+
 import construct as cs
 
 from com_mate_converter.utils.construct_classes import Struct
 
 COMStr = cs.PascalString(cs.VarInt, "utf-8")
 
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+def read_var_int(buf: Buffer, pos: int) -> Tuple[int, int]:
+    value = buf[pos]
+    pos += 1
+    if value & 0x80:
+        value &= 0x7F
+        shift = 7
+        while True:
+            b = buf[pos]
+            pos += 1
+            value |= (b & 0x7F) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+    return value, pos
+
+
+def read_com_str(buf: Buffer, pos: int) -> Tuple[str, int]:
+    length = buf[pos]
+    if length & 0x80:
+        length, pos = read_var_int(buf, pos)
+    else:
+        pos += 1
+    end = pos + length
+    if end > len(buf):
+        raise ValueError(f"COMStr out of range at {pos}: {length} bytes")
+    return str(buf[pos:end], "utf-8"), end
+
+
+def build_var_int(value: int) -> bytes:
+    if value < 0x80:
+        return bytes((value,))
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def build_com_str(text: str) -> bytes:
+    data = text.encode("utf-8")
+    return build_var_int(len(data)) + data
+
 
 class FloatVector2(Struct):
     x: float
@@ -1,4 +1,5 @@
 import dataclasses
+from typing import Dict
 
 
 @dataclasses.dataclass
@@ -8,3 +9,13 @@ class Config:
     pmat_check_mode: int
     cpu_percent: float
     backup: bool
+    backup_backend: str
+    backup_filter: str
+    backup_memory_limit: int
+    read_ahead_limit: int
+    write_behind_limit: int
+    pool_mode: int
+    chunk_size: int
+    auto_workers: bool
+    # Work dir -> stage -> workers chosen by the last auto run
+    worker_nums: Dict[str, Dict[str, int]]
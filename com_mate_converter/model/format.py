@@ -1,4 +1,8 @@
 import dataclasses
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+VARIABLE_PATTERN = re.compile(r"\{([^}]+)\}")
 
 
 @dataclasses.dataclass
@@ -6,3 +10,56 @@ class FormatVariable:
     mate_name: str
     shader_family: str
     shader_name: str
+
+
+VARIABLE_NAMES = tuple(f.name for f in dataclasses.fields(FormatVariable))
+
+
+class MateFormat:
+    """A mate name template compiled to one expression, `{variable}` is replaced by the variable.
+
+    Like `str.format_map` with a dict of the variables, where an unknown name is upper-cased by
+    its lower-case variable if there is one (`{MATE_NAME}`) and kept as it is otherwise.
+    """
+
+    template: str
+    format: Callable[[FormatVariable], str]
+    format_batch: Callable[[Iterable[FormatVariable]], List[str]]
+
+    def __init__(self, template: str) -> None:
+        self.template = template
+        parts: List[str] = []
+        last = 0
+        for match in VARIABLE_PATTERN.finditer(template):
+            if match.start() > last:
+                parts.append(repr(template[last : match.start()]))
+            key = match.group(1)
+            if key in VARIABLE_NAMES:
+                parts.append(f"v.{key}")
+            elif key.lower() in VARIABLE_NAMES:
+                parts.append(f"v.{key.lower()}.upper()")
+            else:
+                parts.append(repr(match.group()))
+            last = match.end()
+        parts.append(repr(template[last:] + ".mate"))
+        expr = " + ".join(parts)
+        source = (
+            f"def format(v):\n    return {expr}\n\n"
+            f"def format_batch(variables):\n    return [{expr} for v in variables]\n"
+        )
+        namespace: Dict[str, Any] = {}
+        exec(compile(source, "<mate format>", "exec"), namespace)
+        self.format = namespace["format"]
+        self.format_batch = namespace["format_batch"]
+
+    @staticmethod
+    def get_variables() -> List[str]:
+        return [f"{{{name}}}" for name in VARIABLE_NAMES] + [f"{{{name.upper()}}}" for name in VARIABLE_NAMES]
+
+    @staticmethod
+    def open_variable(value: str) -> Optional[int]:
+        """Start of the `{variable}` being typed at the end of `value`, None if there is none."""
+        index = value.rfind("{")
+        if index < 0 or "}" in value[index:]:
+            return None
+        return index
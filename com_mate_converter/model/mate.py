@@ -1,11 +1,13 @@
 import dataclasses
+import functools
+import struct
 from typing import Any, Dict, List, Tuple, Type
 
 import construct as cs
 
-from com_mate_converter.utils.construct_classes import Struct, subcon, subcon_switch
+from com_mate_converter.utils.construct_classes import Struct, compile_lazy, subcon, subcon_switch
 
-from .base import COMStr, FloatVector2, FloatVector4
+from .base import Buffer, COMStr, FloatVector2, FloatVector4, build_com_str, read_com_str
 
 
 class BaseProperty(Struct):
@@ -184,35 +186,51 @@ class Mate(Struct):
         "mate_name" / COMStr,
         "material" / Material.SUBCON,
     )
-    SUBCON_COMPILED = cs.Struct(
-        "magic" / cs.Const(b"\x0eCM3D2_MATERIAL"),
-        "version" / cs.Int32sl,
-        "mate_name" / COMStr,
-        "material"
-        / cs.Struct(
-            "name" / COMStr,
-            "shader" / COMStr,
-            "shader_filename" / COMStr,
-            "properties"
-            / cs.RepeatUntil(
-                cs.obj_.prop_type == '"end"',
-                cs.Struct(
-                    "prop_type" / COMStr,
-                    "prop"
-                    / cs.Switch(
-                        cs.this.prop_type,
-                        {
-                            "tex": TexProperty.SUBCON,
-                            "col": ColorProperty.SUBCON,
-                            "vec": VectorProperty.SUBCON,
-                            "f": FloatProperty.SUBCON,
-                            "end": EndProperty.SUBCON,
-                        },
+    SUBCON_COMPILED = compile_lazy(
+        cs.Struct(
+            "magic" / cs.Const(b"\x0eCM3D2_MATERIAL"),
+            "version" / cs.Int32sl,
+            "mate_name" / COMStr,
+            "material"
+            / cs.Struct(
+                "name" / COMStr,
+                "shader" / COMStr,
+                "shader_filename" / COMStr,
+                "properties"
+                / cs.RepeatUntil(
+                    cs.obj_.prop_type == '"end"',
+                    cs.Struct(
+                        "prop_type" / COMStr,
+                        "prop"
+                        / cs.Switch(
+                            cs.this.prop_type,
+                            {
+                                "tex": TexProperty.SUBCON,
+                                "col": ColorProperty.SUBCON,
+                                "vec": VectorProperty.SUBCON,
+                                "f": FloatProperty.SUBCON,
+                                "end": EndProperty.SUBCON,
+                            },
+                        ),
                     ),
                 ),
             ),
         ),
-    ).compile()
+        "mate",
+    )
+
+    @classmethod
+    def parse(cls, data: bytes) -> "Mate":
+        try:
+            return MateCodec.decode(data)
+        except Exception:
+            return super().parse(data)
+
+    def build(self) -> bytes:
+        try:
+            return MateCodec.encode(self)
+        except Exception:
+            return super().build()
 
     @staticmethod
     def create(mate_name: str, shader: str, shader_filename: str, material_name: str) -> "Mate":
@@ -354,3 +372,147 @@ class Mate(Struct):
                 ),
             )
         )
+
+
+class MateCodec:
+    """Hand-written codec of the CM3D2_MATERIAL layout, the fast path of `Mate.parse` and `Mate.build`.
+
+    Any error is raised to the caller, which falls back to the construct definition above.
+    """
+
+    MAGIC = b"\x0eCM3D2_MATERIAL"
+    INT32 = struct.Struct("<i")
+    FLOAT = struct.Struct("<f")
+    FLOAT4 = struct.Struct("<4f")
+
+    @staticmethod
+    def decode(data: Buffer) -> Mate:
+        buf = memoryview(data)
+        if buf[:15] != MateCodec.MAGIC:
+            raise ValueError("Invalid Mate magic")
+        (version,) = MateCodec.INT32.unpack_from(buf, 15)
+        mate_name, pos = read_com_str(buf, 19)
+        name, pos = read_com_str(buf, pos)
+        shader, pos = read_com_str(buf, pos)
+        shader_filename, pos = read_com_str(buf, pos)
+        properties: List[BaseProperty] = []
+        while True:
+            prop_type, pos = read_com_str(buf, pos)
+            if prop_type == "tex":
+                tex_name, pos = read_com_str(buf, pos)
+                tex_type, pos = read_com_str(buf, pos)
+                if tex_type == "tex2d" or tex_type == "cube":
+                    file, pos = read_com_str(buf, pos)
+                    path, pos = read_com_str(buf, pos)
+                    ox, oy, sx, sy = MateCodec.FLOAT4.unpack_from(buf, pos)
+                    pos += 16
+                    data_cls = TexProperty.Tex.Tex2dData if tex_type == "tex2d" else TexProperty.Tex.CubeData
+                    tex_data: TexProperty.Tex.BaseTexData = data_cls(
+                        name=file, path=path, offset=FloatVector2(ox, oy), scale=FloatVector2(sx, sy)
+                    )
+                elif tex_type == "texRT":
+                    file, pos = read_com_str(buf, pos)
+                    path, pos = read_com_str(buf, pos)
+                    tex_data = TexProperty.Tex.TexRTData(name=file, path=path)
+                elif tex_type == "null":
+                    tex_data = TexProperty.Tex.NullTexData()
+                else:
+                    raise ValueError(f"Unknown tex type: {tex_type}")
+                properties.append(
+                    TexProperty(
+                        prop_type=prop_type, prop=TexProperty.Tex(tex_name=tex_name, tex_type=tex_type, data=tex_data)
+                    )
+                )
+            elif prop_type == "col":
+                prop_name, pos = read_com_str(buf, pos)
+                value = FloatVector4(*MateCodec.FLOAT4.unpack_from(buf, pos))
+                pos += 16
+                properties.append(
+                    ColorProperty(prop_type=prop_type, prop=ColorProperty.Color(name=prop_name, value=value))
+                )
+            elif prop_type == "vec":
+                prop_name, pos = read_com_str(buf, pos)
+                value = FloatVector4(*MateCodec.FLOAT4.unpack_from(buf, pos))
+                pos += 16
+                properties.append(
+                    VectorProperty(prop_type=prop_type, prop=VectorProperty.Vector(name=prop_name, value=value))
+                )
+            elif prop_type == "f":
+                prop_name, pos = read_com_str(buf, pos)
+                (f_value,) = MateCodec.FLOAT.unpack_from(buf, pos)
+                pos += 4
+                properties.append(
+                    FloatProperty(prop_type=prop_type, prop=FloatProperty.Float(name=prop_name, value=f_value))
+                )
+            elif prop_type == "end":
+                properties.append(EndProperty())
+                break
+            else:
+                raise ValueError(f"Unknown prop type: {prop_type}")
+        return Mate(
+            magic=MateCodec.MAGIC,
+            version=version,
+            mate_name=mate_name,
+            material=Material(name=name, shader=shader, shader_filename=shader_filename, properties=properties),
+        )
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _com_str_field(text: str) -> Tuple[str, bytes]:
+        data = build_com_str(text)
+        return f"{len(data)}s", data
+
+    @staticmethod
+    def encode(mate: Mate) -> bytes:
+        if mate.magic != MateCodec.MAGIC:
+            raise ValueError("Invalid Mate magic")
+        material = mate.material
+        fmt: List[str] = ["<15si"]
+        args: List[Any] = [MateCodec.MAGIC, mate.version]
+
+        def add_str(text: str) -> None:
+            field_fmt, data = MateCodec._com_str_field(text)
+            fmt.append(field_fmt)
+            args.append(data)
+
+        add_str(mate.mate_name)
+        add_str(material.name)
+        add_str(material.shader)
+        add_str(material.shader_filename)
+        for p in material.properties:
+            prop_type = p.prop_type
+            add_str(prop_type)
+            if prop_type == "tex":
+                tex: TexProperty.Tex = p.prop  # type: ignore
+                add_str(tex.tex_name)
+                add_str(tex.tex_type)
+                tex_data: Any = tex.data
+                if tex.tex_type == "tex2d" or tex.tex_type == "cube":
+                    add_str(tex_data.name)
+                    add_str(tex_data.path)
+                    fmt.append("4f")
+                    args += (tex_data.offset.x, tex_data.offset.y, tex_data.scale.x, tex_data.scale.y)
+                elif tex.tex_type == "texRT":
+                    add_str(tex_data.name)
+                    add_str(tex_data.path)
+                elif tex.tex_type != "null":
+                    raise ValueError(f"Unknown tex type: {tex.tex_type}")
+            elif prop_type == "col" or prop_type == "vec":
+                add_str(p.prop.name)  # type: ignore
+                value: FloatVector4 = p.prop.value  # type: ignore
+                fmt.append("4f")
+                args += (value.x, value.y, value.z, value.w)
+            elif prop_type == "f":
+                add_str(p.prop.name)  # type: ignore
+                fmt.append("f")
+                args.append(p.prop.value)  # type: ignore
+            elif prop_type == "end":
+                break
+            else:
+                raise ValueError(f"Unknown prop type: {prop_type}")
+        else:
+            raise ValueError("Missing end property")
+        layout = struct.Struct("".join(fmt))
+        buf = bytearray(layout.size)
+        layout.pack_into(buf, 0, *args)
+        return bytes(buf)
@@ -1,11 +1,27 @@
 import dataclasses
-from typing import List
+import struct
+from typing import Dict, List, Optional, Tuple
 
 import construct as cs
 
-from com_mate_converter.utils.construct_classes import Struct, subcon
+from com_mate_converter.utils.construct_classes import Struct, compile_lazy, subcon
 
-from .base import COMStr
+from .base import Buffer, COMStr, build_com_str, read_var_int
+
+MENU_MAGIC = b"\x0ACM3D2_MENU"
+MATERIAL_CHANGE = "マテリアル変更"
+
+
+def _read_menu_str(buf: memoryview, pos: int) -> Tuple[str, int]:
+    # Only canonical lengths are accepted, so that untouched bytes are the same as `Menu.build` output
+    start = pos
+    length, pos = read_var_int(buf, pos)
+    if pos - start > 1 and buf[pos - 1] == 0:
+        raise ValueError(f"Non-canonical VarInt at {start}")
+    end = pos + length
+    if end > len(buf):
+        raise ValueError(f"COMStr out of range at {pos}: {length} bytes")
+    return str(buf[pos:end], "utf-8"), end
 
 
 class Command(Struct):
@@ -46,43 +62,101 @@ class Menu(Struct):
             Command.SUBCON,
         ),
     )
-    SUBCON_COMPILED = cs.Struct(
-        "magic" / cs.Const(b"\x0ACM3D2_MENU"),
-        "version" / cs.Int32sl,
-        "src_name" / COMStr,
-        "item_name" / COMStr,
-        "category" / COMStr,
-        "info_text" / COMStr,
-        "body_size" / cs.Int32sl,
-        "commands"
-        / cs.RepeatUntil(
-            cs.obj_.arg_num == 0,
-            Command.SUBCON,
+    SUBCON_COMPILED = compile_lazy(
+        cs.Struct(
+            "magic" / cs.Const(b"\x0ACM3D2_MENU"),
+            "version" / cs.Int32sl,
+            "src_name" / COMStr,
+            "item_name" / COMStr,
+            "category" / COMStr,
+            "info_text" / COMStr,
+            "body_size" / cs.Int32sl,
+            "commands"
+            / cs.RepeatUntil(
+                cs.obj_.arg_num == 0,
+                Command.SUBCON,
+            ),
         ),
-    ).compile()
-    SUBCON_HEADER_COMPILED = cs.Struct(
-        "magic" / cs.Const(b"\x0ACM3D2_MENU"),
-        "version" / cs.Int32sl,
-        "src_name" / COMStr,
-        "item_name" / COMStr,
-        "category" / COMStr,
-        "info_text" / COMStr,
-        "body_size" / cs.Int32sl,
-    ).compile()
-    SUBCON_COMMANDS_COMPILED = cs.Struct(
-        "commands"
-        / cs.RepeatUntil(
-            cs.obj_.arg_num == 0,
-            Command.SUBCON,
-        )
-    ).compile()
+        "menu",
+    )
+    SUBCON_HEADER_COMPILED = compile_lazy(
+        cs.Struct(
+            "magic" / cs.Const(b"\x0ACM3D2_MENU"),
+            "version" / cs.Int32sl,
+            "src_name" / COMStr,
+            "item_name" / COMStr,
+            "category" / COMStr,
+            "info_text" / COMStr,
+            "body_size" / cs.Int32sl,
+        ),
+        "menu_header",
+    )
+    SUBCON_COMMANDS_COMPILED = compile_lazy(
+        cs.Struct(
+            "commands"
+            / cs.RepeatUntil(
+                cs.obj_.arg_num == 0,
+                Command.SUBCON,
+            )
+        ),
+        "menu_commands",
+    )
 
     def build(self) -> bytes:
-        data_dict = dataclasses.asdict(self)
+        data_dict = self.to_dict()
         body_data = self.SUBCON_COMMANDS_COMPILED.build(data_dict)  # type: ignore
         data_dict["body_size"] = self.body_size = len(body_data)
         return self.SUBCON_HEADER_COMPILED.build(data_dict) + body_data
 
+    @staticmethod
+    def replace_mate_names(data: Buffer, mate_name_dict: Dict[str, str]) -> Optional[bytes]:
+        """Replace the NPR mate arguments of "マテリアル変更" commands without a full parse.
+
+        The output is the same as `Menu.parse` -> replace -> `Menu.build`: only the replaced COMStr are
+        re-encoded, `body_size` is recomputed and the untruncated data after the end command is dropped.
+        Returns None if nothing is replaced, raises ValueError if the menu is not well-formed.
+        """
+        buf = memoryview(data)
+        if buf[:11] != MENU_MAGIC:
+            raise ValueError("Invalid Menu magic")
+        try:
+            pos = 15
+            for _ in range(4):
+                _, pos = _read_menu_str(buf, pos)
+            header_end = pos
+            body_start = pos = header_end + 4
+            pieces: List[Tuple[int, int, bytes]] = []
+            while True:
+                arg_num = buf[pos]
+                pos += 1
+                if arg_num == 0:
+                    break
+                command, pos = _read_menu_str(buf, pos)
+                if arg_num > 1 and command == MATERIAL_CHANGE:
+                    for _ in range(1, arg_num):
+                        arg_start = pos
+                        arg, pos = _read_menu_str(buf, pos)
+                        arg_lower = arg.lower()
+                        if "_nprmat_" in arg_lower and arg_lower.endswith(".mate"):
+                            if (new_mate_name := mate_name_dict.get(arg_lower)) is not None:
+                                pieces.append((arg_start, pos, build_com_str(new_mate_name)))
+                else:
+                    for _ in range(1, arg_num):
+                        _, pos = _read_menu_str(buf, pos)
+        except IndexError as e:
+            raise ValueError("Menu is truncated") from e
+        if not pieces:
+            return None
+        body: List[Buffer] = []
+        last = body_start
+        for arg_start, arg_end, new_arg in pieces:
+            body.append(buf[last:arg_start])
+            body.append(new_arg)
+            last = arg_end
+        body.append(buf[last:pos])
+        body_data = b"".join(body)
+        return b"".join((buf[:header_end], struct.pack("<i", len(body_data)), body_data))
+
     @staticmethod
     def create(item_name: str, category: str, infoText: str, src_name: str = "") -> "Menu":
         return Menu(
@@ -1,10 +1,21 @@
-from typing import Optional
+import dataclasses
+import struct
+from typing import BinaryIO, Optional
 
 import construct as cs
 
 from com_mate_converter.utils.construct_classes import Struct
 
-from .base import COMStr
+from .base import COMStr, read_var_int
+
+PMAT_MAGIC = b"\x0FCM3D2_PMATERIAL"
+
+
+@dataclasses.dataclass
+class PmatHeader:
+    version: int
+    hash: int
+    material_name: str
 
 
 class Pmat(Struct):
@@ -28,6 +39,24 @@ class Pmat(Struct):
         self.hash = Pmat.str_hash(self.material_name)
         return super().build()
 
+    @staticmethod
+    def read_header(f: BinaryIO, peek_size: int = 256) -> PmatHeader:
+        """Read magic, version, hash and material_name from the beginning of the file only."""
+        data = f.read(peek_size)
+        if data[:16] != PMAT_MAGIC:
+            raise ValueError("Invalid Pmat magic")
+        try:
+            version, hash = struct.unpack_from("<ii", data, 16)
+            length, pos = read_var_int(data, 24)
+        except (IndexError, struct.error) as e:
+            raise ValueError("Pmat is truncated") from e
+        end = pos + length
+        if end > len(data):
+            data += f.read(end - len(data))
+            if end > len(data):
+                raise ValueError("Pmat is truncated")
+        return PmatHeader(version=version, hash=hash, material_name=data[pos:end].decode("utf-8"))
+
     @staticmethod
     def str_hash(s: str) -> int:
         h = 0
@@ -1,7 +1,17 @@
+import copy
 import dataclasses
+import hashlib
+import marshal
+import os
+import re
+import sys
+import threading
+import types
 import typing
+from pathlib import Path
 
 import construct as cs
+from construct.core import extractfield
 from typing_extensions import Self
 
 # https://github.com/matejcik/construct-classes
@@ -43,6 +53,234 @@ def subcon_switch(
     return dataclasses.field(metadata=metadata, **kwargs)
 
 
+# Generated code of the compiled constructs, reused by later launches and by worker processes.
+# The cache dir of the user if not set, never a shared dir: the cached code is executed.
+compile_cache_dir: typing.Optional[Path] = None
+ADDRESS_PATTERN = re.compile(r" at 0x[0-9a-fA-F]+")
+LINK_PATTERN = re.compile(r"(linked(?:instances|parsers|builders))\[(\d+)\]")
+
+
+def _dump(obj: typing.Any, nodes: typing.List[cs.Construct], index: typing.Dict[int, int]) -> str:
+    """Everything the generated code of a construct depends on, subcons are numbered in walk order."""
+    if isinstance(obj, cs.Construct):
+        if (i := index.get(id(obj))) is not None:
+            return f"@{i}"
+        index[id(obj)] = len(nodes)
+        nodes.append(obj)
+        attrs = ",".join(f"{k}={_dump(v, nodes, index)}" for k, v in sorted(vars(obj).items()))
+        return f"{type(obj).__module__}.{type(obj).__qualname__}({attrs})"
+    if isinstance(obj, (list, tuple)):
+        return "[" + ",".join(_dump(v, nodes, index) for v in obj) + "]"
+    if isinstance(obj, dict):
+        return "{" + ",".join(f"{k!r}:{_dump(v, nodes, index)}" for k, v in sorted(obj.items(), key=repr)) + "}"
+    if isinstance(obj, types.FunctionType):
+        return f"{obj.__module__}.{obj.__qualname__}:{hashlib.sha1(marshal.dumps(obj.__code__)).hexdigest()}"
+    return ADDRESS_PATTERN.sub("", repr(obj))
+
+
+def _user_cache_dir() -> Path:
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local"
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "com-mate-converter"
+
+
+def _is_private(*paths: Path) -> bool:
+    """Owned by the current user and not writable by others."""
+    if not hasattr(os, "getuid"):
+        # Windows, the user cache dir is only accessible by the user
+        return True
+    uid = os.getuid()
+    for path in paths:
+        st = path.stat()
+        if st.st_uid != uid or st.st_mode & 0o022:
+            return False
+    return True
+
+
+class LazyCompiled(cs.Construct):
+    """`subcon.compile()` on first use, with the generated code cached in `compile_cache_dir`.
+
+    The generated code refers to some subcons by `id()`, in the cache they are referred to by walk order instead.
+    """
+
+    def __init__(self, subcon: cs.Construct, name: str) -> None:
+        super().__init__()
+        self.subcon = subcon
+        self.cache_name = name
+        self._compiled: typing.Optional[cs.Construct] = None
+        self._lock = threading.Lock()
+
+    @property
+    def compiled(self) -> cs.Construct:
+        if (compiled := self._compiled) is None:
+            with self._lock:
+                if (compiled := self._compiled) is None:
+                    compiled = self._compiled = self._compile()
+        return compiled
+
+    def _compile(self) -> cs.Construct:
+        nodes: typing.List[cs.Construct] = []
+        dump = _dump(self.subcon, nodes, {})
+        key = hashlib.sha1(f"{cs.version}|{sys.version}|{dump}".encode()).hexdigest()
+        cache_dir = compile_cache_dir if compile_cache_dir is not None else _user_cache_dir()
+        cache_path = cache_dir / f"{self.cache_name}-{key[:20]}.bin"
+        try:
+            if not _is_private(cache_dir, cache_path):
+                raise PermissionError(f"Cache file not private: {cache_path}")
+            code, links = marshal.loads(cache_path.read_bytes())
+            module = types.ModuleType(f"compiled_{self.cache_name}")
+            exec(code, module.__dict__)
+            module.linkedinstances = {i: extractfield(nodes[i]) for i in links}
+            module.linkedparsers = {i: f._parse for i, f in module.linkedinstances.items()}
+            module.linkedbuilders = {i: f._build for i, f in module.linkedinstances.items()}
+            compiled = module.compiled
+            compiled.module = module
+            compiled.defersubcon = self.subcon
+            return compiled
+        except Exception:
+            pass
+        compiled = self.subcon.compile()
+        node_index = {id(n): i for i, n in enumerate(nodes)}
+        try:
+            links = {k: node_index[k] for k in compiled.module.linkedinstances}
+            source = LINK_PATTERN.sub(lambda m: f"{m.group(1)}[{links[int(m.group(2))]}]", compiled.source)
+            cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+            if not _is_private(cache_dir):
+                raise PermissionError(f"Cache dir not private: {cache_dir}")
+            tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(marshal.dumps((compile(source, f"<{self.cache_name}>", "exec"), list(links.values()))))
+            os.replace(tmp_path, cache_path)
+        except Exception:
+            # Not cached, compiled again next time
+            pass
+        return compiled
+
+    def parse(self, data: bytes, **contextkw: typing.Any) -> typing.Any:
+        return self.compiled.parse(data, **contextkw)
+
+    def build(self, obj: typing.Any, **contextkw: typing.Any) -> bytes:
+        return self.compiled.build(obj, **contextkw)
+
+    def _parse(self, stream: typing.Any, context: typing.Any, path: typing.Any) -> typing.Any:
+        return self.compiled._parse(stream, context, path)
+
+    def _build(self, obj: typing.Any, stream: typing.Any, context: typing.Any, path: typing.Any) -> typing.Any:
+        return self.compiled._build(obj, stream, context, path)
+
+    def _sizeof(self, context: typing.Any, path: typing.Any) -> int:
+        return self.subcon._sizeof(context, path)
+
+
+def compile_lazy(subcon: cs.Construct, name: str) -> LazyCompiled:
+    return LazyCompiled(subcon, name)
+
+
+# Field values which are the same in the dict form, everything else goes through `_asdict_value`
+_ATOMIC_TYPES = frozenset((type(None), bool, int, float, str, bytes))
+_MISSING = object()
+
+
+def _asdict_value(value: typing.Any) -> typing.Any:
+    """`dataclasses.asdict` of a field value, except that `Struct` values use their generated `to_dict`."""
+    value_type = type(value)
+    if value_type in _ATOMIC_TYPES:
+        return value
+    if isinstance(value, Struct):
+        return value.to_dict()
+    if isinstance(value, (list, tuple)):
+        if hasattr(value, "_fields"):
+            return value_type(*[_asdict_value(v) for v in value])
+        return value_type(_asdict_value(v) for v in value)
+    if isinstance(value, dict):
+        return value_type((_asdict_value(k), _asdict_value(v)) for k, v in value.items())
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    return copy.deepcopy(value)
+
+
+def _call_without_missing(cls: type, args: typing.Tuple[typing.Tuple[str, typing.Any], ...]) -> typing.Any:
+    return cls(**{k: v for k, v in args if v is not _MISSING})
+
+
+def _compile_converters(cls: type) -> None:
+    """Generate `_from_container` and `to_dict` of a Struct class from its fields, once at class creation.
+
+    The generated code is the same as walking `dataclasses.fields` for each object, without the reflection.
+    """
+    namespace: typing.Dict[str, typing.Any] = {
+        "cls": cls,
+        "Container": cs.Container,
+        "ListContainer": cs.ListContainer,
+        "decontainerize": Struct._decontainerize,
+        "asdict_value": _asdict_value,
+        "call_without_missing": _call_without_missing,
+        "MISSING": _MISSING,
+        "ATOMIC_TYPES": _ATOMIC_TYPES,
+        "Struct": Struct,
+    }
+    parse_lines = ["def from_container(data):", "    get = data.get"]
+    build_lines = ["def to_dict(self):"]
+    names: typing.List[str] = []
+    optional_names: typing.List[str] = []
+
+    def add_plain(var: str, indent: str) -> None:
+        parse_lines.append(f"{indent}if isinstance({var}, ListContainer):")
+        parse_lines.append(f"{indent}    {var} = decontainerize({var})")
+
+    def add_substruct(var: str, field_name: str, subcls: str, indent: str) -> None:
+        parse_lines.append(f"{indent}if isinstance({var}, ListContainer):")
+        parse_lines.append(f"{indent}    {var} = [{subcls}.from_parsed(d) for d in {var}]")
+        parse_lines.append(f"{indent}elif isinstance({var}, Container):")
+        parse_lines.append(f"{indent}    {var} = {subcls}.from_parsed({var})")
+        parse_lines.append(f"{indent}elif {var} is None:")
+        parse_lines.append(f"{indent}    {var} = MISSING")
+        parse_lines.append(f"{indent}else:")
+        parse_lines.append(
+            f"{indent}    raise ValueError("
+            f"f'Mismatched type for field {field_name}: expected a struct, found {{type({var})}}')"
+        )
+
+    for i, field in enumerate(dataclasses.fields(cls)):
+        var = f"v{i}"
+        names.append(field.name)
+        parse_lines.append(f"    {var} = get({field.name!r})")
+        subcls = field.metadata.get("substruct")
+        if subcls is None:
+            add_plain(var, "    ")
+            build_lines.append(f"    {var} = self.{field.name}")
+            build_lines.append(f"    if type({var}) not in ATOMIC_TYPES:")
+            build_lines.append(f"        {var} = asdict_value({var})")
+            continue
+        optional_names.append(var)
+        if isinstance(subcls, dict):
+            namespace[f"switch{i}"] = subcls
+            parse_lines.append(f"    sub{i} = switch{i}.get(get({field.metadata.get('substruct_dist_field')!r}))")
+            parse_lines.append(f"    if sub{i} is None:")
+            add_plain(var, "        ")
+            parse_lines.append("    else:")
+            add_substruct(var, field.name, f"sub{i}", "        ")
+        else:
+            namespace[f"sub{i}"] = subcls
+            add_substruct(var, field.name, f"sub{i}", "    ")
+        build_lines.append(f"    {var} = self.{field.name}")
+        build_lines.append(f"    {var} = {var}.to_dict() if isinstance({var}, Struct) else asdict_value({var})")
+
+    call_args = ", ".join(f"{name}=v{i}" for i, name in enumerate(names))
+    if optional_names:
+        parse_lines.append(f"    if {' or '.join(f'{var} is MISSING' for var in optional_names)}:")
+        missing_args = "".join(f"({name!r}, v{i}), " for i, name in enumerate(names))
+        parse_lines.append(f"        return call_without_missing(cls, ({missing_args}))")
+    parse_lines.append(f"    return cls({call_args})")
+    build_lines.append("    return {" + ", ".join(f"{name!r}: v{i}" for i, name in enumerate(names)) + "}")
+    source = "\n".join(parse_lines + build_lines) + "\n"
+    exec(compile(source, f"<{cls.__qualname__} converters>", "exec"), namespace)
+    cls._from_container = staticmethod(namespace["from_container"])  # type: ignore
+    if "to_dict" not in vars(cls):
+        cls.to_dict = namespace["to_dict"]  # type: ignore
+
+
 @dataclass_transform(
     field_specifiers=(
         subcon,
@@ -51,8 +289,10 @@ def subcon_switch(
 )
 class _StructMeta(type):
     def __new__(cls, name: str, bases: typing.Tuple[type, ...], namespace: typing.Dict[str, typing.Any]) -> type:
-        new_cls = super().__new__(cls, name, bases, namespace)
-        return dataclasses.dataclass()(new_cls)
+        new_cls = dataclasses.dataclass()(super().__new__(cls, name, bases, namespace))
+        if bases:
+            _compile_converters(new_cls)
+        return new_cls
 
 
 class Struct(metaclass=_StructMeta):
@@ -61,10 +301,17 @@ class Struct(metaclass=_StructMeta):
         typing.Optional["cs.Construct[cs.Container[typing.Any], typing.Dict[str, typing.Any]]"]
     ] = None
 
+    # Generated for each subclass by `_compile_converters`
+    _from_container: typing.ClassVar[typing.Callable[[cs.Container], typing.Any]]
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        """Same as `dataclasses.asdict(self)` as input of `SUBCON`, generated for each subclass."""
+        return {}
+
     def build(self) -> bytes:
         if self.SUBCON_COMPILED is not None:
-            return self.SUBCON_COMPILED.build(dataclasses.asdict(self))
-        return self.SUBCON.build(dataclasses.asdict(self))
+            return self.SUBCON_COMPILED.build(self.to_dict())
+        return self.SUBCON.build(self.to_dict())
 
     @staticmethod
     def _decontainerize(item: typing.Any) -> typing.Any:
@@ -74,28 +321,7 @@ class Struct(metaclass=_StructMeta):
 
     @classmethod
     def from_parsed(cls: typing.Type[Self], data: cs.Container) -> Self:
-        args = {}
-        for field in dataclasses.fields(cls):
-            field_data = data.get(field.name)
-            subcls = field.metadata.get("substruct")
-            if isinstance(subcls, dict):
-                subcls = subcls.get(data.get(field.metadata.get("substruct_dist_field")))  # type: ignore
-            if subcls is None:
-                args[field.name] = field_data
-                continue
-
-            if isinstance(field_data, cs.ListContainer):
-                args[field.name] = [subcls.from_parsed(d) for d in field_data]
-            elif isinstance(field_data, cs.Container):
-                args[field.name] = subcls.from_parsed(field_data)
-            elif field_data is None:
-                continue
-            else:
-                raise ValueError(f"Mismatched type for field {field.name}: expected a struct, found {type(field_data)}")
-
-        for key in args:
-            args[key] = cls._decontainerize(args[key])
-        return cls(**args)
+        return cls._from_container(data)
 
     @classmethod
     def parse(cls: typing.Type[Self], data: bytes) -> Self:
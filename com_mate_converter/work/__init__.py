@@ -1,3 +1,3 @@
-from .work_manager import WorkCommand, WorkManager, WorkProgress, WorkType
+from .work_manager import WorkManager, WorkType
 
-__all__ = ["WorkCommand", "WorkManager", "WorkProgress", "WorkType"]
+__all__ = ["WorkManager", "WorkType"]
@@ -0,0 +1,312 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import zipfile
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Type
+
+from loguru import logger
+
+from com_mate_converter import _
+from com_mate_converter.model import Config
+
+# Filter ids of py7zr, None is its default (BCJ + LZMA2)
+SEVEN_ZIP_FILTERS: Dict[str, Optional[str]] = {
+    "lzma2": None,
+    "lzma": "FILTER_LZMA",
+    "bzip2": "FILTER_BZIP2",
+    "deflate": "FILTER_DEFLATE",
+    "copy": "FILTER_COPY",
+}
+ZIP_COMPRESSIONS: Dict[str, int] = {
+    "lzma2": zipfile.ZIP_LZMA,
+    "lzma": zipfile.ZIP_LZMA,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "copy": zipfile.ZIP_STORED,
+}
+# FICLONE from linux/fs.h
+FICLONE = 0x40049409
+
+
+class BackupWriter:
+    """One backup of a work dir, entries are named relative to the parent of the work dir.
+
+    Opening an existing backup appends to it.
+    """
+
+    suffix: str = ""
+    path: Path
+
+    def __init__(self, path: Path, config: Config) -> None:
+        self.path = path
+
+    def write_file(self, file_path: Path, arcname: str) -> None:
+        raise NotImplementedError
+
+    def write_data(self, data: bytes, arcname: str) -> None:
+        raise NotImplementedError
+
+    def link_file(self, file_path: Path, arcname: str) -> bool:
+        """Back up a file without copying it, False if the backend or the filesystem cannot."""
+        return False
+
+    @staticmethod
+    def names(path: Path) -> List[str]:
+        """Names of the file entries of the backup at `path`."""
+        raise NotImplementedError
+
+    @staticmethod
+    def extract(path: Path, target: Path, select: Callable[[str], bool]) -> int:
+        """Write the selected entries of the backup at `path` under `target`, return their number."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "BackupWriter":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+
+class SevenZipBackup(BackupWriter):
+    suffix = ".7z"
+
+    def __init__(self, path: Path, config: Config) -> None:
+        import py7zr
+
+        super().__init__(path, config)
+        if path.exists():
+            # The filters of an existing archive are kept
+            self.archive = py7zr.SevenZipFile(path, "a")
+        elif (filter_id := SEVEN_ZIP_FILTERS[config.backup_filter]) is None:
+            self.archive = py7zr.SevenZipFile(path, "w")
+        else:
+            self.archive = py7zr.SevenZipFile(path, "w", filters=[{"id": getattr(py7zr, filter_id)}])
+
+    def write_file(self, file_path: Path, arcname: str) -> None:
+        self.archive.write(file_path, arcname)
+
+    def write_data(self, data: bytes, arcname: str) -> None:
+        self.archive.writestr(data, arcname)
+
+    def close(self) -> None:
+        self.archive.close()
+
+    @staticmethod
+    def names(path: Path) -> List[str]:
+        import py7zr
+
+        with py7zr.SevenZipFile(path, "r") as archive:
+            return [f.filename for f in archive.list() if not f.is_directory]
+
+    @staticmethod
+    def extract(path: Path, target: Path, select: Callable[[str], bool]) -> int:
+        import py7zr
+
+        with py7zr.SevenZipFile(path, "r") as archive:
+            names = [f.filename for f in archive.list() if not f.is_directory and select(f.filename)]
+            if names:
+                archive.extract(target, names)
+        return len(names)
+
+
+class ZipBackup(BackupWriter):
+    suffix = ".zip"
+
+    def __init__(self, path: Path, config: Config) -> None:
+        super().__init__(path, config)
+        self.archive = zipfile.ZipFile(
+            path, "a" if path.exists() else "w", compression=ZIP_COMPRESSIONS[config.backup_filter]
+        )
+
+    def write_file(self, file_path: Path, arcname: str) -> None:
+        self.archive.write(file_path, arcname)
+
+    def write_data(self, data: bytes, arcname: str) -> None:
+        self.archive.writestr(arcname, data)
+
+    def close(self) -> None:
+        self.archive.close()
+
+    @staticmethod
+    def names(path: Path) -> List[str]:
+        with zipfile.ZipFile(path) as archive:
+            return [n for n in archive.namelist() if not n.endswith("/")]
+
+    @staticmethod
+    def extract(path: Path, target: Path, select: Callable[[str], bool]) -> int:
+        with zipfile.ZipFile(path) as archive:
+            names = [n for n in archive.namelist() if not n.endswith("/") and select(n)]
+            archive.extractall(target, names)
+        return len(names)
+
+
+class CopyTreeBackup(BackupWriter):
+    """A folder with the same content as the archive would have."""
+
+    def _target(self, arcname: str) -> Path:
+        target = self.path / arcname
+        target.parent.mkdir(parents=True, exist_ok=True)
+        return target
+
+    def write_file(self, file_path: Path, arcname: str) -> None:
+        shutil.copy2(file_path, self._target(arcname))
+
+    def write_data(self, data: bytes, arcname: str) -> None:
+        with self._target(arcname).open("wb") as f:
+            f.write(data)
+
+    @staticmethod
+    def names(path: Path) -> List[str]:
+        return [p.relative_to(path).as_posix() for p in path.rglob("*") if p.is_file()]
+
+    @staticmethod
+    def extract(path: Path, target: Path, select: Callable[[str], bool]) -> int:
+        num = 0
+        for file_path in path.rglob("*"):
+            if file_path.is_file() and select(arcname := file_path.relative_to(path).as_posix()):
+                (target / arcname).parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(file_path, target / arcname)
+                num += 1
+        return num
+
+
+class SnapshotBackup(CopyTreeBackup):
+    """Like `CopyTreeBackup`, but files on disk are reflinked or hardlinked instead of copied where possible.
+
+    A hardlink stays a valid backup because converted files are written to a new file and replaced, never in place.
+    """
+
+    def write_file(self, file_path: Path, arcname: str) -> None:
+        if not self.link_file(file_path, arcname):
+            shutil.copy2(file_path, self._target(arcname))
+
+    def link_file(self, file_path: Path, arcname: str) -> bool:
+        target = self._target(arcname)
+        if reflink(file_path, target):
+            return True
+        try:
+            os.link(file_path, target)
+            return True
+        except OSError:
+            return False
+
+
+class DedupBackup(BackupWriter):
+    """Each unique content is stored once in `blobs` of the backup folder, shared by all work dirs.
+
+    The backup itself is a manifest mapping the names of the entries to the sha256 of their content.
+    """
+
+    suffix = ".json"
+    VERSION = 1
+    blob_path: Path
+    files: Dict[str, str]
+
+    def __init__(self, path: Path, config: Config) -> None:
+        super().__init__(path, config)
+        self.blob_path = path.parent / "blobs"
+        self.files = DedupBackup.read_manifest(path) if path.exists() else {}
+
+    @staticmethod
+    def read_manifest(path: Path) -> Dict[str, str]:
+        with path.open("r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != DedupBackup.VERSION:
+            raise ValueError(f"Unknown backup manifest version: {manifest.get('version')}")
+        return manifest["files"]
+
+    @staticmethod
+    def get_blob(blob_path: Path, digest: str) -> Path:
+        return blob_path / digest[:2] / digest
+
+    def write_file(self, file_path: Path, arcname: str) -> None:
+        with file_path.open("rb") as f:
+            self.write_data(f.read(), arcname)
+
+    def write_data(self, data: bytes, arcname: str) -> None:
+        digest = hashlib.sha256(data).hexdigest()
+        self.files[arcname] = digest
+        blob = DedupBackup.get_blob(self.blob_path, digest)
+        if blob.exists():
+            return
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        # The backups of other work dirs may write the same blob at the same time
+        tmp_path = blob.with_name(f"{digest}.{threading.get_ident()}.tmp")
+        with tmp_path.open("wb") as f:
+            f.write(data)
+        os.replace(tmp_path, blob)
+
+    def close(self) -> None:
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump({"version": DedupBackup.VERSION, "files": self.files}, f, ensure_ascii=False, indent=0)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def names(path: Path) -> List[str]:
+        return list(DedupBackup.read_manifest(path))
+
+    @staticmethod
+    def extract(path: Path, target: Path, select: Callable[[str], bool]) -> int:
+        blob_path = path.parent / "blobs"
+        num = 0
+        for arcname, digest in DedupBackup.read_manifest(path).items():
+            if select(arcname):
+                file_path = target / arcname
+                file_path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(DedupBackup.get_blob(blob_path, digest), file_path)
+                num += 1
+        return num
+
+
+def reflink(src: Path, dst: Path) -> bool:
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+
+    try:
+        with src.open("rb") as fs, dst.open("wb") as fd:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        return True
+    except OSError:
+        dst.unlink(missing_ok=True)
+        return False
+
+
+BACKUP_BACKENDS: Dict[str, Type[BackupWriter]] = {
+    "7z": SevenZipBackup,
+    "zip": ZipBackup,
+    "copy": CopyTreeBackup,
+    "snapshot": SnapshotBackup,
+    "dedup": DedupBackup,
+}
+
+
+def get_backup_backend(config: Config) -> Type[BackupWriter]:
+    if (backend := BACKUP_BACKENDS.get(config.backup_backend)) is None or config.backup_filter not in SEVEN_ZIP_FILTERS:
+        logger.warning(
+            _("Unknown backup backend: {backend} ({filter}), use 7z").format(
+                backend=config.backup_backend, filter=config.backup_filter
+            )
+        )
+        config.backup_backend = "7z"
+        config.backup_filter = "lzma2"
+        return SevenZipBackup
+    return backend
+
+
+def get_backup_reader(path: Path) -> Optional[Type[BackupWriter]]:
+    """The backend of an existing backup, None if `path` is not a backup."""
+    if path.is_dir():
+        return CopyTreeBackup
+    for backend in (SevenZipBackup, ZipBackup, DedupBackup):
+        if path.suffix.lower() == backend.suffix:
+            return backend
+    return None
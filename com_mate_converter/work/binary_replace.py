@@ -1,8 +1,8 @@
-from typing import Dict, List, Optional
+import re
+from array import array
+from typing import Dict, List, Tuple
 
-import regex
-
-from com_mate_converter.model.base import COMStr
+from com_mate_converter.model.base import COMStr, build_com_str
 
 
 def encode_com_str(text: str) -> bytes:
@@ -14,29 +14,188 @@ def decode_com_str(data: bytes) -> str:
 
 
 class BinaryReplace:
-    repls: Dict[str, bytes] = {}
-    replace_pattern: Optional[regex.Pattern] = None
+    """Replace COMStr-encoded mate names in raw data with an ASCII case-insensitive Aho-Corasick automaton.
+
+    Matches are leftmost-longest and non-overlapping, like the `regex` alternation used before.
+    The trie is numbered depth-first, so the first child of a state is the next state and only states with
+    several children need a dict. Failure links and outputs are resolved lazily while scanning.
+    The automaton is built once per run and can be shared by threads or pickled to worker processes.
+    """
 
-    @staticmethod
-    def compile_pattern(mate_name_dict: Dict[str, str], sort_len: bool = False) -> None:
-        BinaryReplace.repls.clear()
-        keys: List[bytes] = []
+    def __init__(self, mate_name_dict: Dict[str, str]) -> None:
+        self.prefixes: List[bytes] = []
+        self.repls: List[bytes] = []
+        self.lengths: List[int] = []
+        keys: List[Tuple[bytes, int]] = []
         for k, v in mate_name_dict.items():
-            BinaryReplace.repls[k] = encode_com_str(v)
-            keys.append(encode_com_str(k))
-        if sort_len:
-            keys.sort(key=lambda s: (len(s), s), reverse=True)
-        BinaryReplace.replace_pattern = regex.compile(b"|".join(map(regex.escape, keys)), regex.IGNORECASE)
-
-    @staticmethod
-    def replace(data: bytes) -> bytes:
-        if BinaryReplace.replace_pattern is not None:
-            return BinaryReplace.replace_pattern.sub(BinaryReplace.repl, data)
-        return data
-
-    @staticmethod
-    def repl(match: regex.Match) -> bytes:
-        data: bytes = match.group()
-        if (text := BinaryReplace.repls.get(decode_com_str(data).lower())) is not None:
-            return text
-        return data
+            key = build_com_str(k)
+            self.prefixes.append(key[: len(key) - len(k.encode("utf-8"))])
+            self.repls.append(build_com_str(v))
+            self.lengths.append(len(key))
+            keys.append((key.lower(), len(keys)))
+        keys.sort()
+        label = bytearray(1)
+        parent = array("i", [0])
+        depth = array("i", [0])
+        terminal = array("i", [-1])
+        has_child = bytearray(1)
+        branch: Dict[int, Dict[int, int]] = {}
+        path = [0]
+        prev = b""
+        for key, index in keys:
+            lcp = 0
+            m = min(len(prev), len(key))
+            while lcp < m and prev[lcp] == key[lcp]:
+                lcp += 1
+            if lcp == len(key):
+                continue
+            del path[lcp + 1 :]
+            node = path[lcp]
+            for c in key[lcp:]:
+                new = len(label)
+                if has_child[node]:
+                    if (children := branch.get(node)) is None:
+                        children = branch[node] = {label[node + 1]: node + 1}
+                    children[c] = new
+                else:
+                    # Keys are sorted, so a state without children is always the last one created
+                    has_child[node] = 1
+                label.append(c)
+                parent.append(node)
+                depth.append(depth[node] + 1)
+                terminal.append(-1)
+                has_child.append(0)
+                path.append(new)
+                node = new
+            terminal[node] = index
+            prev = key
+        self.label = label
+        self.parent = parent
+        self.depth = depth
+        self.has_child = has_child
+        self.branch = branch
+        self.fail = array("i", [-1]) * len(label)
+        self.fail[0] = 0
+        self.match = array("i", (-2 if t < 0 else t for t in terminal))
+        self.match[0] = -1
+        # From the root, jump straight to the next byte that can start a match
+        first_bytes = b"".join(re.escape(bytes([c])) for c in sorted(self._children(0)))
+        self.root_pattern = re.compile(b"[" + first_bytes + b"]") if first_bytes else None
+
+    def __len__(self) -> int:
+        return len(self.repls)
+
+    def _children(self, state: int) -> List[int]:
+        if (children := self.branch.get(state)) is not None:
+            return list(children)
+        if self.has_child[state]:
+            return [self.label[state + 1]]
+        return []
+
+    def _goto(self, state: int, c: int) -> int:
+        if (children := self.branch.get(state)) is not None:
+            return children.get(c, -1)
+        if self.has_child[state] and self.label[state + 1] == c:
+            return state + 1
+        return -1
+
+    def _fail(self, state: int) -> int:
+        fail = self.fail
+        if (f := fail[state]) >= 0:
+            return f
+        chain: List[int] = []
+        while fail[state] < 0:
+            chain.append(state)
+            state = self.parent[state]
+        for s in reversed(chain):
+            p = self.parent[s]
+            if p == 0:
+                fail[s] = 0
+                continue
+            c = self.label[s]
+            t = fail[p]
+            while (f := self._goto(t, c)) < 0 and t != 0:
+                t = self._fail(t)
+            fail[s] = max(f, 0)
+        return fail[chain[0]]
+
+    def _match(self, state: int) -> int:
+        match = self.match
+        if (m := match[state]) != -2:
+            return m
+        chain: List[int] = []
+        while (m := match[state]) == -2:
+            chain.append(state)
+            state = self._fail(state)
+        for s in chain:
+            match[s] = m
+        return m
+
+    def replace(self, data: bytes) -> bytes:
+        if self.root_pattern is None:
+            return data
+        root_search = self.root_pattern.search
+        hay = data.lower()
+        n = len(hay)
+        branch = self.branch
+        has_child = self.has_child
+        label = self.label
+        depth = self.depth
+        fail = self.fail
+        match = self.match
+        lengths = self.lengths
+        pieces: List[bytes] = []
+        last = 0
+        i = 0
+        state = 0
+        best_start = best_index = -1
+        while True:
+            if state == 0 and best_index < 0:
+                if (root_match := root_search(hay, i)) is None:
+                    break
+                i = root_match.start()
+            if i < n:
+                c = hay[i]
+                while True:
+                    if (children := branch.get(state)) is not None:
+                        nxt = children.get(c, -1)
+                    elif has_child[state] and label[state + 1] == c:
+                        nxt = state + 1
+                    else:
+                        nxt = -1
+                    if nxt >= 0:
+                        state = nxt
+                        break
+                    if state == 0:
+                        break
+                    state = f if (f := fail[state]) >= 0 else self._fail(state)
+                if (index := match[state]) == -2:
+                    index = self._match(state)
+                if index >= 0:
+                    start = i - lengths[index] + 1
+                    if best_index < 0 or start < best_start:
+                        best_start, best_index = start, index
+                # Commit only when no match in progress can start at or before the best one
+                if best_index < 0 or i - depth[state] + 1 <= best_start:
+                    i += 1
+                    continue
+            elif best_index < 0:
+                break
+            end = best_start + lengths[best_index]
+            prefix = self.prefixes[best_index]
+            if data[best_start : best_start + len(prefix)] == prefix:
+                pieces.append(data[last:best_start])
+                pieces.append(self.repls[best_index])
+                last = i = end
+            else:
+                # Only the length prefix differs in case, it is not the same COMStr
+                i = best_start + 1
+            state = 0
+            best_start = best_index = -1
+        if not pieces:
+            return data
+        pieces.append(data[last:])
+        return b"".join(pieces)
+
+
+__all__ = ["BinaryReplace", "decode_com_str", "encode_com_str"]
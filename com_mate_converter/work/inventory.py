@@ -0,0 +1,137 @@
+import dataclasses
+import functools
+import os
+import sys
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+
+from com_mate_converter import _
+
+# Same case rules as `Path.glob` on the current platform
+MATE_SUFFIX = os.path.normcase(".mate")
+MENU_SUFFIX = os.path.normcase(".menu")
+PMAT_SUFFIX = os.path.normcase(".pmat")
+NPR_MARK = os.path.normcase("_NPRMAT_")
+# Reparse tag of a junction (from winnt.h)
+IO_REPARSE_TAG_MOUNT_POINT = 0xA0000003
+
+
+@dataclasses.dataclass
+class FileEntry:
+    work_path: Path
+    path_str: str
+    size: int
+    mtime_ns: int
+    inode: int
+
+    @functools.cached_property
+    def path(self) -> Path:
+        # Building a Path is far more expensive than the scan itself, so only do it for files being processed
+        return Path(self.path_str)
+
+    @staticmethod
+    def from_dir_entry(work_path: Path, entry: "os.DirEntry[str]") -> "FileEntry":
+        stat = entry.stat()
+        return FileEntry(
+            work_path=work_path,
+            path_str=entry.path,
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            inode=stat.st_ino,
+        )
+
+
+def is_linked_dir(entry: "os.DirEntry[str]") -> bool:
+    if entry.is_symlink():
+        return True
+    if sys.platform == "win32":
+        return getattr(entry.stat(follow_symlinks=False), "st_reparse_tag", 0) == IO_REPARSE_TAG_MOUNT_POINT
+    return False
+
+
+class Inventory:
+    work_dirs: List[Path]
+    npr_mates: List[FileEntry]
+    other_mates: List[FileEntry]
+    menus: List[FileEntry]
+    pmats: List[FileEntry]
+
+    def __init__(self) -> None:
+        self.work_dirs = []
+        self.npr_mates = []
+        self.other_mates = []
+        self.menus = []
+        self.pmats = []
+
+    def clear(self) -> None:
+        self.work_dirs.clear()
+        self.npr_mates.clear()
+        self.other_mates.clear()
+        self.menus.clear()
+        self.pmats.clear()
+
+    @staticmethod
+    def normalize_work_dirs(paths: List[str]) -> List[Path]:
+        """Existing dirs in input order, without duplicates and dirs nested in another one."""
+        resolved: Dict[Path, Path] = {}
+        for p in paths:
+            p = Path(p)
+            if p.is_dir():
+                resolved.setdefault(p.resolve(), p)
+            else:
+                logger.warning(_("Work dir not found: {path}").format(path=p))
+        work_dirs: List[Path] = []
+        for r, p in resolved.items():
+            if any(parent in resolved for parent in r.parents):
+                logger.debug(_("Ignore nested work dir: {path}").format(path=p))
+                continue
+            work_dirs.append(p)
+        return work_dirs
+
+    def scan(self, paths: List[str], is_cancelled: Optional[Callable[[], bool]] = None) -> None:
+        """Find the files of the work dirs, each dir is scanned once.
+
+        Linked dirs (symlinks and junctions) are not followed, like `Path.glob("**")`, a Mate reachable by
+        two paths would be converted twice and the Menus could only point to one of them.
+        """
+        self.clear()
+        # (st_dev, st_ino) of the dirs scanned
+        visited: Set[Tuple[int, int]] = set()
+        for work_path in self.normalize_work_dirs(paths):
+            self.work_dirs.append(work_path)
+            stack = [str(work_path)]
+            while stack:
+                if is_cancelled is not None and is_cancelled():
+                    return
+                dir_path = stack.pop()
+                try:
+                    stat = os.stat(dir_path)
+                    if (key := (stat.st_dev, stat.st_ino)) in visited:
+                        continue
+                    visited.add(key)
+                    it = os.scandir(dir_path)
+                except OSError:
+                    continue
+                sub_dirs: List[str] = []
+                with it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir():
+                                if not is_linked_dir(entry):
+                                    sub_dirs.append(entry.path)
+                                continue
+                            name = os.path.normcase(entry.name)
+                            if name.endswith(MATE_SUFFIX):
+                                if NPR_MARK in name[: -len(MATE_SUFFIX)]:
+                                    self.npr_mates.append(FileEntry.from_dir_entry(work_path, entry))
+                                else:
+                                    self.other_mates.append(FileEntry.from_dir_entry(work_path, entry))
+                            elif name.endswith(MENU_SUFFIX):
+                                self.menus.append(FileEntry.from_dir_entry(work_path, entry))
+                            elif name.endswith(PMAT_SUFFIX):
+                                self.pmats.append(FileEntry.from_dir_entry(work_path, entry))
+                        except OSError:
+                            continue
+                stack.extend(reversed(sub_dirs))
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from com_mate_converter import _
+
+from .inventory import FileEntry, Inventory
+
+# Facts about the content of a file, they hold as long as the file is not modified
+MENU_NO_NPR = "menu_no_npr"
+PMAT_CONSISTENT = "pmat_consistent"
+# Menu with NPR refs which was left unchanged, only valid for the same config and mate rename mapping
+MENU_UNCHANGED = "menu_unchanged"
+
+
+class ScanManifest:
+    """Result of the last run for each Menu and Pmat, so files with the same size and mtime are not read again."""
+
+    VERSION = 1
+    path: Path
+    # path -> [size, mtime_ns, result, fingerprint]
+    entries: Dict[str, List[Any]]
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.entries = {}
+
+    @staticmethod
+    def fingerprint(*objs: Any) -> str:
+        return hashlib.sha1(json.dumps(objs, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def load(self) -> None:
+        self.entries = {}
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == ScanManifest.VERSION:
+                self.entries = manifest["entries"]
+        except Exception:
+            logger.warning(_("Failed to load scan manifest."))
+
+    @logger.catch
+    def save(self) -> None:
+        tmp_path = self.path.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump({"version": ScanManifest.VERSION, "entries": self.entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, entry: FileEntry) -> Optional[Tuple[str, str]]:
+        if (record := self.entries.get(entry.path_str)) is None:
+            return None
+        size, mtime_ns, result, fingerprint = record
+        if size != entry.size or mtime_ns != entry.mtime_ns:
+            return None
+        return result, fingerprint
+
+    def update(self, entry: FileEntry, result: str, fingerprint: str = "") -> None:
+        self.entries[entry.path_str] = [entry.size, entry.mtime_ns, result, fingerprint]
+
+    def prune(self, inventory: Inventory) -> None:
+        """Drop entries of files which are gone from the scanned work dirs."""
+        prefixes = tuple(os.path.join(str(p), "") for p in inventory.work_dirs)
+        if not prefixes:
+            return
+        alive = {e.path_str for e in inventory.menus}
+        alive.update(e.path_str for e in inventory.pmats)
+        for path_str in [k for k in self.entries if k.startswith(prefixes) and k not in alive]:
+            del self.entries[path_str]
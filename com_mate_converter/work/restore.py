@@ -0,0 +1,129 @@
+import multiprocessing
+import os
+from multiprocessing.dummy import Pool as ThreadPool
+from pathlib import Path, PurePath
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+from com_mate_converter import _
+
+from .backup import get_backup_reader
+
+NEW_FILE_LIST = "new_file_list.txt"
+# Backup name -> absolute path of the work dir
+WORK_DIR_LIST = "work_dirs.txt"
+FILE_TYPES: Dict[str, str] = {"mate": ".mate", "menu": ".menu", "pmat": ".pmat"}
+
+
+def make_selector(mod: Optional[str] = None, file_types: Sequence[str] = ()) -> Callable[[str], bool]:
+    """Select paths inside a folder named `mod` (at any depth) and of the given file types, case-insensitive."""
+    mod_lower = mod.lower() if mod else None
+    suffixes = tuple(FILE_TYPES[t] for t in file_types)
+
+    def select(path: str) -> bool:
+        pure_path = PurePath(path)
+        if suffixes and not pure_path.name.lower().endswith(suffixes):
+            return False
+        if mod_lower is not None and mod_lower not in (p.lower() for p in pure_path.parts[:-1]):
+            return False
+        return True
+
+    return select
+
+
+def write_work_dirs(backup_dir: Path, backup_dict: Dict[Path, Path]) -> None:
+    with (backup_dir / WORK_DIR_LIST).open("a", encoding="utf-8") as f:
+        for work_path, back_path in backup_dict.items():
+            f.write(f"{back_path.name}\t{work_path.resolve().as_posix()}\n")
+
+
+def read_work_dirs(backup_dir: Path) -> Dict[str, Path]:
+    work_dirs: Dict[str, Path] = {}
+    if (path := backup_dir / WORK_DIR_LIST).exists():
+        with path.open("r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    name, work_path = line.rstrip("\n").split("\t", 1)
+                    work_dirs[name] = Path(work_path)
+    return work_dirs
+
+
+def get_arcname(file_path: str, work_dirs: Sequence[Path]) -> str:
+    """Name of a file like in the backups, relative to the parent of its work dir."""
+    path = Path(file_path)
+    for work_path in work_dirs:
+        if work_path in path.parents:
+            return path.relative_to(work_path.parent).as_posix()
+    return file_path
+
+
+def remove_new_files(backup_dir: Path, select: Callable[[str], bool]) -> int:
+    """Delete the files created by the conversion (renamed Mates and Pmats).
+
+    They are listed by absolute path, but selected by the same name as the backup entries.
+    """
+    if not (path := backup_dir / NEW_FILE_LIST).exists():
+        return 0
+    work_dirs = list(read_work_dirs(backup_dir).values())
+    num = 0
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            if (file_path := line.strip()) and select(get_arcname(file_path, work_dirs)):
+                try:
+                    os.remove(file_path)
+                    num += 1
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    logger.warning(_("Failed to Remove: {filename}").format(filename=file_path))
+    return num
+
+
+def has_selected(path: Path, select: Callable[[str], bool]) -> bool:
+    backend = get_backup_reader(path)
+    assert backend is not None
+    return any(select(name) for name in backend.names(path))
+
+
+def restore(
+    backup_dir: Path,
+    target: Optional[Path] = None,
+    mod: Optional[str] = None,
+    file_types: Sequence[str] = (),
+) -> bool:
+    """Undo a conversion from its backup folder, the backups of all work dirs are extracted side by side.
+
+    Originals are written relative to the parent of their work dir, or to `target` if given.
+    """
+    select = make_selector(mod, file_types)
+    work_dirs = read_work_dirs(backup_dir)
+    jobs: List[Tuple[Path, Path]] = []
+    for path in sorted(backup_dir.iterdir()):
+        if path.name in (NEW_FILE_LIST, WORK_DIR_LIST, "blobs") or get_backup_reader(path) is None:
+            continue
+        if target is not None:
+            jobs.append((path, target))
+        elif (work_path := work_dirs.get(path.name)) is not None:
+            jobs.append((path, work_path.parent))
+        else:
+            logger.error(_("Unknown work dir of {b_name}, set the target dir").format(b_name=path.name))
+            return False
+    # The new files are only removed when there are originals to put back
+    if not any(has_selected(path, select) for path, _target in jobs):
+        logger.error(_("No backup entry is selected, nothing is restored"))
+        return False
+    removed_num = remove_new_files(backup_dir, select)
+    logger.info(_("Removed {num} new files").format(num=removed_num))
+
+    @logger.catch(default=-1)
+    def extract(path: Path, extract_path: Path) -> int:
+        backend = get_backup_reader(path)
+        assert backend is not None
+        num = backend.extract(path, extract_path, select)
+        logger.info(_('Restored {num} files from "{b_name}"').format(num=num, b_name=path.name))
+        return num
+
+    with ThreadPool(min(len(jobs), max(multiprocessing.cpu_count(), 2))) as pool:
+        results = pool.starmap(extract, jobs)
+    return all(num >= 0 for num in results)
@@ -0,0 +1,422 @@
+import dataclasses
+import io
+import os
+import traceback
+from enum import IntEnum
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from com_mate_converter import _
+from com_mate_converter.config import CMC_Config
+from com_mate_converter.model import Config, FormatVariable, Mate, Menu, Pmat
+from com_mate_converter.model.mate import FloatProperty
+
+from .binary_replace import BinaryReplace
+from .inventory import PMAT_SUFFIX, FileEntry
+from .manifest import MENU_NO_NPR, MENU_UNCHANGED, PMAT_CONSISTENT
+
+NPR_MARK = b"_nprmat_"
+
+
+class WorkType(IntEnum):
+    Mate = 0
+    Menu = 1
+    Pmat = 2
+    Finished = 3
+    Prefetch = 4
+
+
+@dataclasses.dataclass
+class StageContext:
+    """Everything a worker needs for a stage, shipped once per worker when the pool starts."""
+
+    work_type: WorkType
+    config: Config
+    shader_names: Dict[str, str]
+    shader_families: Dict[str, str]
+    mate_name_dict: Dict[str, str] = dataclasses.field(default_factory=dict)
+    mate_pmat_set: Set[str] = dataclasses.field(default_factory=set)
+    binary_replace: Optional[BinaryReplace] = None
+    # Mate path -> its new name, see `allocate_mate_names`
+    new_mate_names: Dict[str, str] = dataclasses.field(default_factory=dict)
+
+    @staticmethod
+    def create(work_type: WorkType, **kwargs: Any) -> "StageContext":
+        return StageContext(
+            work_type=work_type,
+            config=CMC_Config.config,
+            shader_names=CMC_Config.shader_names,
+            shader_families=CMC_Config.shader_families,
+            **kwargs,
+        )
+
+
+@dataclasses.dataclass
+class MateFix:
+    work_path: Path
+    path: Path
+    new_data: bytes
+    new_path: Path
+    data: bytes = b""
+
+    def apply(self) -> None:
+        self.path.rename(self.new_path)
+        try:
+            # Replaced rather than written in place, a hardlink snapshot of the original stays intact
+            replace_file(self.new_path, self.new_data)
+        except Exception:
+            # A failed Mate keeps its name, it is not in the rename mapping
+            self.new_path.rename(self.path)
+            raise
+
+
+@dataclasses.dataclass
+class MenuFix:
+    work_path: Path
+    path: Path
+    new_data: bytes
+    data: bytes = b""
+
+    def apply(self) -> None:
+        with self.path.open("wb") as f:
+            f.write(self.new_data)
+
+
+@dataclasses.dataclass
+class PmatFix:
+    work_path: Path
+    path: Path
+    new_data: bytes
+    new_path: Optional[Path]
+    data: bytes = b""
+
+    def apply(self) -> None:
+        with self.path.open("wb") as f:
+            f.write(self.new_data)
+        if self.new_path is not None:
+            self.path.rename(self.new_path)
+
+
+# A converted file, written by the main process once its original is queued for backup.
+# A worker only sends back the new content, the original (`data`) is paired with it by the `WorkPoolThread`
+# which read it ahead.
+Fix = Union[MateFix, MenuFix, PmatFix]
+
+
+@dataclasses.dataclass
+class BatchResult:
+    done: int = 0
+    skipped: int = 0
+    # Bytes of the files of the batch
+    size: int = 0
+    # Path of the first file of a batch read ahead, the main process holds the originals of the batch by it
+    batch_key: str = ""
+    logs: List[Tuple[str, str]] = dataclasses.field(default_factory=list)
+    # Files left untouched with their result for the scan manifest
+    scanned: List[Tuple[FileEntry, str]] = dataclasses.field(default_factory=list)
+    pass_list: List[Path] = dataclasses.field(default_factory=list)
+    # Mate
+    mate_pmat_set: Set[str] = dataclasses.field(default_factory=set)
+    mate_fixes: List[MateFix] = dataclasses.field(default_factory=list)
+    # Prefetch
+    menu_candidates: List[FileEntry] = dataclasses.field(default_factory=list)
+    pmat_candidates: List[FileEntry] = dataclasses.field(default_factory=list)
+    # Menu
+    menu_fixes: List[MenuFix] = dataclasses.field(default_factory=list)
+    # Pmat
+    pmat_fixes: List[PmatFix] = dataclasses.field(default_factory=list)
+
+    def warning(self, message: str, path: Path) -> None:
+        self.logs.append(("WARNING", message.format(filename=path.name)))
+
+    def info(self, message: str, path: Path) -> None:
+        self.logs.append(("INFO", message.format(filename=path.name)))
+
+
+Task = Callable[[StageContext, FileEntry, BatchResult], None]
+# A task of a CPU bound stage gets the content of the file read ahead, None if it could not be read
+BufferTask = Callable[[StageContext, FileEntry, Optional[bytes], BatchResult], None]
+
+# Stages running at the same time in one process (thread pools) each have their own context
+stages: Dict[WorkType, Tuple[StageContext, Any]] = {}
+
+
+def init_worker(stage_context: StageContext, stage_cancel_event: Any) -> None:
+    stages[stage_context.work_type] = (stage_context, stage_cancel_event)
+    # Processes do not share the config of the main process
+    CMC_Config.config = stage_context.config
+    CMC_Config.shader_names = stage_context.shader_names
+    CMC_Config.shader_families = stage_context.shader_families
+
+
+def run_batch(task: Task, work_type: WorkType, batch: List[FileEntry]) -> BatchResult:
+    context, cancel_event = stages[work_type]
+    result = BatchResult(size=sum(entry.size for entry in batch))
+    for entry in batch:
+        if cancel_event.is_set():
+            break
+        try:
+            task(context, entry, result)
+        except Exception:
+            result.logs.append(("ERROR", traceback.format_exc()))
+        result.done += 1
+    return result
+
+
+def run_buffer_batch(
+    task: BufferTask, work_type: WorkType, batch: List[Tuple[FileEntry, Optional[bytes]]]
+) -> BatchResult:
+    context, cancel_event = stages[work_type]
+    result = BatchResult(size=sum(entry.size for entry, _data in batch), batch_key=batch[0][0].path_str)
+    for entry, data in batch:
+        if cancel_event.is_set():
+            break
+        try:
+            task(context, entry, data, result)
+        except Exception:
+            result.logs.append(("ERROR", traceback.format_exc()))
+        result.done += 1
+    return result
+
+
+def read_file(path_str: str) -> Optional[bytes]:
+    try:
+        with open(path_str, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def prefetch(context: StageContext, entry: FileEntry, result: BatchResult) -> None:
+    """Everything about a Menu/Pmat that does not depend on the converted Mates, done while they are converting."""
+    if os.path.normcase(entry.path_str).endswith(PMAT_SUFFIX):
+        try:
+            with open(entry.path_str, "rb") as f:
+                material_name = Pmat.read_header(f).material_name
+        except Exception:
+            # Read again and reported by the Pmat stage
+            result.pmat_candidates.append(entry)
+            return
+        if os.path.splitext(os.path.basename(entry.path_str))[0] == material_name:
+            result.scanned.append((entry, PMAT_CONSISTENT))
+        else:
+            result.pmat_candidates.append(entry)
+        return
+    with open(entry.path_str, "rb") as f:
+        data = f.read()
+    if has_npr_reference(data):
+        result.menu_candidates.append(entry)
+    else:
+        result.skipped += 1
+        result.scanned.append((entry, MENU_NO_NPR))
+
+
+def allocate_mate_names(mate_entries: List[FileEntry]) -> Dict[str, str]:
+    """New names of the Mates, unique in their dir ignoring case like COM3D2, from one listing of each dir.
+
+    Every name already in the dir is taken, so the Mates can be renamed in any order and by any worker.
+    """
+    # The first choice of all names is formatted in one call, only collisions are formatted one by one
+    dirs: Dict[str, List[Tuple[FileEntry, str, str, int]]] = {}
+    format_variables: List[FormatVariable] = []
+    for entry in mate_entries:
+        stem = os.path.splitext(os.path.basename(entry.path_str))[0]
+        if "_NPRMAT" not in stem:
+            continue
+        try:
+            mate_name, shader_filename = stem.split("_NPRMAT")
+        except ValueError:
+            continue
+        if shader_filename.lower() not in CMC_Config.shader_names:
+            continue
+        dirs.setdefault(os.path.dirname(entry.path_str), []).append(
+            (entry, mate_name, shader_filename, len(format_variables))
+        )
+        format_variables.append(
+            FormatVariable(
+                mate_name=mate_name,
+                shader_family=CMC_Config.shader_families.get(shader_filename.lower()) or "npr",
+                shader_name=shader_filename,
+            )
+        )
+    first_names = CMC_Config.get_new_mate_names(format_variables)
+    new_mate_names: Dict[str, str] = {}
+    for dir_path, mates in dirs.items():
+        try:
+            taken = {name.lower() for name in os.listdir(dir_path)}
+        except OSError:
+            # Reported as failed by `process_mate`
+            continue
+        for entry, mate_name, shader_filename, name_index in mates:
+            new_mate_name = first_names[name_index]
+            index = 1
+            while new_mate_name.lower() in taken:
+                new_mate_name = CMC_Config.get_new_mate_name(
+                    FormatVariable(
+                        mate_name=f"{mate_name}_{index}",
+                        shader_family=CMC_Config.shader_families.get(shader_filename) or "npr",
+                        shader_name=shader_filename,
+                    )
+                )
+                index += 1
+            taken.add(new_mate_name.lower())
+            new_mate_names[entry.path_str] = new_mate_name
+    return new_mate_names
+
+
+def process_mate(context: StageContext, mate_entry: FileEntry, data: Optional[bytes], result: BatchResult) -> None:
+    mate_path = mate_entry.path
+    if "_NPRMAT" not in mate_path.stem:
+        result.pass_list.append(mate_path)
+        result.warning(_("Ignore Mate (no NPRMAT): {filename}"), mate_path)
+        return
+    mate_name, shader_filename = mate_path.stem.split("_NPRMAT")
+    try:
+        # Read once ahead of the worker, the original is also what gets backed up
+        if data is None:
+            raise OSError(f"Failed to read {mate_path}")
+        mate = Mate.parse(data)
+    except Exception:
+        result.pass_list.append(mate_path)
+        result.warning(_("Failed to Read Mate: {filename}"), mate_path)
+        return
+    shader_name = CMC_Config.shader_names.get(shader_filename.lower())
+    if shader_name is None:
+        result.pass_list.append(mate_path)
+        result.warning(_("Ignore Mate (Unknown Shader): {filename}"), mate_path)
+        return
+    result.mate_pmat_set.add(mate.material.name)
+    mate.material.shader = shader_name
+    mate.material.shader_filename = f"com3d2mod{shader_filename}"
+    if (new_mate_name := context.new_mate_names.get(mate_entry.path_str)) is None:
+        result.pass_list.append(mate_path)
+        result.warning(_("Failed to Process Mate: {filename}"), mate_path)
+        return
+    new_mate_path = mate_path.parent / new_mate_name
+    mate.mate_name = new_mate_name[:-5]
+    if shader_filename.startswith("_NPRToon"):
+        for p in mate.material.properties:
+            if type(p) is FloatProperty:
+                if "Toggle" in p.prop.name:
+                    p.prop.name += "_ON_SSKEYWORD"
+    try:
+        new_data = mate.build()
+    except Exception:
+        result.pass_list.append(mate_path)
+        result.warning(_("Failed to Process Mate: {filename}"), mate_path)
+        return
+    # Renamed and written by the main process once the original is queued for backup, only then it is in the mapping
+    result.mate_fixes.append(MateFix(mate_entry.work_path, mate_path, new_data, new_mate_path))
+
+
+def replace_file(path: Path, data: bytes) -> None:
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tmp_path.open("wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def process_menu(context: StageContext, menu_entry: FileEntry, data: Optional[bytes], result: BatchResult) -> None:
+    work_path, menu_path = menu_entry.work_path, menu_entry.path
+    if data is None:
+        result.pass_list.append(menu_path)
+        result.warning(_("Failed to Read Menu: {filename}"), menu_path)
+        return
+    if not has_npr_reference(data):
+        result.skipped += 1
+        result.scanned.append((menu_entry, MENU_NO_NPR))
+        return
+    changed = False
+    if context.config.menu_process_mode == 0:
+        try:
+            new_data = Menu.replace_mate_names(data, context.mate_name_dict)
+        except Exception:
+            # Not well-formed for the splice, take the full parse path to report it exactly
+            try:
+                menu = Menu.parse(data)
+            except Exception:
+                result.pass_list.append(menu_path)
+                result.warning(_("Failed to Read Menu: {filename}"), menu_path)
+                return
+            try:
+                new_data = replace_menu_mate_names(menu, context.mate_name_dict)
+            except Exception:
+                result.pass_list.append(menu_path)
+                result.warning(_("Failed to Process Menu: {filename}"), menu_path)
+                return
+        changed = new_data is not None
+    elif context.config.menu_process_mode == 1:
+        assert context.binary_replace is not None
+        new_data = context.binary_replace.replace(data)
+        if new_data != data:
+            changed = True
+    if changed:
+        result.menu_fixes.append(MenuFix(work_path, menu_path, new_data))  # type: ignore
+    else:
+        result.scanned.append((menu_entry, MENU_UNCHANGED))
+
+
+def has_npr_reference(data: bytes) -> bool:
+    # Every renamed mate has the marker in its name, and most menus never reference one
+    return NPR_MARK in data.lower()
+
+
+def replace_menu_mate_names(menu: Menu, mate_name_dict: Dict[str, str]) -> Optional[bytes]:
+    changed = False
+    for c in menu.commands:
+        if (args_len := len(c.args)) > 1 and c.args[0] == "マテリアル変更":
+            for i in range(1, args_len):
+                arg_lower = c.args[i].lower()
+                if "_nprmat_" in arg_lower and arg_lower.endswith(".mate"):
+                    if (new_mate_name := mate_name_dict.get(arg_lower)) is not None:
+                        c.args[i] = new_mate_name
+                        changed = True
+    return menu.build() if changed else None
+
+
+def process_pmat(context: StageContext, pmat_entry: FileEntry, data: Optional[bytes], result: BatchResult) -> None:
+    work_path, pmat_path = pmat_entry.work_path, pmat_entry.path
+    try:
+        if data is None:
+            raise OSError(f"Failed to read {pmat_path}")
+        pmat_header = Pmat.read_header(io.BytesIO(data))
+    except Exception:
+        result.pass_list.append(pmat_path)
+        result.warning(_("Failed to Read Pmat: {filename}"), pmat_path)
+        return
+    changed = False
+    pmat_new_filepath: Optional[Path] = None
+    pmat_filename = pmat_path.stem
+    pmat_mat_name = pmat_header.material_name
+    mate_pmat_set = context.mate_pmat_set
+    if pmat_filename != pmat_mat_name:
+        if pmat_filename in mate_pmat_set and pmat_mat_name not in mate_pmat_set:
+            result.info(_("[white]Detect Wrong [MatName] Pmat: {filename}"), pmat_path)
+            if context.config.pmat_check_mode == 0:
+                changed = True
+        elif pmat_filename not in mate_pmat_set and pmat_mat_name in mate_pmat_set:
+            result.info(_("[white]Detect Wrong [FileName] Pmat: {filename}"), pmat_path)
+            if context.config.pmat_check_mode == 0:
+                changed = True
+                pmat_new_filepath = pmat_path.parent / f"{pmat_mat_name}.pmat"
+        else:
+            result.info(_("[white]Detect Pmat with Potential Error: {filename}"), pmat_path)
+    else:
+        result.scanned.append((pmat_entry, PMAT_CONSISTENT))
+    if changed:
+        # Only a Pmat to be fixed is fully parsed and rebuilt, it is written by the main process after the backup
+        try:
+            pmat = Pmat.parse(data)
+        except Exception:
+            result.pass_list.append(pmat_path)
+            result.warning(_("Failed to Read Pmat: {filename}"), pmat_path)
+            return
+        if pmat_new_filepath is None:
+            pmat.material_name = pmat_filename
+        try:
+            new_data = pmat.build()
+        except Exception:
+            result.pass_list.append(pmat_path)
+            result.warning(_("Failed to Process Pmat: {filename}"), pmat_path)
+            return
+        result.pmat_fixes.append(PmatFix(work_path, pmat_path, new_data, pmat_new_filepath))
@@ -2,55 +2,59 @@ import os
 import threading
 import time
 from datetime import datetime
-from enum import IntEnum
 from pathlib import Path
-from typing import Callable, Dict, List, Optional, Set, Tuple
+from typing import Any, Callable, Dict, List, Optional, Set
 
-import py7zr
 from loguru import logger
-from textual.message import Message
 
 from com_mate_converter import _
 from com_mate_converter.config import CMC_Config
-from com_mate_converter.model import FormatVariable, Mate, Menu, Pmat
-from com_mate_converter.model.mate import FloatProperty
 
+from . import restore, tasks
+from .backup import get_backup_backend
 from .binary_replace import BinaryReplace
-from .work_thread import BackupThread, WorkPoolThread
+from .inventory import FileEntry, Inventory
+from .manifest import MENU_NO_NPR, MENU_UNCHANGED, PMAT_CONSISTENT, ScanManifest
+from .tasks import BatchResult, StageContext, WorkType
+from .work_thread import BackupPool, CancelToken, WorkPoolThread, WriteBehindThread
 
 
-class WorkType(IntEnum):
-    Mate = 0
-    Menu = 1
-    Pmat = 2
-    Finished = 3
-
-
-class WorkCommand(Message):
-    def __init__(self, work_type: WorkType) -> None:
-        super().__init__()
-        self.work_type = work_type
-
-
-class WorkProgress(Message):
-    def __init__(self, percentage: float) -> None:
-        super().__init__()
-        self.percentage = percentage
+class WorkManager:
+    """Run the conversion as a pipeline.
 
+    Menus and Pmats are prefetched (prefiltered / header checked) while the Mates are converted,
+    their originals are backed up on the way.
+    Once the Mates are done, the rename mapping and `mate_pmat_set` are final and the Menu rewrites
+    and Pmat fixes run side by side.
+    Workers only convert files in memory, the converted files are written by a `WriteBehindThread`.
+    """
 
-class WorkManager:
-    send_message_callback: Callable[[Message], bool]
-    work_pool_thread: Optional[WorkPoolThread] = None
-    backup_thread: Optional[BackupThread] = None
+    progress_callback: Callable[[int], None]
+    finished_callback: Callable[[], None]
+    pool_threads: List[WorkPoolThread]
+    backup_pool: Optional[BackupPool] = None
+    write_thread: Optional[WriteBehindThread] = None
+    cancel_token: CancelToken
+    merge_lock: threading.Lock
     # Files
-    work_dirs: List[Path]
-    mate_list: List[Path]
-    menu_list: List[Tuple[Path, Path]]
-    pmat_list: List[Tuple[Path, Path]]
+    inventory: Inventory
+    manifest: ScanManifest
+    menu_fingerprint: str = ""
+    mate_list: List[FileEntry]
+    menu_list: List[FileEntry]
+    pmat_list: List[FileEntry]
     # Work
     finish_counter: int = 0
-    finish_counter_lock: threading.Lock
-    rename_lock: threading.Lock
+    total_counter: int = 0
+    last_percentage: int = -1
+    menu_skip_count: int = 0
+    failed: bool = False
+    # Stage -> seconds, in the order the stages ended
+    timings: Dict[str, float]
+    _lap_time: float = 0.0
+    # Most files in a batch, stage -> number of batches it was dispatched in
+    chunk_size: int = 0
+    chunks: Dict[str, int]
     backup_dict: Dict[Path, Path]
     mate_pmat_set: Set[str]
     mate_proc_list: List[Path]
@@ -60,16 +64,23 @@ class WorkManager:
     pmat_change_list: List[Path]
     pmat_pass_list: List[Path]
     pmat_fname_change_list: List[Path]
+    # Fixes which could not be queued for writing
+    failed_fixes: List[tasks.Fix]
 
-    def __init__(self, send_message_callback: Callable[[Message], bool]) -> None:
-        self.send_message_callback = send_message_callback
-        self.work_dirs = []
+    def __init__(self, progress_callback: Callable[[int], None], finished_callback: Callable[[], None]) -> None:
+        self.progress_callback = progress_callback
+        self.finished_callback = finished_callback
+        self.pool_threads = []
+        self.cancel_token = CancelToken()
+        self.merge_lock = threading.Lock()
+        self.inventory = Inventory()
+        self.manifest = ScanManifest(CMC_Config.scan_manifest_file)
         self.mate_list = []
         self.menu_list = []
         self.pmat_list = []
+        self.timings = {}
+        self.chunks = {}
         self.backup_dict = {}
-        self.finish_counter_lock = threading.Lock()
-        self.rename_lock = threading.Lock()
         self.mate_pmat_set = set()
         self.mate_proc_list = []
         self.mate_pass_list = []
@@ -78,21 +89,37 @@ class WorkManager:
         self.pmat_change_list = []
         self.pmat_pass_list = []
         self.pmat_fname_change_list = []
+        self.failed_fixes = []
 
     def kill_work_thread(self) -> None:
-        if self.backup_thread is not None:
-            self.backup_thread.kill()
-        if self.work_pool_thread is not None:
-            self.work_pool_thread.kill()
+        self.cancel_token.cancel()
+        if self.backup_pool is not None:
+            self.backup_pool.kill()
+        if self.write_thread is not None:
+            self.write_thread.kill()
+        for t in self.pool_threads:
+            t.kill()
 
     def stop_work_thread(self) -> None:
-        if self.backup_thread is not None:
-            self.backup_thread.stop()
-        if self.work_pool_thread is not None:
-            self.work_pool_thread.stop()
+        if self.backup_pool is not None:
+            self.backup_pool.stop()
+        if self.write_thread is not None:
+            self.write_thread.stop()
+        for t in self.pool_threads:
+            t.stop()
+
+    def is_running(self) -> bool:
+        if self.backup_pool is not None and self.backup_pool.is_alive():
+            return True
+        if self.write_thread is not None and self.write_thread.is_alive():
+            return True
+        return any(t.is_alive() for t in self.pool_threads)
 
     def clear(self) -> None:
-        self.work_dirs.clear()
+        self.pool_threads.clear()
+        self.backup_pool = None
+        self.write_thread = None
+        self.inventory.clear()
         self.mate_list.clear()
         self.menu_list.clear()
         self.pmat_list.clear()
@@ -105,11 +132,24 @@ class WorkManager:
         self.pmat_change_list.clear()
         self.pmat_pass_list.clear()
         self.pmat_fname_change_list.clear()
+        self.failed_fixes.clear()
         self.finish_counter = 0
+        self.total_counter = 0
+        self.last_percentage = -1
+        self.menu_skip_count = 0
+        self.failed = False
+        self.timings.clear()
+        self.chunk_size = 0
+        self.chunks.clear()
 
-    def counter_add(self) -> None:
-        with self.finish_counter_lock:
-            self.finish_counter += 1
+    def merge_result(self, result: BatchResult) -> None:
+        for level, message in result.logs:
+            logger.log(level, message)
+        self.finish_counter += result.done
+        # The total grows when later stages are planned, the progress bar only moves forward in whole percents
+        if (percentage := self.finish_counter * 100 // max(self.total_counter, 1)) > self.last_percentage:
+            self.last_percentage = percentage
+            self.progress_callback(percentage)
 
     def report_failed(self) -> None:
         report_path = Path.cwd() / "failed_or_pass_list.txt"
@@ -125,91 +165,238 @@ class WorkManager:
             for p in self.pmat_pass_list:
                 f.write(f"{p.as_posix()}\n")
 
-    def wait_for_work_thread_exit(self) -> None:
-        if self.work_pool_thread is not None:
-            while self.work_pool_thread.is_alive():
-                time.sleep(0.1)
+    def run(self, paths: List[str], is_cancelled: Callable[[], bool]) -> None:
+        """Process the paths from start to end in the calling thread, then call `finished_callback`."""
+        try:
+            if self.is_running():
+                logger.error(_("A Work Thread Pool is still running"))
+                self.failed = True
+                return
+            self.clear()
+            self.cancel_token = CancelToken()
+            start_time = self._lap_time = time.perf_counter()
+            self._run(paths, lambda: is_cancelled() or self.cancel_token.is_cancelled())
+            self.timings["total"] = time.perf_counter() - start_time
+        except Exception:
+            logger.exception(_("Failed to Process"))
+            self.failed = True
+            self.kill_work_thread()
+        finally:
+            self.finished_callback()
 
-    def start_process_mate(self, paths: List[str], is_cancelled: Callable[[], bool]) -> None:
-        if self.work_pool_thread is not None and not self.work_pool_thread.is_stopped():
-            logger.error(_("A Work Thread Pool is still running"))
-            self.send_message_callback(WorkCommand(WorkType.Finished))
-            return
-        self.clear()
+    def _lap(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.timings[stage] = now - self._lap_time
+        self._lap_time = now
+
+    def _run(self, paths: List[str], is_cancelled: Callable[[], bool]) -> None:
         logger.info(_("Searching..."))
-        logger.debug(_("Search for Mate..."))
-        self._glob_mates(paths, is_cancelled)
+        self._scan_files(paths, is_cancelled)
+        self._lap("scan")
         logger.info(_("[royal_blue1]Found {num} NPR Mate").format(num=len(self.mate_list)))
-        if len(self.mate_list) == 0:
-            self.send_message_callback(WorkCommand(WorkType.Finished))
-            return
-        self.work_pool_thread = WorkPoolThread(self.process_mate, self.mate_list, self.process_mate_finish)
-        self.work_pool_thread.start()
-        logger.info(_("Processing Mate..."))
-
-    @logger.catch
-    def process_mate(self, mate_path: Path) -> None:
-        if "_NPRMAT" not in mate_path.stem:
-            self.mate_pass_list.append(mate_path)
-            logger.warning(_("Ignore Mate (no NPRMAT): {filename}").format(filename=mate_path.name))
-            return
-        mate_name, shader_filename = mate_path.stem.split("_NPRMAT")
-        try:
-            with mate_path.open("rb") as f:
-                mate = Mate.parse(f.read())
-        except Exception:
-            self.mate_pass_list.append(mate_path)
-            logger.warning(_("Failed to Read Mate: {filename}").format(filename=mate_path.name))
-            return
-        shader_name = CMC_Config.shader_names.get(shader_filename.lower())
-        if shader_name is None:
-            self.mate_pass_list.append(mate_path)
-            logger.warning(_("Ignore Mate (Unknown Shader): {filename}").format(filename=mate_path.name))
+        if len(self.mate_list) == 0 or is_cancelled():
             return
-        self.mate_pmat_set.add(mate.material.name)
-        mate.material.shader = shader_name
-        mate.material.shader_filename = f"com3d2mod{shader_filename}"
-        new_mate_name = CMC_Config.get_new_mate_name(
-            FormatVariable(
-                mate_name=mate_name,
-                shader_family=CMC_Config.shader_families.get(shader_filename.lower()) or "npr",
-                shader_name=shader_filename,
-            )
+        prefetch_list = self._plan_prefetch()
+        self.total_counter = len(self.mate_list) + len(prefetch_list)
+        prefetch_thread = self._start_pool(
+            tasks.prefetch,
+            prefetch_list,
+            StageContext.create(WorkType.Prefetch),
+            self.merge_prefetch_result,
+            io_bound=True,
         )
-        new_mate_path = mate_path.parent / new_mate_name
-        with self.rename_lock:
-            index = 1
-            while new_mate_path.exists():
-                new_mate_name = CMC_Config.get_new_mate_name(
-                    FormatVariable(
-                        mate_name=f"{mate_name}_{index}",
-                        shader_family=CMC_Config.shader_families.get(shader_filename) or "npr",
-                        shader_name=shader_filename,
-                    )
-                )
-                new_mate_path = mate_path.parent / new_mate_name
-                index += 1
-            mate_path.rename(new_mate_path)
-        mate.mate_name = new_mate_name[:-5]
-        if shader_filename.startswith("_NPRToon"):
-            for p in mate.material.properties:
-                if type(p) is FloatProperty:
-                    if "Toggle" in p.prop.name:
-                        p.prop.name += "_ON_SSKEYWORD"
+        self._start_backup()
+        write_thread = self.write_thread = WriteBehindThread(self.cancel_token)
+        write_thread.start()
         try:
-            data = mate.build()
-        except Exception:
-            self.mate_pass_list.append(mate_path)
-            logger.warning(_("Failed to Process Mate: {filename}").format(filename=mate_path.name))
-            return
-        self.mate_name_dict[mate_path.name.lower()] = new_mate_name
-        with new_mate_path.open("wb") as f:
-            f.write(data)
-        self.mate_proc_list.append(new_mate_path)
-        self.counter_add()
-        self.send_message_callback(
-            WorkProgress((self.finish_counter + len(self.mate_pass_list)) / len(self.mate_list) * 100)
+            mate_context = StageContext.create(WorkType.Mate, new_mate_names=tasks.allocate_mate_names(self.mate_list))
+            mate_thread = self._start_pool(tasks.process_mate, self.mate_list, mate_context, self.merge_mate_result)
+            logger.info(_("Processing Mate..."))
+            mate_thread.join()
+            if is_cancelled():
+                return
+            self.merge_fixes()
+            self.process_mate_finish()
+            self._lap("mate")
+            prefetch_thread.join()
+            self._lap("prefetch")
+            if is_cancelled():
+                return
+            self._process_menu_and_pmat(is_cancelled)
+            self._lap("menu_pmat")
+            self._save_worker_nums()
+        finally:
+            # Files are only written after their original is queued, they are written before the backup is closed
+            write_thread.stop()
+            write_thread.join()
+            # Everything queued belongs to a file which was already renamed or overwritten
+            if self.backup_pool is not None:
+                self.backup_pool.stop()
+                self.backup_pool.join()
+                logger.debug(_("Backup Finished"))
+                self._lap("backup")
+
+    def get_summary(self) -> Dict[str, Any]:
+        """Counts and timings of the last run."""
+        return {
+            "mate": {
+                "found": len(self.mate_list),
+                "converted": len(self.mate_proc_list),
+                "failed": len(self.mate_pass_list),
+            },
+            "menu": {
+                "found": len(self.inventory.menus),
+                "processed": len(self.menu_list),
+                "skipped": self.menu_skip_count,
+                "failed": len(self.menu_pass_list),
+            },
+            "pmat": {
+                "found": len(self.inventory.pmats),
+                "checked": len(self.pmat_list),
+                "renamed": len(self.pmat_fname_change_list),
+                "failed": len(self.pmat_pass_list),
+            },
+            "backup": [p.as_posix() for p in self.backup_dict.values() if p.exists()],
+            "failed": self.failed,
+            "chunk_size": self.chunk_size,
+            "chunks": dict(self.chunks),
+            "workers": {t.stage_key: t.worker_num for t in self.pool_threads},
+            "timings": {k: round(v, 3) for k, v in self.timings.items()},
+        }
+
+    def _start_pool(
+        self,
+        target: tasks.Task,
+        args: List[FileEntry],
+        context: StageContext,
+        result_callback: Callable[[BatchResult], None],
+        io_bound: bool = False,
+    ) -> WorkPoolThread:
+        pool_thread = WorkPoolThread(
+            target,
+            args,
+            context,
+            result_callback,
+            self.cancel_token,
+            io_bound=io_bound,
+            worker_nums=self._saved_worker_nums(),
         )
+        self.pool_threads.append(pool_thread)
+        self.chunk_size = pool_thread.chunk_size
+        self.chunks[context.work_type.name.lower()] = pool_thread.chunk_num
+        pool_thread.start()
+        return pool_thread
+
+    def _work_dir_keys(self) -> List[str]:
+        return [p.resolve().as_posix() for p in self.inventory.work_dirs]
+
+    def _saved_worker_nums(self) -> Dict[str, int]:
+        """Workers chosen by the last auto run for each stage, the first work dir which has one wins."""
+        worker_nums: Dict[str, int] = {}
+        for key in reversed(self._work_dir_keys()):
+            worker_nums.update(CMC_Config.config.worker_nums.get(key, {}))
+        return worker_nums
+
+    def _save_worker_nums(self) -> None:
+        tuned = {t.stage_key: t.worker_num for t in self.pool_threads if t.tuner is not None}
+        if not tuned:
+            return
+        worker_nums = dict(CMC_Config.config.worker_nums)
+        for key in self._work_dir_keys():
+            worker_nums[key] = {**worker_nums.get(key, {}), **tuned}
+        CMC_Config.config.worker_nums = worker_nums
+        CMC_Config.write_worker_nums()
+        logger.debug(_("Workers: {workers}").format(workers=tuned))
+
+    @logger.catch
+    def _scan_files(self, paths: List[str], is_cancelled: Callable[[], bool]) -> None:
+        self.inventory.scan(paths, is_cancelled)
+        self.mate_list = self.inventory.npr_mates
+        self.manifest.load()
+        self.manifest.prune(self.inventory)
+
+    def _plan_prefetch(self) -> List[FileEntry]:
+        """Files to prefetch, without those the scan manifest already knows."""
+        prefetch_list: List[FileEntry] = []
+        known_menu_num = 0
+        logger.info(_("[royal_blue1]Found {num} Menu").format(num=len(self.inventory.menus)))
+        for e in self.inventory.menus:
+            if (known := self.manifest.lookup(e)) is None:
+                prefetch_list.append(e)
+            elif known == (MENU_NO_NPR, ""):
+                known_menu_num += 1
+            else:
+                # Left unchanged last time, it depends on the rename mapping checked later
+                self.menu_list.append(e)
+        logger.debug(_("{num} Menu unchanged since last run").format(num=known_menu_num))
+        if CMC_Config.config.pmat_check_mode == 2:
+            return prefetch_list
+        known_pmat_num = 0
+        logger.info(_("[royal_blue1]Found {num} Pmat").format(num=len(self.inventory.pmats)))
+        for e in self.inventory.pmats:
+            if self.manifest.lookup(e) == (PMAT_CONSISTENT, ""):
+                known_pmat_num += 1
+            else:
+                prefetch_list.append(e)
+        logger.debug(_("{num} Pmat unchanged since last run").format(num=known_pmat_num))
+        return prefetch_list
+
+    @logger.catch
+    def merge_prefetch_result(self, result: BatchResult) -> None:
+        with self.merge_lock:
+            self.menu_skip_count += result.skipped
+            self.menu_list += result.menu_candidates
+            self.pmat_list += result.pmat_candidates
+            for entry, scan_result in result.scanned:
+                self.manifest.update(entry, scan_result)
+            self.merge_result(result)
+
+    @logger.catch
+    def merge_mate_result(self, result: BatchResult) -> None:
+        with self.merge_lock:
+            self.mate_pass_list += result.pass_list
+            self.mate_pmat_set |= result.mate_pmat_set
+            for fix in result.mate_fixes:
+                # Never renamed or overwritten before the original is queued for backup
+                if CMC_Config.config.backup and (
+                    self.backup_pool is None
+                    or not self.backup_pool.add_backup(fix.work_path, fix.path, fix.data, link=True)
+                ):
+                    self.mate_pass_list.append(fix.path)
+                    logger.warning(_("Failed to Process Mate: {filename}").format(filename=fix.path.name))
+                    continue
+                self.add_fix(fix)
+            self.merge_result(result)
+
+    def add_fix(self, fix: tasks.Fix) -> None:
+        # Blocks while the write-behind queue is full
+        if self.write_thread is None or not self.write_thread.add_fix(fix):
+            # Dropped when the work is killed
+            self.failed_fixes.append(fix)
+
+    def merge_fixes(self) -> None:
+        """Wait for the files queued so far to be written and account them."""
+        applied, failed = self.write_thread.flush() if self.write_thread is not None else ([], [])
+        with self.merge_lock:
+            failed += self.failed_fixes
+            self.failed_fixes = []
+            for fix in applied:
+                if isinstance(fix, tasks.MateFix):
+                    # Keyed by name only, a Mate of the same name which failed in another dir must not drop it
+                    self.mate_name_dict[fix.path.name.lower()] = fix.new_path.name
+                    self.mate_proc_list.append(fix.new_path)
+                elif isinstance(fix, tasks.PmatFix) and fix.new_path is not None:
+                    self.pmat_fname_change_list.append(fix.new_path)
+            for fix in failed:
+                if isinstance(fix, tasks.MateFix):
+                    self.mate_pass_list.append(fix.path)
+                    logger.warning(_("Failed to Process Mate: {filename}").format(filename=fix.path.name))
+                elif isinstance(fix, tasks.MenuFix):
+                    self.menu_pass_list.append(fix.path)
+                    logger.warning(_("Failed to Process Menu: {filename}").format(filename=fix.path.name))
+                else:
+                    self.pmat_pass_list.append(fix.path)
+                    logger.warning(_("Failed to Process Pmat: {filename}").format(filename=fix.path.name))
 
     def process_mate_finish(self) -> None:
         logger.debug(_("Process Mate Finished"))
@@ -228,215 +415,112 @@ class WorkManager:
                 with backup_path.open("w", encoding="utf-8") as f:
                     for p in self.mate_proc_list:
                         f.write(f"{p.as_posix()}\n")
-        self.send_message_callback(WorkCommand(WorkType.Menu))
 
     @logger.catch
-    def _glob_mates(self, paths: List[str], is_cancelled: Callable[[], bool]) -> None:
-        self.mate_list.clear()
-        mate_list: List[Path] = []
+    def _start_backup(self) -> None:
+        """Name the backup of each work dir and start writing them, originals are queued as they are read."""
+        if not CMC_Config.config.backup:
+            return
+        backend = get_backup_backend(CMC_Config.config)
         backup_path: Optional[Path] = None
         backup_filenames: Set[str] = set()
         curr_datetime: str = datetime.now().strftime("%Y%m%d_%H%M%S")
-        for p in paths:
-            p = Path(p)
-            if p.exists():
-                if p.is_dir():
-                    self.work_dirs.append(p)
-                    cur_list = list(p.glob("**/*_NPRMAT_*.mate"))
-                    if CMC_Config.config.backup:
-                        if backup_path is None:
-                            backup_path = Path.cwd() / "backup" / curr_datetime
-                            backup_path.mkdir(parents=True, exist_ok=True)
-                        backup_filename = p.name
-                        backup_filepath = backup_path / f"{backup_filename}.7z"
-                        index = 1
-                        while backup_filename in backup_filenames or backup_filepath.exists():
-                            backup_filename = f"{p.name}_{index}"
-                            backup_filepath = backup_path / f"{backup_filename}.7z"
-                            index += 1
-                        backup_filenames.add(backup_filename)
-                        self.backup_dict[p] = backup_filepath
-                        if cur_list:
-                            logger.info(
-                                _('Backuping to "{b_name}"').format(
-                                    b_name=backup_filepath.relative_to(Path.cwd() / "backup")
-                                )
-                            )
-                            with py7zr.SevenZipFile(backup_filepath, "w") as archive:
-                                for mate_p in cur_list:
-                                    if is_cancelled():
-                                        return
-                                    archive.write(mate_p, str(mate_p.relative_to(p.parent)))
-                    mate_list += cur_list
-        self.mate_list = mate_list
-
-    def start_process_menu(self) -> None:
-        if self.work_pool_thread is not None and not self.work_pool_thread.is_stopped():
-            logger.error(_("A Work Thread Pool is still running"))
-            self.send_message_callback(WorkCommand(WorkType.Finished))
-            return
-        if self.backup_thread is not None and not self.backup_thread.is_stopped():
-            logger.error(_("A Backup Thread is still running"))
-            self.backup_thread.stop()
-            self.send_message_callback(WorkCommand(WorkType.Finished))
-            return
-        self.finish_counter = 0
-        logger.debug(_("Search for Menu..."))
-        self._glob_menus()
-        logger.info(_("[royal_blue1]Found {num} Menu").format(num=len(self.menu_list)))
-        if len(self.menu_list) == 0:
-            self.send_message_callback(WorkCommand(WorkType.Pmat))
-            return
-        if CMC_Config.config.menu_process_mode == 1:
-            BinaryReplace.compile_pattern(self.mate_name_dict)
-        if CMC_Config.config.backup:
-            self.backup_thread = BackupThread(self.backup_dict)
-            self.backup_thread.start()
-        self.work_pool_thread = WorkPoolThread(self.process_menu, self.menu_list, self.process_menu_finish)
-        self.work_pool_thread.start()
-        logger.info(_("Processing Menu..."))
-
-    @logger.catch
-    def process_menu(self, menu_p: Tuple[Path, Path]) -> None:
-        work_path, menu_path = menu_p
-        with menu_path.open("rb") as f:
-            data = f.read()
-        changed = False
-        if CMC_Config.config.menu_process_mode == 0:
-            try:
-                menu = Menu.parse(data)
-            except Exception:
-                self.counter_add()
-                self.menu_pass_list.append(menu_path)
-                logger.warning(_("Failed to Read Menu: {filename}").format(filename=menu_path.name))
-                return
-            for c in menu.commands:
-                if (args_len := len(c.args)) > 1 and c.args[0] == "マテリアル変更":
-                    for i in range(1, args_len):
-                        arg_lower = c.args[i].lower()
-                        if "_nprmat_" in arg_lower and arg_lower.endswith(".mate"):
-                            if (new_mate_name := self.mate_name_dict.get(arg_lower)) is not None:
-                                c.args[i] = new_mate_name
-                                changed = True
-            if changed:
-                try:
-                    new_data = menu.build()
-                except Exception:
-                    self.counter_add()
-                    self.menu_pass_list.append(menu_path)
-                    logger.warning(_("Failed to Process Menu: {filename}").format(filename=menu_path.name))
-                    return
-        elif CMC_Config.config.menu_process_mode == 1:
-            new_data = BinaryReplace.replace(data)
-            if new_data != data:
-                changed = True
-        if changed:
-            with menu_path.open("wb") as f:
-                f.write(new_data)
-            if CMC_Config.config.backup and self.backup_thread is not None:
-                self.backup_thread.add_backup(work_path, menu_path, data)
-        self.counter_add()
-        self.send_message_callback(WorkProgress((self.finish_counter) / len(self.menu_list) * 100))
-
-    @logger.catch
-    def process_menu_finish(self) -> None:
-        logger.debug(_("Process Menu Finished"))
-        if self.backup_thread is not None:
-            self.backup_thread.stop()
-            while self.backup_thread.is_alive():
-                time.sleep(0.1)
-            logger.debug(_("Backup Menu Finished"))
-        self.send_message_callback(WorkCommand(WorkType.Pmat))
+        for p in self.inventory.work_dirs:
+            if backup_path is None:
+                backup_path = Path.cwd() / "backup" / curr_datetime
+                backup_path.mkdir(parents=True, exist_ok=True)
+            backup_filename = p.name
+            backup_filepath = backup_path / f"{backup_filename}{backend.suffix}"
+            index = 1
+            while backup_filename in backup_filenames or backup_filepath.exists():
+                backup_filename = f"{p.name}_{index}"
+                backup_filepath = backup_path / f"{backup_filename}{backend.suffix}"
+                index += 1
+            backup_filenames.add(backup_filename)
+            self.backup_dict[p] = backup_filepath
+        if backup_path is not None:
+            # Lets `cmc restore` find the work dirs again
+            restore.write_work_dirs(backup_path, self.backup_dict)
+        self.backup_pool = BackupPool(self.backup_dict)
+        self.backup_pool.start()
 
-    @logger.catch
-    def _glob_menus(self) -> None:
-        self.menu_list.clear()
-        menu_list: List[Tuple[Path, Path]] = []
-        for p in self.work_dirs:
-            for m in p.glob("**/*.menu"):
-                menu_list.append((p, m))
+    def _process_menu_and_pmat(self, is_cancelled: Callable[[], bool]) -> None:
+        # Any change of the shader config or the mapping invalidates the Menus which were left unchanged
+        self.menu_fingerprint = ScanManifest.fingerprint(
+            CMC_Config.shader_names,
+            CMC_Config.shader_families,
+            CMC_Config.config.menu_process_mode,
+            self.mate_name_dict,
+        )
+        known = (MENU_UNCHANGED, self.menu_fingerprint)
+        menu_list = [e for e in self.menu_list if self.manifest.lookup(e) != known]
+        if not self.mate_name_dict:
+            # No Mate was renamed, no Menu can change
+            menu_list = []
         self.menu_list = menu_list
-
-    def start_process_pmat(self) -> None:
-        if self.work_pool_thread is not None and not self.work_pool_thread.is_stopped():
-            logger.error(_("A Work Thread Pool is still running"))
-            self.send_message_callback(WorkCommand(WorkType.Finished))
-            return
-        if self.backup_thread is not None and not self.backup_thread.is_stopped():
-            logger.error(_("A Backup Thread is still running"))
-            self.backup_thread.stop()
-            self.send_message_callback(WorkCommand(WorkType.Finished))
-            return
-        if CMC_Config.config.pmat_check_mode == 2:
-            self.send_message_callback(WorkCommand(WorkType.Finished))
-            return
-        self.finish_counter = 0
-        logger.debug(_("Search for Pmat..."))
-        self._glob_pmats()
-        logger.info(_("[royal_blue1]Found {num} Pmat").format(num=len(self.pmat_list)))
-        if len(self.pmat_list) == 0:
-            self.send_message_callback(WorkCommand(WorkType.Finished))
+        self.total_counter += len(self.menu_list) + len(self.pmat_list)
+        stage_threads: List[WorkPoolThread] = []
+        if self.menu_list:
+            binary_replace: Optional[BinaryReplace] = None
+            if CMC_Config.config.menu_process_mode == 1:
+                # Built once here and shared by all workers
+                binary_replace = BinaryReplace(self.mate_name_dict)
+            context = StageContext.create(
+                WorkType.Menu, mate_name_dict=self.mate_name_dict, binary_replace=binary_replace
+            )
+            stage_threads.append(self._start_pool(tasks.process_menu, self.menu_list, context, self.merge_menu_result))
+            logger.info(_("Processing Menu..."))
+        if self.pmat_list:
+            context = StageContext.create(WorkType.Pmat, mate_pmat_set=self.mate_pmat_set)
+            stage_threads.append(self._start_pool(tasks.process_pmat, self.pmat_list, context, self.merge_pmat_result))
+            logger.info(_("Processing Pmat..."))
+        for t in stage_threads:
+            t.join()
+        if is_cancelled():
             return
-        if CMC_Config.config.backup:
-            self.backup_thread = BackupThread(self.backup_dict)
-            self.backup_thread.start()
-        self.work_pool_thread = WorkPoolThread(self.process_pmat, self.pmat_list, self.process_pmat_finish)
-        self.work_pool_thread.start()
-        logger.info(_("Processing Pmat..."))
+        self.merge_fixes()
+        logger.info(_("Skipped {num} Menu without NPR Mate").format(num=self.menu_skip_count))
+        self.manifest.save()
+        self.process_pmat_finish()
 
     @logger.catch
-    def process_pmat(self, pmat_p: Tuple[Path, Path]) -> None:
-        work_path, pmat_path = pmat_p
-        with pmat_path.open("rb") as f:
-            data = f.read()
-        try:
-            pmat = Pmat.parse(data)
-        except Exception:
-            self.counter_add()
-            self.pmat_pass_list.append(pmat_path)
-            logger.warning(_("Failed to Read Pmat: {filename}").format(filename=pmat_path.name))
-            return
-        changed = False
-        pmat_new_filepath: Optional[Path] = None
-        pmat_filename = pmat_path.stem
-        pmat_mat_name = pmat.material_name
-        if pmat_filename != pmat_mat_name:
-            if pmat_filename in self.mate_pmat_set and pmat_mat_name not in self.mate_pmat_set:
-                logger.info(_("[white]Detect Wrong [MatName] Pmat: {filename}").format(filename=pmat_path.name))
-                if CMC_Config.config.pmat_check_mode == 0:
-                    changed = True
-                    pmat.material_name = pmat_filename
-            elif pmat_filename not in self.mate_pmat_set and pmat_mat_name in self.mate_pmat_set:
-                logger.info(_("[white]Detect Wrong [FileName] Pmat: {filename}").format(filename=pmat_path.name))
-                if CMC_Config.config.pmat_check_mode == 0:
-                    changed = True
-                    pmat_new_filepath = pmat_path.parent / f"{pmat_mat_name}.pmat"
-            else:
-                logger.info(_("[white]Detect Pmat with Potential Error: {filename}").format(filename=pmat_path.name))
-        if changed:
-            if CMC_Config.config.backup and self.backup_thread is not None:
-                self.backup_thread.add_backup(work_path, pmat_path, data)
-            try:
-                new_data = pmat.build()
-                with pmat_path.open("wb") as f:
-                    f.write(new_data)
-                if pmat_new_filepath is not None:
-                    self.pmat_fname_change_list.append(pmat_path)
-                    pmat_path.rename(pmat_new_filepath)
-            except Exception:
-                self.pmat_pass_list.append(pmat_path)
-                logger.warning(_("Failed to Process Pmat: {filename}").format(filename=pmat_path.name))
-        self.counter_add()
-        self.send_message_callback(WorkProgress((self.finish_counter) / len(self.pmat_list) * 100))
+    def merge_menu_result(self, result: BatchResult) -> None:
+        with self.merge_lock:
+            self.menu_pass_list += result.pass_list
+            self.menu_skip_count += result.skipped
+            for entry, scan_result in result.scanned:
+                fingerprint = self.menu_fingerprint if scan_result == MENU_UNCHANGED else ""
+                self.manifest.update(entry, scan_result, fingerprint)
+            for fix in result.menu_fixes:
+                # Never overwritten before the original is queued for backup
+                if CMC_Config.config.backup and (
+                    self.backup_pool is None or not self.backup_pool.add_backup(fix.work_path, fix.path, fix.data)
+                ):
+                    self.menu_pass_list.append(fix.path)
+                    logger.warning(_("Failed to Process Menu: {filename}").format(filename=fix.path.name))
+                    continue
+                self.add_fix(fix)
+            self.merge_result(result)
+
+    @logger.catch
+    def merge_pmat_result(self, result: BatchResult) -> None:
+        with self.merge_lock:
+            self.pmat_pass_list += result.pass_list
+            for entry, scan_result in result.scanned:
+                self.manifest.update(entry, scan_result)
+            for fix in result.pmat_fixes:
+                if CMC_Config.config.backup and (
+                    self.backup_pool is None or not self.backup_pool.add_backup(fix.work_path, fix.path, fix.data)
+                ):
+                    self.pmat_pass_list.append(fix.path)
+                    logger.warning(_("Failed to Process Pmat: {filename}").format(filename=fix.path.name))
+                    continue
+                self.add_fix(fix)
+            self.merge_result(result)
 
     @logger.catch
     def process_pmat_finish(self) -> None:
         logger.debug(_("Process Pmat Finished"))
-        if self.backup_thread is not None:
-            self.backup_thread.stop()
-            while self.backup_thread.is_alive():
-                time.sleep(0.1)
-            logger.debug(_("Backup Pmat Finished"))
         if CMC_Config.config.backup and self.pmat_fname_change_list:
             if lst := list(self.backup_dict.values()):
                 backup_folder = lst[0].parent
@@ -452,13 +536,3 @@ class WorkManager:
                 with backup_path.open("w", encoding="utf-8") as f:
                     for p in self.pmat_fname_change_list:
                         f.write(f"{p.as_posix()}\n")
-        self.send_message_callback(WorkCommand(WorkType.Finished))
-
-    @logger.catch
-    def _glob_pmats(self) -> None:
-        self.pmat_list.clear()
-        pmat_list: List[Tuple[Path, Path]] = []
-        for p in self.work_dirs:
-            for m in p.glob("**/*.pmat"):
-                pmat_list.append((p, m))
-        self.pmat_list = pmat_list
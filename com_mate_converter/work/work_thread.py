@@ -1,101 +1,353 @@
+import functools
 import multiprocessing
-import sys
+import os
+import tempfile
+import threading
 import time
-from io import BytesIO
 from multiprocessing.dummy import Pool as ThreadPool
 from pathlib import Path
 from queue import Queue
 from threading import Thread
-from types import FrameType
-from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+from typing import IO, Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple, Union
 
-import py7zr
 from loguru import logger
 
-from com_mate_converter import CMC_Config
+from com_mate_converter import CMC_Config, _
+
+from . import tasks
+from .backup import BackupWriter, get_backup_backend
+from .inventory import FileEntry
+
+
+class CancelToken:
+    _event: threading.Event
+
+    def __init__(self) -> None:
+        self._event = threading.Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+class ByteBudget:
+    """Bytes of data held in memory by the queues of a stage, like the backups of all work dirs of a `BackupPool`."""
+
+    limit: int
+    used: int = 0
+    peak: int = 0
+    _closed: bool = False
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self._lock = threading.Condition()
+
+    def try_acquire(self, size: int) -> bool:
+        with self._lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def acquire(self, size: int) -> bool:
+        """Wait until `size` fits, more than the limit is let through when nothing is held. False once closed."""
+        with self._lock:
+            while self.used > 0 and self.used + size > self.limit and not self._closed:
+                self._lock.wait()
+            if self._closed:
+                return False
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, size: int) -> None:
+        with self._lock:
+            self.used -= size
+            self._lock.notify_all()
+
+    def close(self) -> None:
+        """Wake up and fail everyone waiting in `acquire`, and all later calls."""
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+
+class SpillFile:
+    """Originals that do not fit in the memory budget, kept in a temp file in the backup folder until written."""
+
+    folder: Path
+    spilled_num: int = 0
+    spilled_size: int = 0
+
+    def __init__(self, folder: Path) -> None:
+        self.folder = folder
+        self._file: Optional[IO[bytes]] = None
+        self._lock = threading.Lock()
+
+    def write(self, data: bytes) -> int:
+        with self._lock:
+            if self._file is None:
+                self._file = tempfile.TemporaryFile(prefix="spill_", suffix=".tmp", dir=self.folder)
+            offset = self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            self.spilled_num += 1
+            self.spilled_size += len(data)
+            return offset
+
+    def read(self, offset: int, size: int) -> bytes:
+        with self._lock:
+            assert self._file is not None
+            self._file.seek(offset)
+            return self._file.read(size)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
 
 
 class BackupThread(Thread):
-    backup_queue: Queue
-    back_files: Dict[Path, py7zr.SevenZipFile]
+    """Write the queued backups of one work dir, until `stop` and everything queued before it is written.
+
+    Originals are queued in memory while the `ByteBudget` allows it, otherwise they are spilled to disk.
+    Everything queued belongs to a file which is about to be renamed or overwritten, so it is always written,
+    even when the work is killed.
+    """
+
+    work_path: Path
+    back_path: Path
+    # (file_path, data or None when spilled, spill offset, size)
+    backup_queue: "Queue[Optional[Tuple[Path, Optional[bytes], int, int]]]"
+    budget: ByteBudget
+    spill_file: SpillFile
+    link_writer: Optional[BackupWriter]
     _stopped_flag: bool = False
-    _killed_flag: bool = False
 
-    def __init__(self, back_paths: Dict[Path, Path]) -> None:
+    def __init__(self, work_path: Path, back_path: Path, budget: Optional[ByteBudget] = None) -> None:
         super().__init__()
+        self.work_path = work_path
+        self.back_path = back_path
         self.backup_queue = Queue()
-        self.back_files = {}
-        for k, v in back_paths.items():
-            if v.exists():
-                self.back_files[k] = py7zr.SevenZipFile(v, "a")
-                self.back_files[k]
+        self.budget = budget or ByteBudget(CMC_Config.config.backup_memory_limit << 20)
+        self.spill_file = SpillFile(back_path.parent)
+        # Nothing is queued after the sentinel
+        self._lock = threading.Lock()
+        backend = get_backup_backend(CMC_Config.config)
+        # Files that are replaced rather than written in place are linked right away, before they are replaced
+        self.link_writer = None
+        if backend.link_file is not BackupWriter.link_file:
+            self.link_writer = backend(back_path, CMC_Config.config)
+
+    @logger.catch
+    def run(self) -> None:
+        back_file: Optional[BackupWriter] = None
+        try:
+            # None is the sentinel put by `stop` and `kill`
+            while (t := self.backup_queue.get()) is not None:
+                if back_file is None:
+                    # Opened on the first file, a work dir with nothing to back up gets no backup
+                    b_name = f"{self.back_path.parent.name}/{self.back_path.name}"
+                    logger.info(_('Backuping to "{b_name}"').format(b_name=b_name))
+                    back_file = get_backup_backend(CMC_Config.config)(self.back_path, CMC_Config.config)
+                file_path, data, offset, size = t
+                if data is None:
+                    data = self.spill_file.read(offset, size)
+                else:
+                    self.budget.release(size)
+                back_file.write_data(data, str(file_path.relative_to(self.work_path.parent)))
+        finally:
+            if back_file is not None:
+                back_file.close()
+            self.spill_file.close()
+
+    def add_backup(self, file_path: Path, data: bytes, link: bool = False) -> bool:
+        """Queue the original of a file, False once stopped."""
+        with self._lock:
+            if self._stopped_flag:
+                return False
+            if link and self.link_writer is not None:
+                if self.link_writer.link_file(file_path, str(file_path.relative_to(self.work_path.parent))):
+                    return True
+            if self.budget.try_acquire(len(data)):
+                self.backup_queue.put_nowait((file_path, data, 0, len(data)))
             else:
-                self.back_files[k] = py7zr.SevenZipFile(v, "w")
+                self.backup_queue.put_nowait((file_path, None, self.spill_file.write(data), len(data)))
+            return True
+
+    def stop(self) -> None:
+        """Accept no more backups, those already queued are still written."""
+        with self._lock:
+            if not self._stopped_flag:
+                self._stopped_flag = True
+                self.backup_queue.put_nowait(None)
+
+    def is_stopped(self) -> bool:
+        return self._stopped_flag
+
+    def kill(self) -> None:
+        # The originals already queued belong to files which are renamed or overwritten, they are drained too
+        self.stop()
+
+
+class BackupPool:
+    """One `BackupThread` per work dir, backups are routed by `work_path`.
+
+    The threads share one memory budget (`Config.backup_memory_limit` in MiB).
+    """
+
+    threads: Dict[Path, BackupThread]
+    budget: ByteBudget
+
+    def __init__(self, back_paths: Dict[Path, Path]) -> None:
+        self.budget = ByteBudget(CMC_Config.config.backup_memory_limit << 20)
+        self.threads = {k: BackupThread(k, v, self.budget) for k, v in back_paths.items()}
+        logger.debug(_("Backup memory limit: {limit} MiB").format(limit=CMC_Config.config.backup_memory_limit))
 
     def start(self) -> None:
-        self.__run_backup = self.run
-        self.run = self.__run
-        Thread.start(self)
+        for t in self.threads.values():
+            t.start()
+
+    @logger.catch
+    def add_backup(self, work_path: Path, file_path: Path, data: bytes, link: bool = False) -> bool:
+        """Queue the original of a file, False if it could not be queued.
+
+        With `link`, the file must be replaced rather than written in place afterwards.
+        """
+        if (t := self.threads.get(work_path)) is None:
+            return False
+        return t.add_backup(file_path, data, link)
+
+    def stop(self) -> None:
+        for t in self.threads.values():
+            t.stop()
+
+    def join(self) -> None:
+        for t in self.threads.values():
+            t.join()
+        logger.debug(
+            _("Backup queue peak: {peak:.1f} MiB, spilled {num} files ({size:.1f} MiB)").format(
+                peak=self.budget.peak / (1 << 20),
+                num=sum(t.spill_file.spilled_num for t in self.threads.values()),
+                size=sum(t.spill_file.spilled_size for t in self.threads.values()) / (1 << 20),
+            )
+        )
+
+    def is_alive(self) -> bool:
+        return any(t.is_alive() for t in self.threads.values())
+
+    def kill(self) -> None:
+        for t in self.threads.values():
+            t.kill()
+
 
-    def __run(self) -> None:
-        sys.settrace(self.globaltrace)
-        self.__run_backup()
-        self.run = self.__run_backup
+class ReadAheadThread(Thread):
+    """Read the files of the batches in dispatch order, ahead of the workers while the `ByteBudget` allows it.
+
+    The batches come out of `read_queue` with the content of their files, until None. The budget is released
+    by the consumer once a batch is done (`BatchResult.size`).
+    """
+
+    # (entry, data or None when it could not be read) of each file of a batch
+    read_queue: "Queue[Optional[List[Tuple[FileEntry, Optional[bytes]]]]]"
+    budget: ByteBudget
+
+    def __init__(self, batches: List[List[FileEntry]], budget: ByteBudget) -> None:
+        super().__init__(daemon=True)
+        self._batches = batches
+        self.read_queue = Queue()
+        self.budget = budget
 
     @logger.catch
     def run(self) -> None:
         try:
-            _final_empty = False
-            while not self._stopped_flag or not _final_empty:
-                while not self.backup_queue.empty():
-                    t: Tuple[Path, Path, bytes] = self.backup_queue.get_nowait()
-                    if len(t) == 3:
-                        work_path, file_path, data = t
-                        if work_path in self.back_files:
-                            self.back_files[work_path].writef(
-                                BytesIO(data), str(file_path.relative_to(work_path.parent))
-                            )
-                time.sleep(0.1)
-                if self._stopped_flag and self.backup_queue.empty():
-                    _final_empty = True
+            for batch in self._batches:
+                # Closed by `stop`
+                if not self.budget.acquire(sum(e.size for e in batch)):
+                    return
+                self.read_queue.put_nowait([(e, tasks.read_file(e.path_str)) for e in batch])
         finally:
-            self.finish_backup()
+            self.read_queue.put_nowait(None)
 
-    @logger.catch
-    def add_backup(self, work_path: Path, file_path: Path, data: bytes) -> None:
-        self.backup_queue.put_nowait((work_path, file_path, data))
-
-    def finish_backup(self) -> None:
-        for f in self.back_files.values():
-            f.close()
-        self.back_files.clear()
+    def batches(self) -> Iterable[List[Tuple[FileEntry, Optional[bytes]]]]:
+        return iter(self.read_queue.get, None)
 
     def stop(self) -> None:
-        self._stopped_flag = True
+        self.budget.close()
 
-    def is_stopped(self) -> bool:
-        return self._stopped_flag
 
-    def globaltrace(self, frame: FrameType, event: str, arg: Any) -> Any:
-        if event == "call":
-            return self.localtrace
-        else:
-            return None
+class WriteBehindThread(Thread):
+    """Apply the fixes of all stages in the order they are queued, the workers never wait for the disk.
+
+    Fixes are queued while the `ByteBudget` (`Config.write_behind_limit` in MiB) allows it, `add_fix` waits
+    otherwise. The outcome of each fix is collected with `flush`.
+    """
+
+    fix_queue: "Queue[Optional[tasks.Fix]]"
+    budget: ByteBudget
+    cancel_token: CancelToken
+    _stopped_flag: bool = False
 
-    def localtrace(self, frame: FrameType, event: str, arg: Any) -> Any:
-        if self._killed_flag:
-            if event == "line":
-                raise SystemExit()
-        return self.localtrace
+    def __init__(self, cancel_token: Optional[CancelToken] = None) -> None:
+        super().__init__()
+        self.fix_queue = Queue()
+        self.budget = ByteBudget(CMC_Config.config.write_behind_limit << 20)
+        self.cancel_token = cancel_token or CancelToken()
+        self._lock = threading.Lock()
+        self._applied: List[tasks.Fix] = []
+        self._failed: List[tasks.Fix] = []
+
+    @logger.catch
+    def run(self) -> None:
+        # None is the sentinel put by `stop` and `kill`
+        while (fix := self.fix_queue.get()) is not None:
+            try:
+                if not self.cancel_token.is_cancelled():
+                    try:
+                        fix.apply()
+                        with self._lock:
+                            self._applied.append(fix)
+                    except Exception:
+                        with self._lock:
+                            self._failed.append(fix)
+            finally:
+                self.budget.release(len(fix.new_data))
+                self.fix_queue.task_done()
+        self.fix_queue.task_done()
+
+    def add_fix(self, fix: tasks.Fix) -> bool:
+        """Queue a fix, False if it was dropped because the thread is stopped."""
+        if self._stopped_flag or not self.budget.acquire(len(fix.new_data)):
+            return False
+        self.fix_queue.put_nowait(fix)
+        return True
+
+    def flush(self) -> Tuple[List[tasks.Fix], List[tasks.Fix]]:
+        """Wait for everything queued so far, return the fixes applied and failed since the last flush."""
+        self.fix_queue.join()
+        with self._lock:
+            applied, self._applied = self._applied, []
+            failed, self._failed = self._failed, []
+        return applied, failed
+
+    def stop(self) -> None:
+        if not self._stopped_flag:
+            self._stopped_flag = True
+            self.fix_queue.put_nowait(None)
 
     def kill(self) -> None:
-        self._killed_flag = True
+        self.cancel_token.cancel()
+        self.budget.close()
+        self.stop()
 
 
 class WorkThread(Thread):
     finish_callback: Optional[Callable[[], None]]
+    cancel_token: CancelToken
     _stopped_flag: bool = False
-    _killed_flag: bool = False
 
     def __init__(
         self,
@@ -103,25 +355,17 @@ class WorkThread(Thread):
         args: Iterable[Any] = ...,
         kwargs: Optional[Mapping[str, Any]] = None,
         finish_callback: Optional[Callable[[], None]] = None,
+        cancel_token: Optional[CancelToken] = None,
     ) -> None:
         super().__init__(target=target, args=args, kwargs=kwargs)
         self.finish_callback = finish_callback
-
-    def start(self) -> None:
-        self.__run_backup = self.run
-        self.run = self.__run
-        Thread.start(self)
-
-    def __run(self) -> None:
-        sys.settrace(self.globaltrace)
-        self.__run_backup()
-        self.run = self.__run_backup
+        self.cancel_token = cancel_token or CancelToken()
 
     def run(self) -> None:
         try:
             if self._target:  # type: ignore
                 self._target(*self._args, **self._kwargs, check_stop=self.is_stopped)  # type: ignore
-                if not self._stopped_flag:
+                if not self._stopped_flag and not self.cancel_token.is_cancelled():
                     if self.finish_callback is not None:
                         self.finish_callback()
                     self._stopped_flag = True
@@ -132,89 +376,260 @@ class WorkThread(Thread):
         self._stopped_flag = True
 
     def is_stopped(self) -> bool:
-        return self._stopped_flag
-
-    def globaltrace(self, frame: FrameType, event: str, arg: Any) -> Any:
-        if event == "call":
-            return self.localtrace
-        else:
-            return None
-
-    def localtrace(self, frame: FrameType, event: str, arg: Any) -> Any:
-        if self._killed_flag:
-            if event == "line":
-                raise SystemExit()
-        return self.localtrace
+        return self._stopped_flag or self.cancel_token.is_cancelled()
 
     def kill(self) -> None:
-        self._killed_flag = True
+        self.cancel_token.cancel()
+
+
+# Most files in a batch when `Config.chunk_size` is 0
+MAX_CHUNK_SIZE = 64
+# Most threads of an IO bound stage with `Config.auto_workers`
+MAX_IO_WORKERS = 32
+
+
+class ConcurrencyTuner:
+    """Hill-climb the number of batches running at once on the throughput in bytes per second.
+
+    Each count is measured over a window of files, the next one tried is a neighbour of the fastest so far,
+    until both neighbours are slower or `CALIBRATION_FILES` files are done. The fastest one is kept for the
+    rest of the stage.
+    """
+
+    WINDOW_FILES = 32
+    CALIBRATION_FILES = 300
+    concurrency: int
+    max_workers: int
+    calibrating: bool
+    # Concurrency -> bytes per second
+    rates: Dict[int, float]
+
+    def __init__(self, start: int, max_workers: int) -> None:
+        self.max_workers = max_workers
+        self.concurrency = min(max(start, 1), max_workers)
+        self.calibrating = max_workers > 1
+        self.rates = {}
+        self._direction = 1
+        self._done_files = 0
+        # The first window also measures the start of the pool, it is not compared
+        self._warmup = True
+        self._reset_window()
+
+    def _reset_window(self) -> None:
+        self._window_start = time.perf_counter()
+        self._window_bytes = 0
+        self._window_files = 0
+
+    def record(self, size: int, files: int) -> None:
+        """Account a finished batch."""
+        self._done_files += files
+        if not self.calibrating:
+            return
+        self._window_bytes += size
+        self._window_files += files
+        if self._window_files < ConcurrencyTuner.WINDOW_FILES:
+            return
+        if self._warmup:
+            self._warmup = False
+        else:
+            self.rates[self.concurrency] = self._window_bytes / max(time.perf_counter() - self._window_start, 1e-9)
+            self._step()
+        self._reset_window()
+
+    def _step(self) -> None:
+        best = max(self.rates, key=self.rates.__getitem__)
+        if self._done_files < ConcurrencyTuner.CALIBRATION_FILES:
+            # Keep going the same way from the fastest one, turn around once
+            for candidate in (best + self._direction, best - self._direction):
+                if 1 <= candidate <= self.max_workers and candidate not in self.rates:
+                    self._direction = candidate - best
+                    self.concurrency = candidate
+                    return
+        self.concurrency = best
+        self.calibrating = False
 
 
 class WorkPoolThread(Thread):
-    finish_callback: Optional[Callable[[], None]]
+    """Run a task over file entries in batches on a thread or process pool (`Config.pool_mode`).
+
+    Batch results are handed to `result_callback` in this thread, one at a time.
+    An IO bound stage always runs on threads, next to the CPU bound one, and its task reads the files itself.
+    The task of a CPU bound stage is a `tasks.BufferTask`, it gets the files read by a `ReadAheadThread`
+    (`Config.read_ahead_limit` in MiB).
+    """
+
+    result_callback: Callable[[tasks.BatchResult], None]
+    cancel_token: CancelToken
+    # Most files in a batch and the number of batches
+    chunk_size: int
+    chunk_num: int
+    # Key of the stage in `Config.worker_nums`, the pools of a stage differ between threads and processes
+    stage_key: str
+    # With `Config.auto_workers`, the pool has `max_workers` and the tuner decides how many are busy
+    tuner: Optional[ConcurrencyTuner] = None
+    read_ahead: Optional[ReadAheadThread] = None
+    # Batches read ahead until they are done, by `BatchResult.batch_key`
+    _read_batches: Dict[str, List[Tuple[FileEntry, Optional[bytes]]]]
     _stopped_flag: bool = False
-    _killed_flag: bool = False
 
     def __init__(
         self,
-        target: Optional[Callable[..., object]] = ...,
-        args: List[Any] = ...,
-        finish_callback: Optional[Callable[[], None]] = None,
+        target: Union[tasks.Task, tasks.BufferTask],
+        args: List[FileEntry],
+        context: tasks.StageContext,
+        result_callback: Callable[[tasks.BatchResult], None],
+        cancel_token: Optional[CancelToken] = None,
+        io_bound: bool = False,
+        worker_nums: Optional[Dict[str, int]] = None,
     ) -> None:
-        super().__init__(target=target)
-        self._args = args
-        self.pool = ThreadPool(max(int(multiprocessing.cpu_count() * CMC_Config.config.cpu_percent), 1))
-        self.finish_callback = finish_callback
-
-    def _target_warpper(self, *args) -> Any:
-        if self._stopped_flag:
-            return None
-        return self._target(*args)  # type: ignore
-
-    def _target_run_in_pool(self) -> List:
-        results = self.pool.map(self._target_warpper, self._args)
-        self.pool.close()
-        self.pool.join()
-        return results
-
-    def start(self) -> None:
-        self.__run_backup = self.run
-        self.run = self.__run
-        Thread.start(self)
-
-    def __run(self) -> None:
-        sys.settrace(self.globaltrace)
-        self.__run_backup()
-        self.run = self.__run_backup
+        super().__init__()
+        self._task = target
+        self._work_type = context.work_type
+        use_processes = CMC_Config.config.pool_mode == 1 and not io_bound
+        self.stage_key = context.work_type.name.lower() + ("_process" if use_processes else "")
+        processes = CMC_Config.get_worker_num()
+        if CMC_Config.config.auto_workers and CMC_Config.worker_num is None:
+            cpu_count = os.cpu_count() or 1
+            max_workers = min(cpu_count * 4, MAX_IO_WORKERS) if io_bound else cpu_count
+            self.tuner = ConcurrencyTuner((worker_nums or {}).get(self.stage_key, processes), max_workers)
+            processes = max_workers
+        self._processes = processes
+        self.chunk_size = CMC_Config.config.chunk_size if CMC_Config.config.chunk_size > 0 else MAX_CHUNK_SIZE
+        self._batches = self.schedule_batches(args, processes, self.chunk_size)
+        self.chunk_num = len(self._batches)
+        if not io_bound:
+            self.read_ahead = ReadAheadThread(self._batches, ByteBudget(CMC_Config.config.read_ahead_limit << 20))
+        self._read_batches = {}
+        self.result_callback = result_callback
+        self.cancel_token = cancel_token or CancelToken()
+        if use_processes:
+            mp_context = multiprocessing.get_context("spawn")
+            self._cancel_event = mp_context.Event()
+            self.pool = mp_context.Pool(
+                processes, initializer=tasks.init_worker, initargs=(context, self._cancel_event)
+            )
+        else:
+            self._cancel_event = threading.Event()
+            tasks.init_worker(context, self._cancel_event)
+            self.pool = ThreadPool(processes)
+
+    @staticmethod
+    def schedule_batches(args: List[FileEntry], processes: int, chunk_size: int = 0) -> List[List[FileEntry]]:
+        """Batches in dispatch order, largest first.
+
+        Files bigger than the first batch go alone ahead of the others, the rest are kept in (dir, inode)
+        order so that a worker reads neighbouring files. Each batch gets a share of the bytes left
+        (guided self-scheduling), so the batches shrink towards the end and even out the workers.
+        """
+        max_files = chunk_size if chunk_size > 0 else MAX_CHUNK_SIZE
+        sizes = [max(e.size, 1) for e in args]
+        remaining = sum(sizes)
+        first_share = remaining // (processes * 4)
+        big = [i for i, size in enumerate(sizes) if size > first_share]
+        big.sort(key=sizes.__getitem__, reverse=True)
+        batches = [[args[i]] for i in big]
+        remaining -= sum(sizes[i] for i in big)
+        big_set = set(big)
+        rest = sorted((os.path.dirname(e.path_str), e.inode, i) for i, e in enumerate(args) if i not in big_set)
+        batch: List[FileEntry] = []
+        batch_bytes = 0
+        share = max(remaining // (processes * 4), 1)
+        for _dir, _inode, i in rest:
+            batch.append(args[i])
+            batch_bytes += sizes[i]
+            if batch_bytes >= share or len(batch) >= max_files:
+                batches.append(batch)
+                remaining -= batch_bytes
+                batch = []
+                batch_bytes = 0
+                share = max(remaining // (processes * 4), 1)
+        if batch:
+            batches.append(batch)
+        return batches
 
     def run(self) -> None:
         try:
-            if self._target:  # type: ignore
-                self._target_run_in_pool()
-                if not self._stopped_flag:
-                    if self.finish_callback is not None:
-                        self.finish_callback()
-                    self._stopped_flag = True
+            batches: Iterable[List[Any]]
+            if self.read_ahead is None:
+                run_batch = functools.partial(tasks.run_batch, self._task, self._work_type)
+                batches = self._batches
+            else:
+                run_batch = functools.partial(tasks.run_buffer_batch, self._task, self._work_type)
+                self.read_ahead.start()
+                batches = self._hold_read_batches(self.read_ahead.batches())
+            if self.tuner is None:
+                results: Iterable[tasks.BatchResult] = self.pool.imap_unordered(run_batch, batches)
+            else:
+                results = self._run_tuned(run_batch, batches, self.tuner)
+            for result in results:
+                if self.cancel_token.is_cancelled():
+                    self._cancel_event.set()
+                if self.read_ahead is not None:
+                    self._pair_originals(result)
+                self.result_callback(result)
+                if self.read_ahead is not None:
+                    self.read_ahead.budget.release(result.size)
+            self.pool.close()
+            self.pool.join()
         finally:
-            del self._target, self._args  # type: ignore
+            if self.read_ahead is not None:
+                self.read_ahead.stop()
+            self.pool.terminate()
+            del self._task, self._batches
+
+    def _hold_read_batches(
+        self, batches: Iterable[List[Tuple[FileEntry, Optional[bytes]]]]
+    ) -> Iterable[List[Tuple[FileEntry, Optional[bytes]]]]:
+        for batch in batches:
+            self._read_batches[batch[0][0].path_str] = batch
+            yield batch
+
+    def _pair_originals(self, result: tasks.BatchResult) -> None:
+        """Give the fixes of a batch the originals read ahead, a worker does not send them back."""
+        originals = {e.path: data for e, data in self._read_batches.pop(result.batch_key) if data is not None}
+        for fixes in (result.mate_fixes, result.menu_fixes, result.pmat_fixes):
+            for fix in fixes:
+                fix.data = originals[fix.path]
+
+    @property
+    def worker_num(self) -> int:
+        """Workers busy at once, the one settled on so far with `Config.auto_workers`."""
+        return self.tuner.concurrency if self.tuner is not None else self._processes
+
+    def _run_tuned(
+        self,
+        run_batch: Callable[[List[Any]], tasks.BatchResult],
+        batches: Iterable[List[Any]],
+        tuner: ConcurrencyTuner,
+    ) -> Iterable[tasks.BatchResult]:
+        """Like `imap_unordered`, but only `tuner.concurrency` batches are in the pool at once."""
+        done: "Queue[Any]" = Queue()
+        batch_iter = iter(batches)
+        running = 0
+        while True:
+            while running < tuner.concurrency and (batch := next(batch_iter, None)) is not None:
+                self.pool.apply_async(run_batch, (batch,), callback=done.put, error_callback=done.put)
+                running += 1
+            if running == 0:
+                return
+            result = done.get()
+            running -= 1
+            if isinstance(result, BaseException):
+                raise result
+            tuner.record(result.size, result.done)
+            yield result
 
     def stop(self) -> None:
         self._stopped_flag = True
+        self._cancel_event.set()
+        if self.read_ahead is not None:
+            self.read_ahead.stop()
 
     def is_stopped(self) -> bool:
-        return self._stopped_flag
-
-    def globaltrace(self, frame: FrameType, event: str, arg: Any) -> Any:
-        if event == "call":
-            return self.localtrace
-        else:
-            return None
-
-    def localtrace(self, frame: FrameType, event: str, arg: Any) -> Any:
-        if self._killed_flag:
-            if event == "line":
-                raise SystemExit()
-        return self.localtrace
+        return self._stopped_flag or self.cancel_token.is_cancelled()
 
     def kill(self) -> None:
-        self._killed_flag = True
+        self.cancel_token.cancel()
+        self._cancel_event.set()
+        if self.read_ahead is not None:
+            self.read_ahead.stop()
@@ -0,0 +1,578 @@
+import argparse
+import dataclasses
+import heapq
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+from types import FrameType
+from typing import Any, Callable, Dict, List
+
+import regex
+
+from com_mate_converter.config import CMC_Config
+from com_mate_converter.model import Mate, Menu, Pmat
+from com_mate_converter.model.base import build_com_str
+from com_mate_converter.model.format import FormatVariable, MateFormat
+from com_mate_converter.model.mate import (
+    BaseProperty,
+    ColorProperty,
+    EndProperty,
+    FloatProperty,
+    MateCodec,
+    TexProperty,
+    VectorProperty,
+)
+from com_mate_converter.utils.construct_classes import Struct
+from com_mate_converter.work import WorkManager, tasks
+from com_mate_converter.work.binary_replace import BinaryReplace, decode_com_str
+from com_mate_converter.work.inventory import FileEntry, Inventory
+from com_mate_converter.work.tasks import MenuFix
+from com_mate_converter.work.work_thread import (
+    BackupThread,
+    ByteBudget,
+    ReadAheadThread,
+    WorkPoolThread,
+    WriteBehindThread,
+)
+from tests import resouce_path
+
+with open(resouce_path / "template_NPRMAT_NPRToonV2_Emissiv_Trans_.mate", "rb") as f:
+    template_mate_data = f.read()
+
+with open(resouce_path / "template.menu", "rb") as f:
+    template_menu_data = f.read()
+
+benchmarks: Dict[str, Callable[[int], None]] = {}
+
+
+def benchmark(func: Callable[[int], None]) -> Callable[[int], None]:
+    benchmarks[func.__name__.replace("bench_", "")] = func
+    return func
+
+
+def run_in_thread(func: Callable[[], Any], trace: Any = None) -> float:
+    def target() -> None:
+        if trace is not None:
+            sys.settrace(trace)
+        func()
+
+    start = time.perf_counter()
+    thread = Thread(target=target)
+    thread.start()
+    thread.join()
+    return time.perf_counter() - start
+
+
+def report(name: str, seconds: float, num: int) -> None:
+    print(f"  {name:<32} {seconds:8.3f} s  {seconds / num * 1e6:10.2f} us/op")  # noqa: T201
+
+
+class LegacyKillTrace:
+    # The per-line trace hook the worker threads used to install as a kill switch
+    _killed_flag: bool = False
+
+    def globaltrace(self, frame: FrameType, event: str, arg: Any) -> Any:
+        if event == "call":
+            return self.localtrace
+        return None
+
+    def localtrace(self, frame: FrameType, event: str, arg: Any) -> Any:
+        if self._killed_flag:
+            if event == "line":
+                raise SystemExit()
+        return self.localtrace
+
+
+class LegacyPollingBackupThread(Thread):
+    # The backup loop and the stage handoff used to check every 0.1s
+    def __init__(self) -> None:
+        super().__init__()
+        self.backup_queue: Queue = Queue()
+        self._stopped_flag = False
+
+    def run(self) -> None:
+        _final_empty = False
+        while not self._stopped_flag or not _final_empty:
+            while not self.backup_queue.empty():
+                self.backup_queue.get_nowait()
+            time.sleep(0.1)
+            if self._stopped_flag and self.backup_queue.empty():
+                _final_empty = True
+
+    def stop(self) -> None:
+        self._stopped_flag = True
+
+
+@benchmark
+def bench_cancellation(num: int) -> None:
+    def work() -> None:
+        for _ in range(num):
+            Mate.parse(template_mate_data).build()
+            Menu.parse(template_menu_data).build()
+
+    legacy = run_in_thread(work, LegacyKillTrace().globaltrace)
+    cooperative = run_in_thread(work)
+    report("settrace kill switch", legacy, num)
+    report("cooperative cancel token", cooperative, num)
+    print(f"  speedup: {legacy / cooperative:.2f}x")  # noqa: T201
+
+
+@benchmark
+def bench_stage_handoff(num: int) -> None:
+    # Sleep-polling costs up to 0.1s per boundary, so it runs fewer rounds
+    legacy_num = min(num, 20)
+    work_path = Path("mods")
+
+    def legacy() -> None:
+        for _ in range(legacy_num):
+            backup_thread = LegacyPollingBackupThread()
+            backup_thread.start()
+            backup_thread.backup_queue.put_nowait((work_path, work_path / "a.menu", b""))
+            backup_thread.stop()
+            while backup_thread.is_alive():
+                time.sleep(0.1)
+
+    def event_driven() -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            for i in range(num):
+                backup_thread = BackupThread(work_path, Path(tmp) / str(i))
+                backup_thread.start()
+                backup_thread.add_backup(work_path / "a.menu", b"")
+                backup_thread.stop()
+                backup_thread.join()
+
+    legacy_seconds = run_in_thread(legacy)
+    # The plain folder backend, so that only the handoff is measured
+    config = CMC_Config.config
+    CMC_Config.config = dataclasses.replace(config, backup_backend="copy")
+    try:
+        event_seconds = run_in_thread(event_driven)
+    finally:
+        CMC_Config.config = config
+    report("sleep-polling handoff", legacy_seconds, legacy_num)
+    report("queue sentinel + join handoff", event_seconds, num)
+    print(f"  speedup: {legacy_seconds / legacy_num / (event_seconds / num):.0f}x per boundary")  # noqa: T201
+
+
+@benchmark
+def bench_mate_codec(num: int) -> None:
+    mate = Mate.parse(template_mate_data)
+
+    def construct_parse() -> None:
+        for _ in range(num):
+            Mate.from_parsed(Mate.SUBCON_COMPILED.parse(template_mate_data))  # type: ignore
+
+    def construct_build() -> None:
+        for _ in range(num):
+            Mate.SUBCON_COMPILED.build(dataclasses.asdict(mate))  # type: ignore
+
+    def codec_decode() -> None:
+        for _ in range(num):
+            MateCodec.decode(template_mate_data)
+
+    def codec_encode() -> None:
+        for _ in range(num):
+            MateCodec.encode(mate)
+
+    report("construct parse", run_in_thread(construct_parse), num)
+    report("MateCodec.decode", run_in_thread(codec_decode), num)
+    report("construct build", run_in_thread(construct_build), num)
+    report("MateCodec.encode", run_in_thread(codec_encode), num)
+
+
+def legacy_from_parsed(cls: Any, data: Any) -> Any:
+    # The reflective Struct.from_parsed used before the converters were generated per class
+    if cls is BaseProperty:
+        cls = {"tex": TexProperty, "col": ColorProperty, "vec": VectorProperty, "f": FloatProperty}.get(
+            data.get("prop_type"), EndProperty
+        )
+    args = {}
+    for field in dataclasses.fields(cls):
+        field_data = data.get(field.name)
+        subcls = field.metadata.get("substruct")
+        if isinstance(subcls, dict):
+            subcls = subcls.get(data.get(field.metadata.get("substruct_dist_field")))
+        if subcls is None:
+            args[field.name] = field_data
+        elif isinstance(field_data, list):
+            args[field.name] = [legacy_from_parsed(subcls, d) for d in field_data]
+        elif field_data is not None:
+            args[field.name] = legacy_from_parsed(subcls, field_data)
+    for key in args:
+        args[key] = Struct._decontainerize(args[key])
+    return cls(**args)
+
+
+@benchmark
+def bench_struct_convert(num: int) -> None:
+    parsed = Mate.SUBCON_COMPILED.parse(template_mate_data)  # type: ignore
+    mate = Mate.from_parsed(parsed)
+    assert legacy_from_parsed(Mate, parsed) == mate
+    assert mate.to_dict() == dataclasses.asdict(mate)
+
+    def count_structs(obj: Any) -> int:
+        if isinstance(obj, list):
+            return sum(count_structs(i) for i in obj)
+        if isinstance(obj, Struct):
+            return 1 + sum(count_structs(getattr(obj, f.name)) for f in dataclasses.fields(obj))
+        return 0
+
+    struct_num = num * count_structs(mate)
+
+    def legacy_parse() -> None:
+        for _ in range(num):
+            legacy_from_parsed(Mate, parsed)
+
+    def generated_parse() -> None:
+        for _ in range(num):
+            Mate.from_parsed(parsed)
+
+    def legacy_build() -> None:
+        for _ in range(num):
+            dataclasses.asdict(mate)
+
+    def generated_build() -> None:
+        for _ in range(num):
+            mate.to_dict()
+
+    report("reflective from_parsed", run_in_thread(legacy_parse), struct_num)
+    report("generated from_parsed", run_in_thread(generated_parse), struct_num)
+    report("dataclasses.asdict", run_in_thread(legacy_build), struct_num)
+    report("generated to_dict", run_in_thread(generated_build), struct_num)
+    print(f"  us/op is per Struct, {struct_num // num} Structs in the Mate")  # noqa: T201
+
+
+@benchmark
+def bench_menu_rewrite(num: int) -> None:
+    menu = Menu.parse(template_menu_data)
+    for i in range(4):
+        menu.add_command(["マテリアル変更", "wear", str(i), f"Test_{i}_NPRMAT_NPRToonV2_Emissiv_Trans_.mate"])
+    data = menu.build()
+    mate_name_dict = {f"test_{i}_nprmat_nprtoonv2_emissiv_trans_.mate": f"Test_{i}_npr.mate" for i in range(4)}
+
+    def parse_and_build() -> None:
+        for _ in range(num):
+            m = Menu.parse(data)
+            for c in m.commands:
+                if len(c.args) > 1 and c.args[0] == "マテリアル変更":
+                    c.args[3] = mate_name_dict.get(c.args[3].lower(), c.args[3])
+            m.build()
+
+    def splice() -> None:
+        for _ in range(num):
+            Menu.replace_mate_names(data, mate_name_dict)
+
+    report("Menu.parse + Menu.build", run_in_thread(parse_and_build), num)
+    report("Menu.replace_mate_names", run_in_thread(splice), num)
+
+
+@benchmark
+def bench_binary_replace(num: int) -> None:
+    mate_name_dict = {f"test_{i}_nprmat_nprtoonv2_emissiv_trans_.mate": f"Test_{i}_npr.mate" for i in range(num)}
+    menu = Menu.parse(template_menu_data)
+    for i in range(0, num, max(num // 4, 1)):
+        menu.add_command(["マテリアル変更", "wear", "0", f"Test_{i}_NPRMAT_NPRToonV2_Emissiv_Trans_.mate"])
+    data = menu.build()
+    repls = {k: build_com_str(v) for k, v in mate_name_dict.items()}
+    binary_replace: Any = None
+    pattern: Any = None
+
+    def regex_compile() -> None:
+        nonlocal pattern
+        keys = b"|".join(regex.escape(build_com_str(k)) for k in mate_name_dict)
+        pattern = regex.compile(keys, regex.IGNORECASE)
+
+    def automaton_build() -> None:
+        nonlocal binary_replace
+        binary_replace = BinaryReplace(mate_name_dict)
+
+    def regex_sub() -> None:
+        for _ in range(100):
+            pattern.sub(lambda m: repls.get(decode_com_str(m.group()).lower(), m.group()), data)
+
+    def automaton_replace() -> None:
+        for _ in range(100):
+            binary_replace.replace(data)
+
+    report("regex alternation compile", run_in_thread(regex_compile), num)
+    report("BinaryReplace build", run_in_thread(automaton_build), num)
+    report("regex sub (100 menus)", run_in_thread(regex_sub), 100)
+    report("BinaryReplace.replace (100 menus)", run_in_thread(automaton_replace), 100)
+
+
+@benchmark
+def bench_mate_format(num: int) -> None:
+    template = "{mate_name}_{SHADER_FAMILY}"
+    variables = [
+        FormatVariable(mate_name=f"test_{i}", shader_family="npr", shader_name="_NPRToonV2_") for i in range(num)
+    ]
+    variable_pattern = re.compile(r"\{([^}]+)\}")
+
+    class SafeDict(dict):
+        # The substitution used before the template was compiled
+        def __missing__(self, key: str) -> str:
+            if key.lower() in self:
+                return self[key.lower()].upper()
+            return f"{{{key}}}"
+
+    def legacy_format() -> None:
+        for v in variables:
+            variable_dict = SafeDict(dataclasses.asdict(v))
+            variable_pattern.sub(lambda match: variable_dict[match.group(1)], template) + ".mate"
+
+    def compiled_format() -> None:
+        mate_format = MateFormat(template)
+        for v in variables:
+            mate_format.format(v)
+
+    def compiled_batch() -> None:
+        MateFormat(template).format_batch(variables)
+
+    report("regex sub + SafeDict", run_in_thread(legacy_format), num)
+    report("MateFormat.format", run_in_thread(compiled_format), num)
+    report("MateFormat.format_batch", run_in_thread(compiled_batch), num)
+
+
+@benchmark
+def bench_pmat_check(num: int) -> None:
+    data = Pmat(
+        magic=b"\x0FCM3D2_PMATERIAL",
+        version=1000,
+        hash=0,
+        material_name="Test_NPRMAT_NPRToonV2_Emissiv_Trans_",
+        renderqueue=2000.0,
+        shader="CM3D2/Toony_Lighted_Trans",
+    ).build()
+
+    def full_parse() -> None:
+        for _ in range(num):
+            Pmat.parse(BytesIO(data).read()).material_name
+
+    def read_header() -> None:
+        for _ in range(num):
+            Pmat.read_header(BytesIO(data)).material_name
+
+    report("Pmat.parse", run_in_thread(full_parse), num)
+    report("Pmat.read_header", run_in_thread(read_header), num)
+
+
+@benchmark
+def bench_inventory(num: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        for i in range(num):
+            folder = root / f"mod_{i // 100}" / f"part_{i % 7}"
+            folder.mkdir(parents=True, exist_ok=True)
+            for name in (f"m{i}_NPRMAT_NPRToonV2_.mate", f"m{i}.mate", f"m{i}.menu", f"m{i}.pmat", f"m{i}.tex"):
+                (folder / name).touch()
+
+        def three_globs() -> None:
+            list(root.glob("**/*_NPRMAT_*.mate"))
+            list(root.glob("**/*.menu"))
+            list(root.glob("**/*.pmat"))
+
+        def scandir() -> None:
+            Inventory().scan([tmp])
+
+        report("Path.glob x3", run_in_thread(three_globs), num)
+        report("Inventory.scan", run_in_thread(scandir), num)
+
+
+def makespan(batches: List[List[FileEntry]], processes: int) -> int:
+    # Each batch goes to the first free worker in dispatch order, its cost is the bytes of its files
+    workers = [0] * processes
+    for batch in batches:
+        heapq.heapreplace(workers, workers[0] + sum(e.size for e in batch))
+    return max(workers)
+
+
+@benchmark
+def bench_schedule(num: int) -> None:
+    processes = 8
+    rng = random.Random(0)
+    entries = [
+        FileEntry(Path("mods"), f"mods/mod_{i // 50}/m{i}.menu", rng.randint(1000, 20000), 0, rng.randint(0, 1 << 20))
+        for i in range(num)
+    ]
+    # A few huge menus at the end of the glob order
+    for e in entries[-4:]:
+        e.size = 2_000_000
+    ideal = max(sum(e.size for e in entries) // processes, max(e.size for e in entries))
+    batch_size = min(max(num // (processes * 4), 1), 64)
+    legacy = [entries[i : i + batch_size] for i in range(0, num, batch_size)]
+    scheduled = WorkPoolThread.schedule_batches(entries, processes)
+    for name, batches in (("fixed batches in glob order", legacy), ("schedule_batches", scheduled)):
+        print(f"  {name:<32} {len(batches):8d} batches  makespan {makespan(batches, processes) / ideal:6.3f}x ideal")  # noqa: T201
+
+
+class SlowDisk:
+    # Every read and write of a file waits like a seek on a HDD mod library
+    LATENCY = 0.0005
+
+    @staticmethod
+    def read(path: Path) -> bytes:
+        time.sleep(SlowDisk.LATENCY)
+        return path.read_bytes()
+
+    @staticmethod
+    def write(path: Path, data: bytes) -> None:
+        time.sleep(SlowDisk.LATENCY)
+        path.write_bytes(data)
+
+
+@benchmark
+def bench_io_stages(num: int) -> None:
+    num = min(num, 2000)
+    with tempfile.TemporaryDirectory() as tmp:
+        entries = []
+        for i in range(num):
+            path = Path(tmp) / f"m{i}.menu"
+            path.write_bytes(template_menu_data)
+            entries.append(FileEntry(Path(tmp), str(path), len(template_menu_data), 0, i))
+
+        def inline() -> None:
+            # One worker reads, converts and writes each file in turn
+            for e in entries:
+                SlowDisk.write(e.path, Menu.parse(SlowDisk.read(e.path)).build())
+
+        class SlowMenuFix(MenuFix):
+            def apply(self) -> None:
+                SlowDisk.write(self.path, self.new_data)
+
+        def pipelined() -> None:
+            read_ahead = ReadAheadThread([[e] for e in entries], ByteBudget(64 << 20))
+            original_read = tasks.read_file
+            tasks.read_file = lambda path_str: SlowDisk.read(Path(path_str))
+            write_thread = WriteBehindThread()
+            try:
+                read_ahead.start()
+                write_thread.start()
+                for batch in read_ahead.batches():
+                    for e, data in batch:
+                        assert data is not None
+                        write_thread.add_fix(SlowMenuFix(e.work_path, e.path, Menu.parse(data).build(), data))
+                        read_ahead.budget.release(e.size)
+                write_thread.flush()
+            finally:
+                tasks.read_file = original_read
+                write_thread.stop()
+                write_thread.join()
+
+        report("read, convert, write inline", run_in_thread(inline), num)
+        report("read-ahead + write-behind", run_in_thread(pipelined), num)
+
+
+def build_mods(root: Path, num: int) -> None:
+    # The Mates of a mod with a Menu using 4 of them and a Pmat with a wrong material name
+    menu = Menu.parse(template_menu_data)
+    pmat_data = Pmat(
+        magic=b"\x0FCM3D2_PMATERIAL",
+        version=1000,
+        hash=0,
+        material_name="wrong",
+        renderqueue=2000.0,
+        shader="CM3D2/Toony_Lighted_Trans",
+    ).build()
+    material_name = Mate.parse(template_mate_data).material.name
+    rng = random.Random(0)
+    for i in range(num):
+        folder = root / f"mod_{i // 100}"
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / f"Test_{i}_NPRMAT_NPRToonV2_Emissiv_Trans_.mate").write_bytes(template_mate_data)
+        commands = list(menu.commands)
+        for _ in range(4):
+            menu.add_command(
+                ["マテリアル変更", "wear", "0", f"Test_{rng.randrange(num)}_NPRMAT_NPRToonV2_Emissiv_Trans_.mate"]
+            )
+        (folder / f"Test_{i}.menu").write_bytes(menu.build())
+        menu.commands = commands
+    (root / "mod_0" / f"{material_name}.pmat").write_bytes(pmat_data)
+
+
+@benchmark
+def bench_pipeline(num: int) -> None:
+    config_path = Path(__file__).parent.parent / "resources" / "config"
+    original_config = CMC_Config.config
+    cwd = Path.cwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        CMC_Config.config_file = Path(tmp) / "config.json"
+        CMC_Config.shader_names_file = config_path / "ShaderNames.json"
+        CMC_Config.shader_families_file = config_path / "ShaderFamilies.json"
+        CMC_Config.scan_manifest_file = Path(tmp) / "scan_manifest.json"
+        CMC_Config.read_config()
+        # Backups are written to the working dir
+        os.chdir(tmp)
+        try:
+            for name, pool_mode, backup in (
+                ("thread pool, no backup", 0, False),
+                ("process pool, no backup", 1, False),
+                ("thread pool, 7z backup", 0, True),
+                ("process pool, 7z backup", 1, True),
+            ):
+                root = Path(tmp) / f"mods_{pool_mode}_{int(backup)}"
+                build_mods(root, num)
+                CMC_Config.config = dataclasses.replace(original_config, pool_mode=pool_mode, backup=backup)
+                work_manager = WorkManager(lambda _percentage: None, lambda: None)
+                report(f"convert, {name}", run_in_thread(lambda: work_manager.run([str(root)], lambda: False)), num)
+                assert work_manager.get_summary()["mate"]["converted"] == num
+        finally:
+            os.chdir(cwd)
+            CMC_Config.config = original_config
+
+
+def import_time(module: str) -> float:
+    # The cumulative time of the last line of -X importtime is the one of the module itself
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True
+    )
+    return int(result.stderr.strip().splitlines()[-1].split("|")[1]) / 1e6
+
+
+@benchmark
+def bench_import_time(num: int) -> None:
+    runs = max(num // 500, 3)
+    for module in ("com_mate_converter", "com_mate_converter.work", "com_mate_converter.cli"):
+        report(f"import {module}", min(import_time(module) for _ in range(runs)), 1)
+    compile_code = (
+        "import sys, time\n"
+        "from pathlib import Path\n"
+        "from com_mate_converter.utils import construct_classes\n"
+        "construct_classes.compile_cache_dir = Path(sys.argv[1])\n"
+        "from com_mate_converter.model import Mate, Menu\n"
+        "start = time.perf_counter()\n"
+        "for c in (Mate.SUBCON_COMPILED, Menu.SUBCON_COMPILED, Menu.SUBCON_HEADER_COMPILED, "
+        "Menu.SUBCON_COMMANDS_COMPILED):\n"
+        "    c.compiled\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("compile constructs (no cache)", "compile constructs (cached)"):
+            result = subprocess.run(
+                [sys.executable, "-c", compile_code, tmp], capture_output=True, text=True, check=True
+            )
+            report(name, float(result.stdout), 1)
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks for com-mate-converter")
+    parser.add_argument("names", nargs="*", help=f"Benchmarks to run: {', '.join(benchmarks)}")
+    parser.add_argument("-n", "--num", type=int, default=2000)
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error(f"Unknown benchmark: {name}")
+    for name in args.names or benchmarks.keys():
+        print(f"[{name}]")  # noqa: T201
+        benchmarks[name](args.num)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,103 @@
+import dataclasses
+import zipfile
+from pathlib import Path
+
+import py7zr
+import pytest
+from com_mate_converter.config import CMC_Config
+from com_mate_converter.work.backup import BACKUP_BACKENDS, DedupBackup
+from com_mate_converter.work.tasks import replace_file
+from com_mate_converter.work.work_thread import BackupPool, BackupThread, ByteBudget
+
+
+def read_backup(path: Path):
+    if path.suffix == ".7z":
+        with py7zr.SevenZipFile(path) as archive:
+            archive.extractall(path.parent / "extracted")
+        return read_backup(path.parent / "extracted")
+    if path.suffix == ".json":
+        DedupBackup.extract(path, path.parent / "extracted", lambda arcname: True)
+        return read_backup(path.parent / "extracted")
+    if path.suffix == ".zip":
+        with zipfile.ZipFile(path) as archive:
+            return {k: archive.read(k) for k in archive.namelist()}
+    return {p.relative_to(path).as_posix(): p.read_bytes() for p in path.rglob("*") if p.is_file()}
+
+
+@pytest.mark.finished()
+@pytest.mark.parametrize("backend_name", list(BACKUP_BACKENDS))
+@pytest.mark.parametrize("backup_filter", ["lzma2", "copy"])
+def test_backup(tmp_path: Path, backend_name: str, backup_filter: str):
+    config = dataclasses.replace(CMC_Config.config, backup_backend=backend_name, backup_filter=backup_filter)
+    backend = BACKUP_BACKENDS[backend_name]
+    mate_path = tmp_path / "mods" / "sub" / "a_NPRMAT_.mate"
+    mate_path.parent.mkdir(parents=True)
+    mate_path.write_bytes(b"mate")
+    backup_path = tmp_path / "backup" / f"mods{backend.suffix}"
+    backup_path.parent.mkdir()
+    with backend(backup_path, config) as backup_writer:
+        backup_writer.write_file(mate_path, "mods/sub/a_NPRMAT_.mate")
+    # The converted file replaces the original, even a hardlinked backup keeps the original
+    replace_file(mate_path, b"converted")
+    with backend(backup_path, config) as backup_writer:
+        backup_writer.write_data(b"menu", "mods/a.menu")
+    assert sorted(backend.names(backup_path)) == ["mods/a.menu", "mods/sub/a_NPRMAT_.mate"]
+    assert read_backup(backup_path) == {"mods/sub/a_NPRMAT_.mate": b"mate", "mods/a.menu": b"menu"}
+    assert mate_path.read_bytes() == b"converted"
+
+
+@pytest.mark.finished()
+def test_backup_spill(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(CMC_Config, "config", dataclasses.replace(CMC_Config.config, backup_backend="copy"))
+    work_path = tmp_path / "mods"
+    backup_path = tmp_path / "backup" / "mods"
+    backup_path.parent.mkdir()
+    # Room for the first file only, the others go to the spill file
+    backup_thread = BackupThread(work_path, backup_path, budget=ByteBudget(4))
+    files = {f"mods/{i}.menu": str(i).encode() * 4 for i in range(3)}
+    for k, v in files.items():
+        backup_thread.add_backup(tmp_path / k, v)
+    assert backup_thread.spill_file.spilled_num == 2
+    backup_thread.start()
+    # Killing stops taking backups, but everything queued is still written
+    backup_thread.kill()
+    assert not backup_thread.add_backup(tmp_path / "mods/late.menu", b"late")
+    backup_thread.join()
+    assert read_backup(backup_path) == files
+    assert backup_thread.budget.used == 0
+    assert list(backup_path.parent.iterdir()) == [backup_path]
+
+
+@pytest.mark.finished()
+def test_backup_pool(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(CMC_Config, "config", dataclasses.replace(CMC_Config.config, backup_backend="zip"))
+    (tmp_path / "backup").mkdir()
+    back_paths = {tmp_path / name: tmp_path / "backup" / f"{name}.zip" for name in ("mods", "mods_1")}
+    backup_pool = BackupPool(back_paths)
+    backup_pool.start()
+    for work_path in back_paths:
+        assert backup_pool.add_backup(work_path, work_path / "a.menu", work_path.name.encode())
+        assert backup_pool.add_backup(work_path, work_path / "sub" / "b.mate", b"mate")
+    # A file of no work dir has no backup
+    assert not backup_pool.add_backup(tmp_path / "other", tmp_path / "other" / "a.menu", b"other")
+    backup_pool.stop()
+    backup_pool.join()
+    assert read_backup(back_paths[tmp_path / "mods"]) == {"mods/a.menu": b"mods", "mods/sub/b.mate": b"mate"}
+    assert read_backup(back_paths[tmp_path / "mods_1"]) == {"mods_1/a.menu": b"mods_1", "mods_1/sub/b.mate": b"mate"}
+
+
+@pytest.mark.finished()
+def test_dedup_backup(tmp_path: Path):
+    backup_path = tmp_path / "backup"
+    backup_path.mkdir()
+    for name in ("mods", "mods_1"):
+        with DedupBackup(backup_path / f"{name}.json", CMC_Config.config) as backup_writer:
+            backup_writer.write_data(b"same", f"{name}/a/x.mate")
+            backup_writer.write_data(b"same", f"{name}/b/x.mate")
+            backup_writer.write_data(name.encode(), f"{name}/a.menu")
+    assert len([p for p in (backup_path / "blobs").rglob("*") if p.is_file()]) == 3
+    assert read_backup(backup_path / "mods_1.json") == {
+        "mods_1/a/x.mate": b"same",
+        "mods_1/b/x.mate": b"same",
+        "mods_1/a.menu": b"mods_1",
+    }
@@ -0,0 +1,47 @@
+import random
+
+import pytest
+import regex
+from com_mate_converter.model.base import build_com_str
+from com_mate_converter.work.binary_replace import BinaryReplace, decode_com_str
+
+
+def regex_replace(mate_name_dict, data):
+    repls = {k: build_com_str(v) for k, v in mate_name_dict.items()}
+    keys = sorted((build_com_str(k) for k in mate_name_dict), key=lambda s: (len(s), s), reverse=True)
+    pattern = regex.compile(b"|".join(map(regex.escape, keys)), regex.IGNORECASE)
+    return pattern.sub(lambda m: repls.get(decode_com_str(m.group()).lower(), m.group()), data)
+
+
+@pytest.mark.finished()
+def test_replace():
+    mate_name_dict = {
+        "a_nprmat_x.mate": "A_npr.mate",
+        "ba_nprmat_x.mate": "BA_npr.mate",
+        "a_nprmat_x.mate.mate": "Long_npr.mate",
+    }
+    binary_replace = BinaryReplace(mate_name_dict)
+    data = b"\x00" + build_com_str("A_NPRMAT_x.mate") + b"\x10" + build_com_str("bA_nprmat_X.mate") + b"\x0f"
+    assert binary_replace.replace(data) == regex_replace(mate_name_dict, data)
+    assert build_com_str("A_npr.mate") in binary_replace.replace(data)
+    assert binary_replace.replace(b"no match") == b"no match"
+    assert BinaryReplace({}).replace(data) == data
+
+
+@pytest.mark.finished()
+def test_replace_random():
+    rng = random.Random(0)
+    alphabet = "aAbB_."
+    for _ in range(200):
+        keys = {"".join(rng.choice(alphabet) for _ in range(rng.randint(1, 6))).lower() for _ in range(6)}
+        mate_name_dict = {k: f"new{i}" for i, k in enumerate(keys)}
+        binary_replace = BinaryReplace(mate_name_dict)
+        pieces = []
+        for _ in range(20):
+            if rng.random() < 0.4:
+                key = rng.choice(list(keys))
+                pieces.append(build_com_str("".join(c.upper() if rng.random() < 0.5 else c for c in key)))
+            else:
+                pieces.append(bytes(rng.choice(b"\x01\x02\x03aAbB_.") for _ in range(rng.randint(1, 4))))
+        data = b"".join(pieces)
+        assert binary_replace.replace(data) == regex_replace(mate_name_dict, data)
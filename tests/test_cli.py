@@ -0,0 +1,179 @@
+import dataclasses
+import json
+from pathlib import Path
+from typing import Dict
+
+import pytest
+from com_mate_converter import cli
+from com_mate_converter.config import CMC_Config
+from com_mate_converter.model import Mate, Menu, Pmat
+from com_mate_converter.work import WorkManager
+from com_mate_converter.work.tasks import BatchResult
+from tests import resouce_path
+
+config_path = Path(__file__).parent.parent / "resources" / "config"
+
+
+def setup_config(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(CMC_Config, "config", dataclasses.replace(CMC_Config.config))
+    monkeypatch.setattr(CMC_Config, "shader_names", {})
+    monkeypatch.setattr(CMC_Config, "shader_families", {})
+    monkeypatch.setattr(CMC_Config, "config_file", tmp_path / "config.json")
+    monkeypatch.setattr(CMC_Config, "shader_names_file", config_path / "ShaderNames.json")
+    monkeypatch.setattr(CMC_Config, "shader_families_file", config_path / "ShaderFamilies.json")
+    monkeypatch.setattr(CMC_Config, "scan_manifest_file", tmp_path / "scan_manifest.json")
+
+
+@pytest.mark.finished()
+def test_convert(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    setup_config(tmp_path, monkeypatch)
+    mate_path = tmp_path / "mods" / "a_NPRMAT_NPRToonV2_.mate"
+    mate_path.parent.mkdir()
+    mate_path.write_bytes((resouce_path / "example_1.mate").read_bytes())
+    summary_path = tmp_path / "summary.json"
+    assert cli.main(["convert", str(tmp_path / "mods"), "--no-backup", "--summary", str(summary_path)]) == 0
+    summary = json.loads(summary_path.read_text(encoding="utf-8"))
+    assert summary["mate"] == {"found": 1, "converted": 1, "failed": 0}
+    assert summary["chunk_size"] == 64
+    assert summary["chunks"]["mate"] == 1
+    assert not mate_path.exists()
+
+
+@pytest.mark.finished()
+def test_convert_auto_workers(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    setup_config(tmp_path, monkeypatch)
+    (tmp_path / "config.json").write_text(json.dumps({"menu_process_mode": 1}), encoding="utf-8")
+    for i in range(3):
+        mate_path = tmp_path / "mods" / f"{i}_NPRMAT_NPRToonV2_.mate"
+        mate_path.parent.mkdir(exist_ok=True)
+        mate_path.write_bytes((resouce_path / "example_1.mate").read_bytes())
+    summary_path = tmp_path / "summary.json"
+    args = ["convert", str(tmp_path / "mods"), "--auto-workers", "--no-backup", "--summary", str(summary_path)]
+    assert cli.main(args) == 0
+    summary = json.loads(summary_path.read_text(encoding="utf-8"))
+    config_dict = json.loads((tmp_path / "config.json").read_text(encoding="utf-8"))
+    # Only the chosen workers are written, the options of the run are not
+    assert config_dict["menu_process_mode"] == 1
+    assert config_dict["worker_nums"] == {(tmp_path / "mods").resolve().as_posix(): summary["workers"]}
+    assert "mate" in summary["workers"]
+
+
+@pytest.mark.finished()
+def test_convert_invalid_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    setup_config(tmp_path, monkeypatch)
+    (tmp_path / "mods").mkdir()
+    (tmp_path / "a.mate").touch()
+    summary_path = tmp_path / "summary.json"
+    for path in (tmp_path / "missing", tmp_path / "a.mate"):
+        assert cli.main(["convert", str(tmp_path / "mods"), str(path), "--summary", str(summary_path)]) == 2
+    assert not summary_path.exists()
+
+
+def build_mods(mods_path: Path) -> Dict[Path, bytes]:
+    """An NPR Mate of each Pmat case with a Menu using it, return the original files."""
+    mate_data = (resouce_path / "example_1.mate").read_bytes()
+    hair_mate = Mate.parse(mate_data)
+    hair_mate.material.name = "hair"
+    menu = Menu.create(item_name="a", category="wear", infoText="a")
+    menu.add_command(["マテリアル変更", "wear", "0", "a_NPRMAT_NPRToonV2_.mate"])
+    files = {
+        "pack/a_NPRMAT_NPRToonV2_.mate": mate_data,
+        "pack/b_NPRMAT_NPRToonV2_.mate": hair_mate.build(),
+        "pack/a.menu": menu.build(),
+        "pack/plain.menu": Menu.create(item_name="plain", category="wear", infoText="plain").build(),
+        # Wrong material name and wrong file name
+        "pack/skin.pmat": build_pmat("wrong"),
+        "pack/other.pmat": build_pmat("hair"),
+    }
+    for name, data in files.items():
+        (mods_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (mods_path / name).write_bytes(data)
+    return read_tree(mods_path)
+
+
+def build_pmat(material_name: str) -> bytes:
+    return Pmat(
+        magic=b"\x0fCM3D2_PMATERIAL",
+        version=1000,
+        hash=0,
+        material_name=material_name,
+        renderqueue=2000.0,
+        shader="CM3D2/Toony_Lighted_Outline",
+    ).build()
+
+
+def read_tree(path: Path) -> Dict[Path, bytes]:
+    return {p.relative_to(path): p.read_bytes() for p in path.rglob("*") if p.is_file()}
+
+
+@pytest.mark.finished()
+@pytest.mark.parametrize("pool_mode", [0, 1])
+def test_convert_and_restore(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], pool_mode: int
+):
+    setup_config(tmp_path, monkeypatch)
+    (tmp_path / "config.json").write_text(
+        json.dumps({"pool_mode": pool_mode, "backup_backend": "zip", "chunk_size": 1}), encoding="utf-8"
+    )
+    mods_path = tmp_path / "mods"
+    originals = build_mods(mods_path)
+    summary_path = tmp_path / "summary.json"
+    assert cli.main(["convert", str(mods_path), "--summary", str(summary_path)]) == 0
+    summary = json.loads(summary_path.read_text(encoding="utf-8"))
+    assert summary["mate"] == {"found": 2, "converted": 2, "failed": 0}
+    assert summary["menu"] == {"found": 2, "processed": 1, "skipped": 1, "failed": 0}
+    assert "Skipped 1 Menu without NPR Mate" in capsys.readouterr().err
+    assert summary["pmat"] == {"found": 2, "checked": 2, "renamed": 1, "failed": 0}
+    converted = read_tree(mods_path)
+    assert sorted(p.as_posix() for p in converted) == [
+        "pack/a.menu",
+        "pack/a_npr.mate",
+        "pack/b_npr.mate",
+        "pack/hair.pmat",
+        "pack/plain.menu",
+        "pack/skin.pmat",
+    ]
+    assert Mate.parse(converted[Path("pack/a_npr.mate")]).material.shader_filename.startswith("com3d2mod")
+    # The Menus are only rewritten once the mapping of all Mates is final
+    menu_args = [c.args for c in Menu.parse(converted[Path("pack/a.menu")]).commands]
+    assert ["マテリアル変更", "wear", "0", "a_npr.mate"] in menu_args
+    assert converted[Path("pack/plain.menu")] == originals[Path("pack/plain.menu")]
+    # The Pmats are only checked against the material names of all Mates
+    assert Pmat.parse(converted[Path("pack/skin.pmat")]).material_name == "skin"
+    assert converted[Path("pack/hair.pmat")] == originals[Path("pack/other.pmat")]
+    assert len(summary["backup"]) == 1
+    assert cli.main(["restore", str(Path(summary["backup"][0]).parent)]) == 0
+    assert read_tree(mods_path) == originals
+
+
+@pytest.mark.finished()
+@pytest.mark.parametrize("pool_mode", [0, 1])
+def test_convert_cancel(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, pool_mode: int):
+    setup_config(tmp_path, monkeypatch)
+    (tmp_path / "config.json").write_text(
+        json.dumps({"pool_mode": pool_mode, "backup_backend": "zip", "chunk_size": 1}), encoding="utf-8"
+    )
+    CMC_Config.read_config()
+    mods_path = tmp_path / "mods"
+    originals = build_mods(mods_path)
+    work_manager = WorkManager(lambda _percentage: None, lambda: None)
+    merge_mate_result = work_manager.merge_mate_result
+
+    def merge_and_kill(result: BatchResult) -> None:
+        merge_mate_result(result)
+        work_manager.kill_work_thread()
+
+    monkeypatch.setattr(work_manager, "merge_mate_result", merge_and_kill)
+    work_manager.run([str(mods_path)], lambda: False)
+    assert not work_manager.is_running()
+    summary = work_manager.get_summary()
+    assert summary["mate"]["converted"] < 2
+    # Cancelled before the Menu and Pmat stages
+    converted = read_tree(mods_path)
+    for name in ("pack/a.menu", "pack/plain.menu", "pack/skin.pmat", "pack/other.pmat"):
+        assert converted[Path(name)] == originals[Path(name)]
+    # Whatever was written has its original in the backup
+    assert len(summary["backup"]) == 1
+    assert cli.main(["restore", str(Path(summary["backup"][0]).parent)]) == 0
+    assert read_tree(mods_path) == originals
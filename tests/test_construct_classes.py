@@ -0,0 +1,46 @@
+import dataclasses
+import os
+from pathlib import Path
+
+import construct as cs
+import pytest
+from tests import resouce_path
+from com_mate_converter.model import Mate
+from com_mate_converter.utils import construct_classes
+from com_mate_converter.utils.construct_classes import LazyCompiled
+
+
+@pytest.mark.finished()
+def test_compile_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(construct_classes, "compile_cache_dir", tmp_path)
+    with open(resouce_path / "example_1.mate", "rb") as f:
+        data = f.read()
+    generated = LazyCompiled(Mate.SUBCON_COMPILED.subcon, "mate")
+    mate = Mate.from_parsed(generated.parse(data))
+    assert generated.compiled.source is not None
+    assert len(list(tmp_path.glob("mate-*.bin"))) == 1
+    cached = LazyCompiled(Mate.SUBCON_COMPILED.subcon, "mate")
+    assert Mate.from_parsed(cached.parse(data)) == mate
+    assert cached.compiled.source is None
+    assert cached.build(dataclasses.asdict(mate)) == generated.build(dataclasses.asdict(mate)) == data
+    if hasattr(os, "getuid"):
+        # Code in a dir others can write to is never executed
+        tmp_path.chmod(0o777)
+        untrusted = LazyCompiled(Mate.SUBCON_COMPILED.subcon, "mate")
+        assert untrusted.compiled.source is not None
+
+
+@pytest.mark.finished()
+def test_struct_converters():
+    with open(resouce_path / "example_1.mate", "rb") as f:
+        data = f.read()
+    parsed = Mate.SUBCON_COMPILED.parse(data)  # type: ignore
+    mate = Mate.from_parsed(parsed)
+    assert mate == Mate.parse(data)
+    assert mate.to_dict() == dataclasses.asdict(mate)
+    assert type(mate.material.properties) is list
+    assert Mate.SUBCON_COMPILED.build(mate.to_dict()) == data  # type: ignore
+    with pytest.raises(ValueError, match="Mismatched type for field material"):
+        Mate.from_parsed(cs.Container(magic=mate.magic, version=1000, mate_name="", material=1))
+    with pytest.raises(TypeError):
+        Mate.from_parsed(cs.Container(magic=mate.magic, version=1000, mate_name=""))
@@ -0,0 +1,57 @@
+import os
+from pathlib import Path
+
+import pytest
+from com_mate_converter.work.inventory import Inventory
+
+
+def touch(path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"data")
+
+
+@pytest.mark.finished()
+def test_scan(tmp_path: Path):
+    touch(tmp_path / "mod_a" / "a_NPRMAT_NPRToonV2_.mate")
+    touch(tmp_path / "mod_a" / "sub" / "b.mate")
+    touch(tmp_path / "mod_a" / "sub" / "b.menu")
+    touch(tmp_path / "mod_a" / "sub" / "b.pmat")
+    touch(tmp_path / "mod_a" / "sub" / "b.tex")
+    touch(tmp_path / "mod_b" / "c_NPRMAT_NPRToonV2_.mate")
+    inventory = Inventory()
+    inventory.scan(
+        [
+            str(tmp_path / "mod_a" / "sub"),
+            str(tmp_path / "mod_a"),
+            str(tmp_path / "mod_b"),
+            str(tmp_path / "mod_b"),
+            str(tmp_path / "missing"),
+        ]
+    )
+    assert inventory.work_dirs == [tmp_path / "mod_a", tmp_path / "mod_b"]
+    assert sorted(e.path.name for e in inventory.npr_mates) == ["a_NPRMAT_NPRToonV2_.mate", "c_NPRMAT_NPRToonV2_.mate"]
+    assert [e.path.name for e in inventory.other_mates] == ["b.mate"]
+    assert [e.path.name for e in inventory.menus] == ["b.menu"]
+    assert [e.path.name for e in inventory.pmats] == ["b.pmat"]
+    assert all(e.size == 4 for e in inventory.menus + inventory.pmats)
+    assert inventory.menus[0].work_path == tmp_path / "mod_a"
+
+
+@pytest.mark.finished()
+@pytest.mark.skipif(not hasattr(os, "symlink"), reason="no symlinks")
+def test_scan_symlinked_dirs(tmp_path: Path):
+    touch(tmp_path / "mods" / "real" / "x_NPRMAT_NPRToonV2_.mate")
+    touch(tmp_path / "mods" / "real" / "x.menu")
+    try:
+        (tmp_path / "mods" / "alias").symlink_to(tmp_path / "mods" / "real", target_is_directory=True)
+        (tmp_path / "mods" / "real" / "loop").symlink_to(tmp_path / "mods", target_is_directory=True)
+    except OSError:
+        pytest.skip("no permission to create symlinks")
+    inventory = Inventory()
+    inventory.scan([str(tmp_path / "mods")])
+    # Each file once, by its real path
+    assert [e.path for e in inventory.npr_mates] == [tmp_path / "mods" / "real" / "x_NPRMAT_NPRToonV2_.mate"]
+    assert [e.path for e in inventory.menus] == [tmp_path / "mods" / "real" / "x.menu"]
+    # A linked work dir itself is scanned
+    inventory.scan([str(tmp_path / "mods" / "alias")])
+    assert [e.path.name for e in inventory.npr_mates] == ["x_NPRMAT_NPRToonV2_.mate"]
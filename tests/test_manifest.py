@@ -0,0 +1,32 @@
+from pathlib import Path
+
+import pytest
+from com_mate_converter.work.inventory import FileEntry, Inventory
+from com_mate_converter.work.manifest import MENU_NO_NPR, PMAT_CONSISTENT, ScanManifest
+
+
+def entry(path: Path, size: int = 1, mtime_ns: int = 1) -> FileEntry:
+    return FileEntry(work_path=path.parent, path_str=str(path), size=size, mtime_ns=mtime_ns, inode=0)
+
+
+@pytest.mark.finished()
+def test_manifest(tmp_path: Path):
+    manifest = ScanManifest(tmp_path / "scan_manifest.json")
+    menu, pmat = entry(tmp_path / "mods" / "a.menu"), entry(tmp_path / "mods" / "a.pmat")
+    manifest.update(menu, MENU_NO_NPR)
+    manifest.update(pmat, PMAT_CONSISTENT)
+    manifest.save()
+    manifest.load()
+    assert manifest.lookup(menu) == (MENU_NO_NPR, "")
+    assert manifest.lookup(entry(menu.path, mtime_ns=2)) is None
+    assert manifest.lookup(entry(menu.path, size=2)) is None
+    inventory = Inventory()
+    inventory.work_dirs.append(tmp_path / "mods")
+    inventory.menus.append(menu)
+    manifest.prune(inventory)
+    assert manifest.lookup(menu) is not None
+    assert manifest.lookup(pmat) is None
+    assert ScanManifest.fingerprint({"a": 1}) != ScanManifest.fingerprint({"a": 2})
+    (tmp_path / "scan_manifest.json").write_text("{", encoding="utf-8")
+    manifest.load()
+    assert manifest.entries == {}
@@ -0,0 +1,25 @@
+import pytest
+from com_mate_converter.model.format import FormatVariable, MateFormat
+
+variable = FormatVariable(mate_name="example", shader_family="npr", shader_name="_NPRToonV2_")
+
+
+@pytest.mark.finished()
+def test_mate_format():
+    assert MateFormat("{mate_name}_{shader_family}").format(variable) == "example_npr.mate"
+    assert MateFormat("{MATE_NAME}{Shader_Name}").format(variable) == "EXAMPLE_NPRTOONV2_.mate"
+    # Unknown variables, unclosed braces and quotes are kept as they are
+    assert MateFormat("{unknown}{}'\\{mate_name").format(variable) == "{unknown}{}'\\{mate_name.mate"
+    assert MateFormat("").format(variable) == ".mate"
+    other = FormatVariable(mate_name="{shader_name}", shader_family="toon", shader_name="_NPRToonV2_")
+    assert MateFormat("{mate_name}-{SHADER_FAMILY}").format_batch([variable, other]) == [
+        "example-NPR.mate",
+        "{shader_name}-TOON.mate",
+    ]
+
+
+@pytest.mark.finished()
+def test_open_variable():
+    assert MateFormat.open_variable("{mate_name}_{sha") == 12
+    assert MateFormat.open_variable("{mate_name}") is None
+    assert MateFormat.open_variable("name") is None
@@ -1,7 +1,9 @@
+import dataclasses
 from construct import ConstructError
 import pytest
 from tests import resouce_path
 from com_mate_converter.model import Mate
+from com_mate_converter.model.mate import MateCodec
 
 
 @pytest.mark.finished()
@@ -60,6 +62,26 @@ def test_truncate():
     assert Mate.parse(data_untruncated).build() == data
 
 
+@pytest.mark.finished()
+def test_codec():
+    for path in sorted(resouce_path.glob("*.mate")):
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            mate = Mate.from_parsed(Mate.SUBCON_COMPILED.parse(data))  # type: ignore
+        except (ConstructError, ValueError):
+            # The broken resources have an unknown tex or prop type
+            with pytest.raises(ValueError, match=r"Unknown (tex|prop) type"):
+                MateCodec.decode(data)
+            continue
+        assert MateCodec.decode(data) == mate
+        assert MateCodec.encode(mate) == Mate.SUBCON_COMPILED.build(dataclasses.asdict(mate))  # type: ignore
+    mate = generate_mate()
+    data = MateCodec.encode(mate)
+    assert data == Mate.SUBCON_COMPILED.build(dataclasses.asdict(mate))  # type: ignore
+    assert MateCodec.decode(data) == mate
+
+
 def generate_mate() -> Mate:
     mate = Mate.create(
         mate_name="test",
@@ -47,6 +47,26 @@ def test_truncate():
     assert Menu.parse(data_untruncated).build() == data
 
 
+@pytest.mark.finished()
+def test_replace_mate_names():
+    mate_name_dict = {"example_nprmat_nprtoonv2_.mate": "example_npr.mate"}
+    menu = generate_menu()
+    menu.add_command(["マテリアル変更", "wear", "0", "Example_NPRMAT_NPRToonV2_.mate"])
+    menu.add_command(["マテリアル変更", "wear", "1", "other_NPRMAT_NPRToonV2_.mate"])
+    data = menu.build()
+    for d in (data, data + b"\x01\x00untruncated"):
+        new_data = Menu.replace_mate_names(d, mate_name_dict)
+        expected = Menu.parse(d)
+        expected.commands[-3].args[3] = "example_npr.mate"
+        assert new_data == expected.build()
+    assert Menu.replace_mate_names(data, {}) is None
+    with open(resouce_path / "menu_example_untruncated.menu", "rb") as f:
+        assert Menu.replace_mate_names(f.read(), mate_name_dict) is None
+    with open(resouce_path / "menu_example_error.menu", "rb") as f:
+        with pytest.raises(ValueError, match="COMStr out of range"):
+            Menu.replace_mate_names(f.read(), mate_name_dict)
+
+
 def generate_menu() -> Menu:
     menu = Menu.create(item_name="example", category="wear", infoText="_" * 128)
     menu.add_command(["icons", "example.tex"])
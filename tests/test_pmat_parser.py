@@ -0,0 +1,38 @@
+from io import BytesIO
+
+import pytest
+from com_mate_converter.model import Pmat
+
+
+@pytest.mark.finished()
+def test_readwrite():
+    pmat = generate_pmat("example")
+    data = pmat.build()
+    assert pmat.hash == Pmat.str_hash("example")
+    assert Pmat.parse(data) == pmat
+
+
+@pytest.mark.finished()
+def test_read_header():
+    for name in ("example", "例" * 200):
+        pmat = generate_pmat(name)
+        data = pmat.build()
+        header = Pmat.read_header(BytesIO(data), peek_size=32)
+        assert header.version == pmat.version
+        assert header.hash == pmat.hash
+        assert header.material_name == name
+    with pytest.raises(ValueError, match="truncated"):
+        Pmat.read_header(BytesIO(data[:40]))
+    with pytest.raises(ValueError, match="magic"):
+        Pmat.read_header(BytesIO(data[1:]))
+
+
+def generate_pmat(material_name: str) -> Pmat:
+    return Pmat(
+        magic=b"\x0FCM3D2_PMATERIAL",
+        version=1000,
+        hash=0,
+        material_name=material_name,
+        renderqueue=2000.0,
+        shader="CM3D2/Toony_Lighted_Trans",
+    )
@@ -0,0 +1,63 @@
+from pathlib import Path
+
+import pytest
+from com_mate_converter.config import CMC_Config
+from com_mate_converter.work.backup import ZipBackup
+from com_mate_converter.work.restore import NEW_FILE_LIST, make_selector, restore, write_work_dirs
+
+
+@pytest.mark.finished()
+def test_make_selector():
+    select = make_selector("ModA", ["mate"])
+    assert select("mods/moda/sub/a.MATE")
+    assert not select("mods/moda/a.menu")
+    assert not select("mods/modb/a.mate")
+    assert not select("mods/a/moda.mate")
+    assert make_selector()("a.pmat")
+
+
+@pytest.mark.finished()
+def test_restore(tmp_path: Path):
+    work_path = tmp_path / "mods"
+    (work_path / "moda").mkdir(parents=True)
+    (work_path / "modb").mkdir()
+    backup_dir = tmp_path / "backup"
+    backup_dir.mkdir()
+    back_path = backup_dir / "mods.zip"
+    with ZipBackup(back_path, CMC_Config.config) as backup_writer:
+        for name in ("moda/a_NPRMAT_.mate", "moda/a.menu", "modb/b_NPRMAT_.mate"):
+            backup_writer.write_data(name.encode(), f"mods/{name}")
+            (work_path / name).write_bytes(b"converted")
+    write_work_dirs(backup_dir, {work_path: back_path})
+    new_files = [work_path / "moda" / "a_npr.mate", work_path / "modb" / "b_npr.mate"]
+    for p in new_files:
+        p.write_bytes(b"new")
+    (backup_dir / NEW_FILE_LIST).write_text("".join(f"{p.as_posix()}\n" for p in new_files), encoding="utf-8")
+    assert restore(backup_dir, mod="moda")
+    assert (work_path / "moda" / "a_NPRMAT_.mate").read_bytes() == b"moda/a_NPRMAT_.mate"
+    assert (work_path / "moda" / "a.menu").read_bytes() == b"moda/a.menu"
+    assert not new_files[0].exists()
+    assert (work_path / "modb" / "b_NPRMAT_.mate").read_bytes() == b"converted"
+    assert new_files[1].exists()
+
+
+@pytest.mark.finished()
+def test_restore_mod_of_work_dir_path(tmp_path: Path):
+    # The work dir itself is under a folder named like the mod
+    work_path = tmp_path / "Mod" / "MyPack"
+    work_path.mkdir(parents=True)
+    backup_dir = tmp_path / "backup"
+    backup_dir.mkdir()
+    back_path = backup_dir / "MyPack.zip"
+    with ZipBackup(back_path, CMC_Config.config) as backup_writer:
+        backup_writer.write_data(b"original", "MyPack/a_NPRMAT_.mate")
+    write_work_dirs(backup_dir, {work_path: back_path})
+    new_file = work_path / "a_npr.mate"
+    new_file.write_bytes(b"new")
+    (backup_dir / NEW_FILE_LIST).write_text(f"{new_file.as_posix()}\n", encoding="utf-8")
+    # Selected like the backup entries, nothing matches and nothing is removed
+    assert not restore(backup_dir, mod="Mod")
+    assert new_file.read_bytes() == b"new"
+    assert restore(backup_dir, mod="MyPack")
+    assert not new_file.exists()
+    assert (work_path / "a_NPRMAT_.mate").read_bytes() == b"original"
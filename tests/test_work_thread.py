@@ -0,0 +1,260 @@
+import dataclasses
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from com_mate_converter.config import CMC_Config
+from com_mate_converter.model import Menu
+from com_mate_converter.work import tasks
+from com_mate_converter.work.inventory import FileEntry
+from com_mate_converter.work.manifest import MENU_NO_NPR
+from com_mate_converter.work.tasks import BatchResult, StageContext, WorkType
+from com_mate_converter.work.work_manager import WorkManager
+from com_mate_converter.work import work_thread
+from com_mate_converter.work.work_thread import (
+    ByteBudget,
+    ConcurrencyTuner,
+    ReadAheadThread,
+    WorkPoolThread,
+    WriteBehindThread,
+)
+from tests import resouce_path
+
+
+def entry(path: str) -> FileEntry:
+    return FileEntry(work_path=Path("mods"), path_str=path, size=0, mtime_ns=0, inode=0)
+
+
+@pytest.mark.finished()
+def test_schedule_batches():
+    entries = [entry(f"mods/{d}/{i}.mate") for d in "cab" for i in range(10)]
+    for i, e in enumerate(entries):
+        e.size, e.inode = 100, 30 - i
+    big = entry("mods/a/big.menu")
+    big.size = 10000
+    batches = WorkPoolThread.schedule_batches(entries + [big], 2)
+    assert sorted(e.path_str for b in batches for e in b) == sorted(e.path_str for e in entries + [big])
+    # The largest file first, then the others by dir and inode in batches which shrink
+    assert batches[0] == [big]
+    rest = [e for b in batches[1:] for e in b]
+    assert rest == sorted(entries, key=lambda e: (e.path.parent.name, e.inode))
+    assert [len(b) for b in batches[1:]] == sorted((len(b) for b in batches[1:]), reverse=True)
+    assert max(len(b) for b in WorkPoolThread.schedule_batches(entries, 1, chunk_size=2)) == 2
+    assert WorkPoolThread.schedule_batches([], 2) == []
+
+
+@pytest.mark.finished()
+def test_process_mate_backup(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(CMC_Config, "config", dataclasses.replace(CMC_Config.config, backup=True))
+    monkeypatch.setattr(CMC_Config, "shader_names", {"_nprtoonv2_": "CM3D2/Toony_Lighted"})
+    mate_path = tmp_path / "mods" / "a_NPRMAT_NPRToonV2_.mate"
+    mate_path.parent.mkdir()
+    data = (resouce_path / "example_1.mate").read_bytes()
+    mate_path.write_bytes(data)
+    mate_entry = FileEntry(tmp_path / "mods", str(mate_path), len(data), 0, 0)
+    result = BatchResult()
+    context = StageContext.create(WorkType.Mate, new_mate_names=tasks.allocate_mate_names([mate_entry]))
+    tasks.process_mate(context, mate_entry, data, result)
+    # Left for the main process until the original is queued for backup
+    assert mate_path.read_bytes() == data
+    (fix,) = result.mate_fixes
+    # The original is not sent back, the pool pairs it with the buffer read ahead
+    assert (fix.path, fix.data) == (mate_path, b"")
+    assert fix.new_path == mate_path.parent / "a_npr.mate"
+
+
+@pytest.mark.finished()
+def test_allocate_mate_names(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(CMC_Config, "config", dataclasses.replace(CMC_Config.config, mate_format="{mate_name}"))
+    monkeypatch.setattr(CMC_Config, "shader_names", {"_nprtoonv2_": "CM3D2/Toony_Lighted"})
+    names = ["a_NPRMAT_NPRToonV2_.mate", "A_NPRMAT_NPRToonV2_.mate", "b_NPRMAT_Unknown_.mate", "A.MATE"]
+    for name in names:
+        (tmp_path / name).touch()
+    entries = [entry(str(tmp_path / name)) for name in names]
+    new_mate_names = tasks.allocate_mate_names(entries)
+    # Taken names are compared ignoring case, unknown shaders get no name
+    assert new_mate_names == {entries[0].path_str: "a_1.mate", entries[1].path_str: "A_2.mate"}
+    assert tasks.allocate_mate_names([entry(str(tmp_path / "missing" / names[0]))]) == {}
+
+
+@pytest.mark.finished()
+def test_concurrency_tuner(monkeypatch: pytest.MonkeyPatch):
+    clock = [0.0]
+    monkeypatch.setattr(work_thread.time, "perf_counter", lambda: clock[0])
+    tuner = ConcurrencyTuner(start=1, max_workers=8)
+    tried = []
+    while tuner.calibrating:
+        tried.append(tuner.concurrency)
+        # 1000 bytes per file, the throughput stops growing at 3 workers
+        clock[0] += ConcurrencyTuner.WINDOW_FILES * 1000 / (min(tuner.concurrency, 3) * 1000 - tuner.concurrency)
+        tuner.record(ConcurrencyTuner.WINDOW_FILES * 1000, ConcurrencyTuner.WINDOW_FILES)
+    assert tuner.concurrency == 3
+    assert tried == [1, 1, 2, 3, 4]
+    assert ConcurrencyTuner(start=4, max_workers=1).concurrency == 1
+
+
+@pytest.mark.finished()
+def test_read_ahead(tmp_path: Path):
+    entries = [entry(str(tmp_path / f"{i}.menu")) for i in range(4)]
+    for i, e in enumerate(entries[:3]):
+        e.path.write_bytes(bytes([i]) * 10)
+        e.size = 10
+    budget = ByteBudget(15)
+    read_ahead = ReadAheadThread([entries[:2], entries[2:]], budget)
+    read_ahead.start()
+    batches = read_ahead.batches()
+    assert next(batches) == [(entries[0], b"\0" * 10), (entries[1], b"\1" * 10)]
+    # More than the budget is only read once nothing is held
+    assert budget.used == 20
+    budget.release(20)
+    assert next(batches) == [(entries[2], b"\2" * 10), (entries[3], None)]
+    assert list(batches) == []
+    read_ahead.join()
+
+
+@pytest.mark.finished()
+def test_write_behind(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(CMC_Config, "config", dataclasses.replace(CMC_Config.config, write_behind_limit=0))
+    menu_path = tmp_path / "a.menu"
+    menu_path.write_bytes(b"old")
+    mate_path = tmp_path / "a_NPRMAT_NPRToonV2_.mate"
+    mate_path.write_bytes(b"old")
+    menu_fix = tasks.MenuFix(tmp_path, menu_path, b"new", data=b"old")
+    mate_fix = tasks.MateFix(tmp_path, mate_path, b"new", tmp_path / "a.mate", data=b"old")
+    missing_fix = tasks.PmatFix(tmp_path, tmp_path / "missing" / "a.pmat", b"new", None, data=b"old")
+    write_thread = WriteBehindThread()
+    write_thread.start()
+    # Each fix is over the budget of 0 MiB, they are queued one at a time
+    for fix in (menu_fix, mate_fix, missing_fix):
+        assert write_thread.add_fix(fix)
+    assert write_thread.flush() == ([menu_fix, mate_fix], [missing_fix])
+    assert menu_path.read_bytes() == b"new"
+    assert not mate_path.exists()
+    assert (tmp_path / "a.mate").read_bytes() == b"new"
+    write_thread.stop()
+    write_thread.join()
+    assert not write_thread.add_fix(menu_fix)
+    assert write_thread.flush() == ([], [])
+
+
+@pytest.mark.finished()
+def test_kill_pool_mid_batch(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(CMC_Config, "shader_names", {"_nprtoonv2_": "CM3D2/Toony_Lighted"})
+    monkeypatch.setattr(CMC_Config, "worker_num", 1)
+    data = (resouce_path / "example_1.mate").read_bytes()
+    entries = []
+    for i in range(5):
+        mate_path = tmp_path / f"{i}_NPRMAT_NPRToonV2_.mate"
+        mate_path.write_bytes(data)
+        entries.append(FileEntry(tmp_path, str(mate_path), len(data), 0, i))
+    cancel_token = work_thread.CancelToken()
+    write_thread = WriteBehindThread(cancel_token)
+    write_thread.start()
+    processed = []
+    results = []
+
+    def process_and_kill(context: StageContext, mate_entry: FileEntry, data: bytes, result: BatchResult) -> None:
+        tasks.process_mate(context, mate_entry, data, result)
+        processed.append(mate_entry)
+        pool_thread.kill()
+
+    def merge(result: BatchResult) -> None:
+        results.append(result)
+        for fix in result.mate_fixes:
+            write_thread.add_fix(fix)
+
+    context = StageContext.create(WorkType.Mate, new_mate_names=tasks.allocate_mate_names(entries))
+    pool_thread = WorkPoolThread(process_and_kill, entries, context, merge, cancel_token)
+    pool_thread.start()
+    pool_thread.join()
+    write_thread.stop()
+    write_thread.join()
+    # The pool stops within one file, nothing is written after the kill
+    assert len(processed) == 1
+    assert sum(r.done for r in results) == 1
+    assert sorted(p.name for p in tmp_path.iterdir()) == [e.path.name for e in entries]
+    assert all(e.path.read_bytes() == data for e in entries)
+
+
+@pytest.mark.finished()
+def test_merge_failed_mate_fixes(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(CMC_Config, "config", dataclasses.replace(CMC_Config.config, backup=False))
+    manager = WorkManager(lambda percentage: None, lambda: None)
+    name = "x_NPRMAT_NPRToonV2_.mate"
+    fixes = [
+        tasks.MateFix(tmp_path / d, tmp_path / d / name, b"new", tmp_path / d / "x_npr.mate", data=b"old")
+        for d in "abc"
+    ]
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / name).write_bytes(b"old")
+    manager.write_thread = WriteBehindThread()
+    manager.write_thread.start()
+    # The Mate of b is missing and its rename fails, the one of c is dropped
+    manager.merge_mate_result(BatchResult(mate_fixes=fixes[:2]))
+    manager.failed_fixes.append(fixes[2])
+    manager.merge_fixes()
+    manager.write_thread.stop()
+    manager.write_thread.join()
+    # Menus still point to the Mate of the same name converted in a
+    assert manager.mate_name_dict == {name.lower(): "x_npr.mate"}
+    assert manager.mate_proc_list == [fixes[0].new_path]
+    assert manager.mate_pass_list == [fixes[1].path, fixes[2].path]
+
+
+@pytest.mark.finished()
+def test_merge_without_backup_queued(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(CMC_Config, "config", dataclasses.replace(CMC_Config.config, backup=True))
+    manager = WorkManager(lambda percentage: None, lambda: None)
+    manager.write_thread = WriteBehindThread()
+    menu_path = tmp_path / "a.menu"
+    pmat_path = tmp_path / "a.pmat"
+    # No backup pool, the originals cannot be queued
+    manager.merge_menu_result(BatchResult(menu_fixes=[tasks.MenuFix(tmp_path, menu_path, b"new", data=b"old")]))
+    manager.merge_pmat_result(BatchResult(pmat_fixes=[tasks.PmatFix(tmp_path, pmat_path, b"new", None, data=b"old")]))
+    assert manager.write_thread.fix_queue.empty()
+    assert (manager.menu_pass_list, manager.pmat_pass_list) == ([menu_path], [pmat_path])
+
+
+@pytest.mark.finished()
+def test_has_npr_reference():
+    assert tasks.has_npr_reference(b"a_NPRMAT_NPRToonV2_.mate")
+    assert tasks.has_npr_reference(b"a_NprMat_NPRToonV2_.mate")
+    assert tasks.has_npr_reference(b"a_nprmat_nprtoonv2_.mate")
+    assert not tasks.has_npr_reference(b"a_NPRToonV2_.mate")
+
+
+@pytest.mark.finished()
+def test_menu_without_npr_reference(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(CMC_Config, "config", dataclasses.replace(CMC_Config.config, backup=True))
+    npr_menu = Menu.create(item_name="a", category="wear", infoText="a")
+    npr_menu.add_command(["マテリアル変更", "wear", "0", "a_NprMat_NPRToonV2_.mate"])
+    menu_data = {
+        "a.menu": npr_menu.build(),
+        "plain.menu": Menu.create(item_name="plain", category="wear", infoText="plain").build(),
+    }
+    entries = []
+    for name, data in menu_data.items():
+        (tmp_path / name).write_bytes(data)
+        entries.append(FileEntry(tmp_path, str(tmp_path / name), len(data), 0, 0))
+    npr_entry, plain_entry = entries
+    prefetch_result = BatchResult()
+    for e in entries:
+        tasks.prefetch(StageContext.create(WorkType.Prefetch), e, prefetch_result)
+    assert prefetch_result.menu_candidates == [npr_entry]
+    assert (prefetch_result.skipped, prefetch_result.scanned) == (1, [(plain_entry, MENU_NO_NPR)])
+    # A Menu changed since the prefetch is skipped by the Menu stage as well
+    menu_result = BatchResult()
+    context = StageContext.create(WorkType.Menu, mate_name_dict={"a_nprmat_nprtoonv2_.mate": "a_npr.mate"})
+    tasks.process_menu(context, plain_entry, menu_data["plain.menu"], menu_result)
+    assert (menu_result.skipped, menu_result.scanned, menu_result.menu_fixes) == (1, [(plain_entry, MENU_NO_NPR)], [])
+    manager = WorkManager(lambda percentage: None, lambda: None)
+    manager.clear()
+    backup_calls = []
+    manager.backup_pool = SimpleNamespace(add_backup=lambda *args, **kwargs: backup_calls.append(args) or True)
+    manager.write_thread = WriteBehindThread()
+    manager.merge_prefetch_result(prefetch_result)
+    manager.merge_menu_result(menu_result)
+    # Neither backed up nor written
+    assert backup_calls == []
+    assert manager.write_thread.fix_queue.empty()
+    assert manager.get_summary()["menu"]["skipped"] == 2